@@ -0,0 +1,72 @@
+"""
+Event dispatch benchmarks.
+
+Usage: python -m lymph.benchmarks.events [<patterns>] [<n>]
+
+Registers <patterns> (default: 1000) patterns with an `EventDispatcher`, a
+quarter of them with wildcards, and measures the time per dispatched event
+with a cached event type, with an empty cache, and for matching every
+pattern as a regex, like `EventDispatcher` did before it used a trie.
+"""
+from __future__ import division, print_function
+
+import itertools
+import sys
+
+from lymph.benchmarks.utils import measure
+from lymph.core.events import Event, EventDispatcher
+
+
+def _handler(event):
+    pass
+
+
+def create_patterns(n):
+    patterns = []
+    for i in range(n):
+        if i % 8 == 0:
+            patterns.append('service%s.*' % i)
+        elif i % 8 == 1:
+            patterns.append('service%s.#' % i)
+        else:
+            patterns.append('service%s.entity%s.changed' % (i, i % 10))
+    return patterns
+
+
+def dispatch_events(patterns=1000, n=10000):
+    dispatcher = EventDispatcher()
+    regexes = []
+    for pattern in create_patterns(patterns):
+        dispatcher.register(pattern, _handler)
+        regexes.append(dispatcher.compile(pattern))
+    events = [Event('service%s.entity%s.changed' % (i % patterns, i % 10), {}) for i in range(n)]
+    it = itertools.cycle(events)
+    cached = events[2]
+
+    def uncached():
+        dispatcher.cache.clear()
+        dispatcher(next(it))
+
+    def regex():
+        evt_type = next(it).evt_type
+        for regex in regexes:
+            if regex.match(evt_type):
+                _handler(cached)
+
+    return {
+        'cached': measure(lambda: dispatcher(cached), n),
+        'uncached': measure(uncached, n),
+        'regex': measure(regex, n),
+    }
+
+
+def main(argv):
+    patterns = int(argv[1]) if len(argv) > 1 else 1000
+    n = int(argv[2]) if len(argv) > 2 else 10000
+    print('dispatch, %s patterns, %s events' % (patterns, n))
+    for name, result in sorted(dispatch_events(patterns, n).items()):
+        print('  %-10s %8.2f us/event' % (name, 1e6 * result['duration']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,98 @@
+"""
+Message encoding and receive path benchmarks.
+
+Usage: python -m lymph.benchmarks.messages [<body size in bytes>] [<n>]
+
+Compares
+  * receiving messages with and without zero-copy frames (time and traced
+    allocations per message),
+  * the throughput of the classic and the compact wire format for messages
+    with the given body size.
+"""
+from __future__ import division, print_function
+
+import sys
+
+import zmq
+
+from lymph.benchmarks.utils import measure
+from lymph.core.messages import Message
+
+
+class _PairSockets(object):
+    def __init__(self, name):
+        self.ctx = zmq.Context()
+        endpoint = 'inproc://lymph-benchmark-%s' % name
+        self.recv_sock = self.ctx.socket(zmq.PAIR)
+        self.recv_sock.bind(endpoint)
+        self.send_sock = self.ctx.socket(zmq.PAIR)
+        self.send_sock.connect(endpoint)
+
+    def __enter__(self):
+        return self.send_sock, self.recv_sock
+
+    def __exit__(self, *exc_info):
+        self.send_sock.close()
+        self.recv_sock.close()
+        self.ctx.term()
+
+
+def _create_message(body_size):
+    return Message(Message.REQ, 'benchmark.receive', body={'blob': b'x' * body_size}, source='inproc://benchmark')
+
+
+def receive_messages(body_size=1024 * 1024, n=50):
+    msg = _create_message(body_size)
+    frames = [msg.source.encode('utf-8')] + msg.pack_frames()
+    results = {}
+    with _PairSockets('receive') as (send_sock, recv_sock):
+        for copy in (True, False):
+            def receive():
+                send_sock.send_multipart(frames, copy=True)
+                received = Message.unpack_frames(recv_sock.recv_multipart(copy=copy), copy=copy)
+                received.headers
+                received.body
+            results['copy' if copy else 'zero-copy'] = measure(receive, n)
+    return results
+
+
+def wire_formats(body_size=100, n=10000):
+    msg = _create_message(body_size)
+    source = msg.source.encode('utf-8')
+    pack = {
+        'classic': msg.pack_frames,
+        'compact': lambda: [msg.pack_compact()],
+    }
+    results = {}
+    with _PairSockets('formats') as (send_sock, recv_sock):
+        for name, pack_frames in pack.items():
+            def send_and_receive():
+                send_sock.send_multipart([source] + pack_frames())
+                received = Message.unpack_frames(recv_sock.recv_multipart())
+                received.headers
+                received.body
+            result = measure(send_and_receive, n)
+            result['messages_per_second'] = 1 / result['duration']
+            results[name] = result
+    return results
+
+
+def _format_allocated(allocated):
+    if allocated is None:
+        return 'n/a'
+    return '%10.0f bytes allocated/msg' % allocated
+
+
+def main(argv):
+    body_size = int(argv[1]) if len(argv) > 1 else 1024 * 1024
+    n = int(argv[2]) if len(argv) > 2 else 50
+    print('receive path, body size: %s bytes, %s messages' % (body_size, n))
+    for name, result in sorted(receive_messages(body_size, n).items()):
+        print('  %-10s %8.3f ms/msg  %s' % (name, 1000 * result['duration'], _format_allocated(result['allocated'])))
+    print('wire formats, body size: 100 bytes')
+    for name, result in sorted(wire_formats().items()):
+        print('  %-10s %8.0f msg/s  %s' % (name, result['messages_per_second'], _format_allocated(result['allocated'])))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
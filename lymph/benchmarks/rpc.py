@@ -0,0 +1,212 @@
+"""
+End-to-end RPC benchmarks.
+
+Usage: python -m lymph.benchmarks.rpc [<n>] [<concurrency>]
+
+Starts service containers in this process that talk over ZeroMQ (via tcp on
+the loopback interface unless other transports are enabled) and measures, for each scenario, the requests per
+second, latency percentiles, traced allocations per request, and greenlet
+switches per request. Results are printed as JSON, see also `lymph bench`.
+
+Scenarios:
+  * echo: a request with a small body,
+  * large-payload: a request with a 1 MB body,
+  * fan-out: one request to each of several instances, waiting for all replies,
+  * streaming: a streamed reply of 100 small chunks.
+"""
+from __future__ import division, print_function
+
+import json
+import platform
+import sys
+import time
+
+import gevent
+import greenlet
+from gevent.pool import Pool
+
+import lymph
+from lymph.benchmarks.utils import AllocationTracker, tracemalloc
+from lymph.core.container import ServiceContainer
+from lymph.core.decorators import rpc
+from lymph.core.interfaces import Interface
+from lymph.core.rpc import ZmqRPCServer
+from lymph.discovery.static import StaticServiceRegistryHub
+from lymph.events.null import NullEventSystem
+from lymph.utils import Histogram
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+SCENARIOS = ('echo', 'fan-out', 'large-payload', 'streaming')
+
+
+class Bench(Interface):
+    @rpc()
+    def echo(self, body=None):
+        return body
+
+    @rpc(stream=True)
+    def chunks(self, n=100, size=100):
+        chunk = b'x' * size
+        for i in range(n):
+            yield chunk
+
+
+class _SwitchCounter(object):
+    """
+    Counts greenlet switches while active.
+    """
+
+    def __init__(self):
+        self.switches = 0
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self.switches += 1
+
+    def __enter__(self):
+        self._previous = greenlet.settrace(self._trace)
+        return self
+
+    def __exit__(self, *exc_info):
+        greenlet.settrace(self._previous)
+
+
+class BenchmarkNetwork(object):
+    """
+    Service containers with a shared static registry: `instances` instances
+    of the `bench` service and a client.
+    """
+
+    def __init__(self, instances=4, ip='127.0.0.1', **rpc_options):
+        self.hub = StaticServiceRegistryHub()
+        self.events = NullEventSystem()
+        self.containers = [self._create_container(Bench, ip, rpc_options) for i in range(instances)]
+        self.client = self._create_container(None, ip, rpc_options)
+
+    def _create_container(self, interface_cls, ip, rpc_options):
+        container = ServiceContainer(rpc=ZmqRPCServer(ip=ip, **rpc_options), registry=self.hub.create_registry(), events=self.events)
+        if interface_cls:
+            container.install_interface(interface_cls, name='bench')
+        return container
+
+    def start(self):
+        for container in self.containers:
+            container.start()
+        self.client.start(register=False)
+
+    def stop(self):
+        for container in self.containers + [self.client]:
+            container.stop()
+        for container in self.containers + [self.client]:
+            container.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def request(self, subject, body, timeout=5):
+        return self.client.send_request('bench', subject, body).get(timeout=timeout)
+
+    def echo(self, size=100):
+        body = {'body': b'x' * size}
+        return lambda: self.request('bench.echo', body)
+
+    def fan_out(self, size=100):
+        body = {'body': b'x' * size}
+        endpoints = [container.endpoint for container in self.containers]
+
+        def fan_out():
+            channels = [self.client.send_request(endpoint, 'bench.echo', body) for endpoint in endpoints]
+            for channel in channels:
+                channel.get(timeout=5)
+        return fan_out
+
+    def stream(self, chunks=100, size=100):
+        body = {'n': chunks, 'size': size}
+
+        def stream():
+            channel = self.client.send_request('bench', 'bench.chunks', body, stream=True)
+            for chunk in channel.iter(timeout=5):
+                pass
+        return stream
+
+
+def run_scenario(func, n=1000, concurrency=10, traced=100):
+    """
+    Calls `func` `n` times from `concurrency` greenlets and returns the
+    requests per second, the latency percentiles (in ms), the greenlet
+    switches per call, and the mean peak allocation per call (in bytes).
+    Allocations are traced in a separate sequential run of `traced` calls,
+    as tracing slows everything down.
+    """
+    func()  # warm up connections and lookups
+    latencies = Histogram()
+
+    def timed_call(i):
+        start = time.time()
+        func()
+        latencies.add(time.time() - start)
+
+    pool = Pool(size=concurrency)
+    with _SwitchCounter() as counter:
+        start = time.time()
+        pool.map(timed_call, range(n))
+        duration = time.time() - start
+    allocated = None
+    if tracemalloc and traced:
+        allocated = 0
+        for i in range(traced):
+            with AllocationTracker() as tracker:
+                func()
+            allocated += tracker.peak
+        allocated /= traced
+    return {
+        'n': n,
+        'concurrency': concurrency,
+        'requests_per_second': n / duration,
+        'latency_ms': dict(('p%s' % p, 1000 * latencies.percentile(p)) for p in PERCENTILES),
+        'greenlet_switches': counter.switches / n,
+        'allocated': allocated,
+    }
+
+
+def run(n=1000, concurrency=10, instances=4, payload_size=1024 * 1024, scenarios=None, **rpc_options):
+    """
+    Runs the given scenarios (default: all) and returns a JSON serializable
+    dict of results.
+    """
+    results = {}
+    with BenchmarkNetwork(instances=instances, **rpc_options) as network:
+        factories = {
+            'echo': (network.echo, n),
+            'large-payload': (lambda: network.echo(size=payload_size), max(1, n // 10)),
+            'fan-out': (network.fan_out, n),
+            'streaming': (network.stream, max(1, n // 10)),
+        }
+        for name in scenarios or SCENARIOS:
+            factory, count = factories[name]
+            results[name] = run_scenario(factory(), n=count, concurrency=concurrency, traced=min(count, 100))
+    return {
+        'lymph': lymph.__version__,
+        'python': platform.python_version(),
+        'gevent': gevent.__version__,
+        'instances': instances,
+        'rpc': rpc_options,
+        'scenarios': results,
+    }
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 1000
+    concurrency = int(argv[2]) if len(argv) > 2 else 10
+    print(json.dumps(run(n=n, concurrency=concurrency), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    import lymph.monkey
+    lymph.monkey.patch()
+    main(sys.argv)
@@ -0,0 +1,71 @@
+"""
+Serializer benchmarks.
+
+Usage: python -m lymph.benchmarks.serializers [<n>]
+
+Encodes and decodes realistic payloads with the msgpack serializer, with
+extension types encoded as tagged dicts (legacy) and as msgpack ExtTypes.
+"""
+from __future__ import division, print_function
+
+import datetime
+import decimal
+import sys
+import uuid
+
+import pytz
+
+from lymph.benchmarks.utils import measure
+from lymph.serializers.base import MsgpackSerializer
+
+
+def _order(i):
+    created_at = datetime.datetime(2015, 6, 1, 12, 30) + datetime.timedelta(minutes=i)
+    return {
+        'id': uuid.UUID(int=i),
+        'customer_id': uuid.UUID(int=i * 7919),
+        'created_at': pytz.utc.localize(created_at),
+        'updated_at': pytz.timezone('Europe/Berlin').localize(created_at),
+        'delivery_date': created_at.date(),
+        'status': 'shipped',
+        'items': [
+            {'sku': 'sku-%s' % j, 'quantity': j, 'price': decimal.Decimal('%s.99' % j)}
+            for j in range(3)
+        ],
+    }
+
+
+PAYLOADS = {
+    'orders': {'orders': [_order(i) for i in range(20)], 'total': 20},
+    'plain': {'orders': [{'id': i, 'status': 'shipped', 'items': list(range(3))} for i in range(20)], 'total': 20},
+    'timestamps': {'timestamps': [pytz.utc.localize(datetime.datetime(2015, 6, 1) + datetime.timedelta(seconds=i)) for i in range(100)]},
+}
+
+
+def serialize(payload, n=1000):
+    results = {}
+    for name, serializer in (('legacy', MsgpackSerializer()), ('ext', MsgpackSerializer(ext_types=True))):
+        packed = serializer.dumps(payload)
+        results[name] = {
+            'size': len(packed),
+            'dumps': measure(lambda: serializer.dumps(payload), n),
+            'loads': measure(lambda: serializer.loads(packed), n),
+        }
+    return results
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 1000
+    for payload_name, payload in sorted(PAYLOADS.items()):
+        print('%s:' % payload_name)
+        for name, result in sorted(serialize(payload, n).items()):
+            print('  %-7s %6s bytes  dumps %8.1f us  loads %8.1f us' % (
+                name,
+                result['size'],
+                1e6 * result['dumps']['duration'],
+                1e6 * result['loads']['duration'],
+            ))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
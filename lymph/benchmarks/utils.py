@@ -0,0 +1,53 @@
+from __future__ import division
+
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+
+class AllocationTracker(object):
+    """
+    Measures the peak of traced memory allocated by a block of code. Requires
+    `tracemalloc` (python >= 3.4), otherwise `peak` is always None.
+    """
+
+    def __init__(self):
+        self.peak = None
+
+    def __enter__(self):
+        if tracemalloc:
+            tracemalloc.start()
+            self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        if tracemalloc:
+            self.peak = tracemalloc.get_traced_memory()[1] - self._start
+            tracemalloc.stop()
+
+
+def measure(func, n):
+    """
+    Calls `func` `n` times and returns the mean duration (in seconds) and the
+    mean peak allocation (in bytes) per call. Allocations are traced in a
+    separate run of `n` calls as tracing slows down `func`.
+    """
+    start = time.time()
+    for i in range(n):
+        func()
+    duration = time.time() - start
+    allocated = None
+    if tracemalloc:
+        allocated = 0
+        for i in range(n):
+            with AllocationTracker() as tracker:
+                func()
+            allocated += tracker.peak
+        allocated /= n
+    return {
+        'duration': duration / n,
+        'allocated': allocated,
+    }
@@ -0,0 +1,60 @@
+from __future__ import print_function
+import json
+import sys
+
+from lymph.cli.base import Command
+
+
+class BenchCommand(Command):
+    """
+    Usage: lymph bench [options] [<scenario>...]
+
+    Description:
+        Starts service containers in this process and benchmarks RPC calls
+        between them over ZeroMQ. Scenarios are echo, large-payload, fan-out,
+        and streaming (default: all). Results are printed as JSON.
+
+    Options:
+      -N <number>                  Send a total of <N> requests per scenario [default: 1000].
+      -C <concurrency>             Send requests from <concurrency> concurrent greenlets [default: 10].
+      --instances=<n>              Number of service instances [default: 4].
+      --payload-size=<bytes>       Body size for the large-payload scenario [default: 1048576].
+      --wire-format=<format>       Either classic or compact [default: classic].
+      --send-queue                 Queue outgoing messages and send them in batches.
+      --zero-copy                  Receive messages without copying their frames.
+      --transports=<transports>    Comma separated transports to use, e.g.
+                                   tcp,ipc,inproc [default: tcp].
+      --output=<file>, -o <file>   Write the results to the given file.
+
+    {COMMON_OPTIONS}
+    """
+
+    needs_config = False
+    short_description = 'Benchmarks RPC calls between in-process containers.'
+
+    def run(self):
+        from lymph.benchmarks.rpc import SCENARIOS, run
+
+        scenarios = self.args['<scenario>']
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                print("unknown scenario: %s (choose from %s)" % (scenario, ', '.join(SCENARIOS)))
+                return 1
+        results = run(
+            n=int(self.args['-N']),
+            concurrency=int(self.args['-C']),
+            instances=int(self.args['--instances']),
+            payload_size=int(self.args['--payload-size']),
+            scenarios=scenarios,
+            wire_format=self.args['--wire-format'],
+            send_queue=self.args['--send-queue'],
+            zero_copy=self.args['--zero-copy'],
+            transports=tuple(self.args['--transports'].split(',')),
+        )
+        output = self.args['--output']
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            print()
@@ -73,7 +73,7 @@ class RequestCommand(Command):
         n_success = len(timings)
         n_timeout = len(timeouts)
         avg = sum(timings) / n_success
-        stddev = math.sqrt(sum((t - avg) ** 2 for t in timings)) / n_success
+        stddev = math.sqrt(sum((t - avg) ** 2 for t in timings) / n_success)
 
         print()
         print('Requests per second:   %8.2f Hz  (#req=%s)' % (n_success / total_time, n_success))
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 from functools import partial
@@ -12,6 +13,7 @@ from lymph.utils import import_object, dump_stacks
 from lymph.autoreload import set_source_change_callback
 from lymph.cli.base import Command
 from lymph.core.container import create_container
+from lymph.services.workers import WorkerFront, FRONT_NAME, WORKER_FRONT_ENV, join_front
 from lymph.utils.sockets import get_unused_port
 
 
@@ -43,7 +45,11 @@ class InstanceCommand(Command):
     """
     Usage: lymph instance [--ip=<address> | --guess-external-ip | -g]
                          [--port <port> | -p <port>] [--reload] [--debug]
-                         [--interface=<cls>]... [options]
+                         [--interface=<cls>]... [--workers=<n>] [options]
+
+    Options:
+      --workers=<n>                Run the interfaces in <n> worker processes
+                                   behind this instance.
 
     {INSTANCE_OPTIONS}
 
@@ -55,6 +61,16 @@ class InstanceCommand(Command):
 
     def run(self):
         debug = self.args.get('--debug')
+        front = os.environ.get(WORKER_FRONT_ENV)
+        self.workers = 0 if front else int(self.args.get('--workers') or 0)
+        if front or self.workers:
+            # The front and its workers talk over ipc.
+            transports = list(self.config.get('container.rpc.transports', ['tcp']))
+            if 'ipc' not in transports:
+                self.config.set('container.rpc.transports', transports + ['ipc'])
+        if front:
+            # Workers are only reached through the front.
+            self.config.set('container.port', None)
 
         self._setup_container(debug)
 
@@ -65,7 +81,10 @@ class InstanceCommand(Command):
 
         self._set_process_title()
 
-        self.container.start(register=not self.args.get('--isolated', False))
+        self.container.start(register=not self.args.get('--isolated', False) and not front)
+
+        if front:
+            join_front(self.container, json.loads(front))
 
         if self.args.get('--reload'):
             set_source_change_callback(self.container.stop)
@@ -79,6 +98,15 @@ class InstanceCommand(Command):
         sys.excepthook = self.container.excepthook
 
         install_plugins(self.container, self.config.get('plugins', {}))
+        if self.workers:
+            # The interfaces run in the worker processes.
+            front = self.container.install_interface(WorkerFront, name=FRONT_NAME)
+            front.apply_config({
+                'command': [sys.executable] + sys.argv,
+                'numprocesses': self.workers,
+                'register': not self.args.get('--isolated', False),
+            })
+            return
         install_interfaces(self.container, self.config.get('interfaces', {}))
 
         for cls_name in self.args.get('--interface', ()):
@@ -0,0 +1,133 @@
+from __future__ import division
+
+import collections
+import math
+import time
+
+from lymph.utils.gpool import RejectExcecutionError
+from lymph.core.monitoring import metrics
+
+# Requests for these subjects are never queued or shed.
+PRIORITY_SUBJECTS = frozenset(['lymph.ping', 'lymph.status'])
+
+
+class ConcurrencyLimit(object):
+    """
+    Adapts the number of requests that may be handled concurrently to the
+    handling latency, like a gradient limiter: the limit grows by up to
+    `sqrt(limit)` per window of samples while the recent latency stays
+    within `tolerance` times the long-term latency, and shrinks in
+    proportion when it doesn't. The long-term latency is an average over
+    about `long_window` windows.
+    """
+
+    def __init__(self, initial=20, min_limit=1, max_limit=1000, tolerance=1.5, smoothing=0.2, window=10, long_window=100):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.window = window
+        self.long_window = long_window
+        self.long_latency = None
+        self._sample_count = 0
+        self._sample_sum = 0
+
+    def __int__(self):
+        return int(self.limit)
+
+    def add(self, latency):
+        self._sample_count += 1
+        self._sample_sum += latency
+        if self._sample_count < self.window:
+            return
+        short_latency = self._sample_sum / self._sample_count
+        self._sample_count = 0
+        self._sample_sum = 0
+        if self.long_latency is None:
+            self.long_latency = short_latency
+        else:
+            self.long_latency += (short_latency - self.long_latency) / self.long_window
+        if not short_latency:
+            return
+        gradient = max(0.5, min(1, self.tolerance * self.long_latency / short_latency))
+        limit = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit + self.smoothing * (limit - self.limit)
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+
+class AdmissionController(object):
+    """
+    Decides which received requests are handled. At most `limit` requests
+    are handled at the same time, further requests wait in a queue of at
+    most `max_queue_size` requests. Requests that don't fit into the queue
+    are shed, i.e. answered with a NACK right away.
+
+    The queue is managed like CoDel: once requests have been waiting longer
+    than `target_delay` for an `interval`, requests are shed when they are
+    taken from the queue until the queue delay drops below the target.
+    """
+
+    def __init__(self, server, max_queue_size=1000, target_delay=.1, interval=1, limit=None, priority_subjects=PRIORITY_SUBJECTS):
+        self.server = server
+        self.max_queue_size = max_queue_size
+        self.target_delay = target_delay
+        self.interval = interval
+        self.limit = limit or ConcurrencyLimit()
+        self.priority_subjects = priority_subjects
+        self.queue = collections.deque()
+        self.running = 0
+        self.first_above_time = 0
+
+    def admit(self, msg, deadline=None):
+        if msg.subject in self.priority_subjects:
+            self.spawn(self.server.dispatch_request, msg, deadline)
+        elif self.running < int(self.limit) and not self.queue:
+            self._dispatch(msg, deadline)
+        elif len(self.queue) < self.max_queue_size:
+            self.queue.append((time.monotonic(), msg, deadline))
+        else:
+            self.server.shed_request(msg, 'queue_full')
+
+    def spawn(self, func, msg, *args):
+        try:
+            self.server.spawn(func, msg, *args)
+        except RejectExcecutionError:
+            self.server.shed_request(msg, 'pool_full')
+            return False
+        return True
+
+    def _dispatch(self, msg, deadline):
+        self.running += 1
+        if not self.spawn(self._run, msg, deadline):
+            self.running -= 1
+
+    def _run(self, msg, deadline):
+        start = time.monotonic()
+        try:
+            self.server.dispatch_request(msg, deadline)
+        finally:
+            self.running -= 1
+            self.limit.add(time.monotonic() - start)
+            self._dispatch_queued()
+
+    def _dispatch_queued(self):
+        while self.queue and self.running < int(self.limit):
+            enqueued_at, msg, deadline = self.queue.popleft()
+            now = time.monotonic()
+            if deadline is not None and deadline <= now:
+                self.server.drop_expired_request(msg)
+                continue
+            # Like CoDel, the last request in the queue is never shed.
+            if now - enqueued_at < self.target_delay or not self.queue:
+                self.first_above_time = 0
+            elif not self.first_above_time:
+                self.first_above_time = now + self.interval
+            elif now >= self.first_above_time:
+                self.server.shed_request(msg, 'queue_delay')
+                continue
+            self._dispatch(msg, deadline)
+
+    def _get_metrics(self):
+        yield metrics.RawMetric('rpc.queue_size', len(self.queue))
+        yield metrics.RawMetric('rpc.concurrency_limit', int(self.limit))
@@ -0,0 +1,185 @@
+from __future__ import division
+
+import math
+import random
+import time
+import weakref
+
+from lymph.core import services
+from lymph.utils import import_object
+
+
+class EndpointSet(object):
+    """
+    The endpoints of a service's instances. The list is built when it is
+    first needed and discarded when the service reports a change.
+    """
+
+    def __init__(self, service):
+        self._endpoints = None
+        service.observe((services.ADDED, services.REMOVED, services.UPDATED), self.invalidate)
+        self._service = weakref.ref(service)
+
+    def invalidate(self, instance=None, action=None):
+        self._endpoints = None
+
+    @property
+    def endpoints(self):
+        if self._endpoints is None:
+            self._endpoints = [instance.endpoint for instance in self._service()]
+        return self._endpoints
+
+
+class Balancer(object):
+    """
+    Picks the endpoint a request is sent to. Endpoints without a connection
+    or with a live connection are candidates.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.endpoint_sets = weakref.WeakKeyDictionary()
+
+    def get_endpoints(self, service):
+        try:
+            endpoint_set = self.endpoint_sets[service]
+        except KeyError:
+            endpoint_set = self.endpoint_sets[service] = EndpointSet(service)
+        endpoints = endpoint_set.endpoints
+        unavailable = self.server.breakers.get_unavailable(service.name)
+        if unavailable:
+            # Skip endpoints with an open circuit breaker, unless all are.
+            available = [endpoint for endpoint in endpoints if endpoint not in unavailable]
+            if available:
+                return available
+        return endpoints
+
+    def is_candidate(self, endpoint):
+        connection = self.server.connections.get(endpoint)
+        return connection is None or connection.is_alive()
+
+    def get_candidates(self, endpoints):
+        return [endpoint for endpoint in endpoints if self.is_candidate(endpoint)]
+
+    def sample(self, endpoints, k):
+        """
+        Returns up to `k` distinct random candidates from `endpoints`.
+        """
+        if len(endpoints) > k:
+            # Most endpoints are usually alive, so try a random sample first.
+            sample = random.sample(endpoints, k)
+            if all(self.is_candidate(endpoint) for endpoint in sample):
+                return sample
+        candidates = self.get_candidates(endpoints)
+        if len(candidates) <= k:
+            return candidates
+        return random.sample(candidates, k)
+
+    def pick(self, service):
+        """
+        Returns an endpoint of `service`, or None if there is no candidate.
+        """
+        raise NotImplementedError
+
+    def pick_other(self, service, endpoint):
+        """
+        Returns an endpoint of `service` other than `endpoint`, e.g. for a
+        hedged request, or None if there is no other candidate.
+        """
+        for other in self.sample(self.get_endpoints(service), 2):
+            if other != endpoint:
+                return other
+        return None
+
+
+class RandomBalancer(Balancer):
+    def pick(self, service):
+        sample = self.sample(self.get_endpoints(service), 1)
+        return sample[0] if sample else None
+
+
+class LeastCostBalancer(Balancer):
+    """
+    Picks the cheaper of two random candidates (power of two choices).
+    """
+
+    def get_cost(self, connection):
+        raise NotImplementedError
+
+    def pick(self, service):
+        sample = self.sample(self.get_endpoints(service), 2)
+        if len(sample) < 2:
+            return sample[0] if sample else None
+        a, b = sample
+        return a if self._get_cost(a) <= self._get_cost(b) else b
+
+    def _get_cost(self, endpoint):
+        connection = self.server.connections.get(endpoint)
+        if connection is None:
+            return 0
+        return self.get_cost(connection)
+
+
+class LeastOutstandingBalancer(LeastCostBalancer):
+    def get_cost(self, connection):
+        return len(connection.outstanding_requests)
+
+
+class EWMABalancer(LeastCostBalancer):
+    """
+    Prefers instances with a lower expected time to complete another
+    request: their latency EWMA times the number of outstanding requests.
+    """
+
+    def get_cost(self, connection):
+        return connection.latency_ewma * (len(connection.outstanding_requests) + 1)
+
+
+class PhiBalancer(Balancer):
+    """
+    Picks a random candidate weighted by `1 / (1 + phi)`, where phi is the
+    suspicion level for the time since the peer was last heard from, assuming
+    exponentially distributed message inter-arrival times with a mean of the
+    heartbeat interval.
+    """
+
+    def get_phi(self, connection, now):
+        return (now - connection.last_seen) / (connection.heartbeat_interval * math.log(10))
+
+    def pick(self, service):
+        candidates = self.get_candidates(self.get_endpoints(service))
+        if not candidates:
+            return None
+        now = time.monotonic()
+        weights = []
+        for endpoint in candidates:
+            connection = self.server.connections.get(endpoint)
+            if connection is None or not connection.last_seen:
+                weights.append(1)
+            else:
+                weights.append(1 / (1 + self.get_phi(connection, now)))
+        x = random.random() * sum(weights)
+        for endpoint, weight in zip(candidates, weights):
+            x -= weight
+            if x < 0:
+                return endpoint
+        return candidates[-1]
+
+
+BALANCERS = {
+    'random': RandomBalancer,
+    'p2c': LeastOutstandingBalancer,
+    'ewma': EWMABalancer,
+    'phi': PhiBalancer,
+}
+
+
+def get_balancer_class(name):
+    """
+    Returns the balancer class for one of the names in `BALANCERS` or an
+    import path (`module:Class`).
+    """
+    try:
+        return BALANCERS[name]
+    except KeyError:
+        return import_object(name)
@@ -1,39 +1,427 @@
+import heapq
+import itertools
+import logging
+import time
+
 import gevent
+import gevent.event
+import gevent.hub
 import gevent.queue
 
 from lymph.exceptions import Timeout, Nack, RemoteError
 from lymph.core.messages import Message
 
 
+logger = logging.getLogger(__name__)
+
+# Number of chunks a server may send ahead of the consumer of a stream.
+STREAM_WINDOW = 16
+# Streams are aborted if the consumer doesn't grant new credits in time.
+STREAM_CREDIT_TIMEOUT = 30
+
+# Maximum number of calls in a multi-call request.
+MULTI_CALL_MAX_SIZE = 100
+
+# Channels of requests without a deadline are closed after this many seconds
+# if nobody waits for the reply.
+STALE_CHANNEL_TIMEOUT = 30
+
+STREAM_CHUNK = 'chunk'
+STREAM_END = 'end'
+
+
+def get_stream_subject(request_id):
+    # Subject of the credit messages a consumer sends to the producer.
+    return '%s.stream' % request_id
+
+
 class Channel(object):
+    __slots__ = ('request', 'server')
+
     def __init__(self, request, server):
         self.request = request
         self.server = server
 
+    def get_request(self, request_id):
+        """
+        Returns the request message of this channel with id `request_id`, or
+        None.
+        """
+        if self.request.id == request_id:
+            return self.request
+
+
+class ChannelTimeouts(object):
+    """
+    Wakes up channels whose `get()` timed out, and closes channels nobody
+    waits for, from a single greenlet and a heap ordered by time. This
+    replaces a timer per `get()` call.
+
+    The heap only holds request ids, channels are looked up in
+    `server.channels` when their time comes, so closed channels (and their
+    replies) aren't kept alive until then.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.heap = []
+        self.greenlet = None
+        self._counter = itertools.count()
+        self._wakeup = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def start(self):
+        # Not spawned on the server's pool: it must not be rejected by a
+        # bounded pool, and runs until the server stops.
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+
+    def schedule(self, at, channel):
+        if not self.heap or at < self.heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self.heap, (at, next(self._counter), channel.request.id))
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                at, _, request_id = heapq.heappop(self.heap)
+                channel = self.server.channels.get(request_id)
+                if channel is not None:
+                    channel.expire(now)
+            timeout = self.heap[0][0] - now if self.heap else None
+            self._wakeup.wait(timeout)
+
 
 class RequestChannel(Channel):
+    """
+    Receives the reply to a request. The first reply is kept, later ones are
+    ignored.
+    """
+
+    __slots__ = ('breaker', 'stale_at', '_reply', '_waiter', '_wait_until', '_closed')
+
     def __init__(self, request, server):
         super(RequestChannel, self).__init__(request, server)
-        self.queue = gevent.queue.Queue()
+        self.breaker = None
+        self.stale_at = None
+        self._reply = None
+        self._waiter = None
+        self._wait_until = None
+        self._closed = False
 
     def recv(self, msg):
-        self.queue.put(msg)
+        if self._reply is not None:
+            return
+        self._reply = msg
+        if self._waiter is not None:
+            gevent.get_hub().loop.run_callback(self._wake)
+
+    def _wake(self):
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            waiter.switch(self._reply)
+
+    def expire(self, now):
+        """
+        Called by `ChannelTimeouts` when a scheduled time has come: wakes up a
+        `get()` that timed out, or closes the channel if nobody waits for it
+        and it is stale.
+        """
+        if self._closed or self._reply is not None:
+            return
+        if self._waiter is not None:
+            if now >= self._wait_until:
+                gevent.get_hub().loop.run_callback(self._wake)
+        elif self.stale_at is not None and now >= self.stale_at:
+            logger.debug('closing stale channel: %s', self.request)
+            self.close()
 
     def get(self, timeout=1):
         try:
-            msg = self.queue.get(timeout=timeout)
+            msg = self._reply
+            if msg is None and not self._closed and (timeout is None or timeout > 0):
+                self._waiter = gevent.hub.Waiter()
+                if timeout is not None:
+                    self._wait_until = time.monotonic() + timeout
+                    self.server.timeouts.schedule(self._wait_until, self)
+                msg = self._waiter.get()
+            if msg is None:
+                self._record(False)
+                raise Timeout(self.request)
+            self._record(msg.type != Message.NACK)
             if msg.type == Message.NACK:
                 raise Nack(self.request)
             elif msg.type == Message.ERROR:
                 raise RemoteError.from_reply(self.request, msg)
             return msg
-        except gevent.queue.Empty:
-            raise Timeout(self.request)
         finally:
+            self._waiter = None
             self.close()
 
+    def _record(self, success):
+        # Reports the outcome to the circuit breaker of the receiving instance.
+        if self.breaker is not None:
+            self.breaker.record(success)
+
     def close(self):
-        del self.server.channels[self.request.id]
+        self._closed = True
+        self.server.channels.pop(self.request.id, None)
+
+
+class HedgedRequestChannel(RequestChannel):
+    """
+    Sends a duplicate of the request to another instance of `service` if
+    there is no reply after the hedge delay of `policy`, and returns the
+    first reply. A NACK for one of the requests is ignored while the other
+    one is still outstanding.
+    """
+
+    def __init__(self, request, server, service, policy):
+        super(HedgedRequestChannel, self).__init__(request, server)
+        self.queue = gevent.queue.Queue()
+        self.service = service
+        self.policy = policy
+        self.endpoint = None
+        self.hedge = None
+        self.sent_at = time.monotonic()
+        self.waiting = False
+
+    def expire(self, now):
+        if not self.waiting:
+            super(HedgedRequestChannel, self).expire(now)
+
+    def get(self, timeout=1):
+        self.waiting = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        outstanding = set([self.request.id])
+        hedge_at = None
+        delay = self.policy.get_delay(self.request.subject)
+        if delay is not None and self.endpoint:
+            hedge_at = self.sent_at + delay
+        try:
+            while True:
+                wake_at = deadline
+                if hedge_at is not None and (deadline is None or hedge_at < deadline):
+                    wake_at = hedge_at
+                wait = None if wake_at is None else max(0, wake_at - time.monotonic())
+                try:
+                    msg = self.queue.get(timeout=wait)
+                except gevent.queue.Empty:
+                    if hedge_at is None or (deadline is not None and hedge_at >= deadline):
+                        self._record(False)
+                        raise Timeout(self.request)
+                    hedge_at = None
+                    self.hedge = self.server.send_hedge(self)
+                    if self.hedge is not None:
+                        outstanding.add(self.hedge.id)
+                    continue
+                outstanding.discard(msg.subject)
+                if msg.type == Message.NACK and self.hedge is not None and msg.subject == self.hedge.id:
+                    # The hedge was rejected, most likely the method isn't idempotent.
+                    self.policy.disable(self.request.subject)
+                if msg.type != Message.NACK or not outstanding:
+                    return self._get_result(msg)
+        finally:
+            self.close()
+
+    def recv(self, msg):
+        self.queue.put(msg)
+
+    def get_request(self, request_id):
+        if self.hedge is not None and self.hedge.id == request_id:
+            return self.hedge
+        return super(HedgedRequestChannel, self).get_request(request_id)
+
+    def _get_result(self, msg):
+        if msg.subject == self.request.id:
+            self._record(msg.type != Message.NACK)
+        if msg.type == Message.NACK:
+            raise Nack(self.request)
+        self.policy.record(
+            self.request.subject,
+            time.monotonic() - self.sent_at,
+            hedge_won=self.hedge is not None and msg.subject == self.hedge.id,
+        )
+        if msg.type == Message.ERROR:
+            raise RemoteError.from_reply(self.request, msg)
+        return msg
+
+    def close(self):
+        # Replies to the other request are dropped from now on.
+        self.server.channels.pop(self.request.id, None)
+        if self.hedge is not None:
+            self.server.channels.pop(self.hedge.id, None)
+
+
+class StreamChannel(RequestChannel):
+    """
+    Receives the chunks of a streamed reply. The server sends at most
+    `window` chunks ahead, consumed chunks are acknowledged in batches of
+    half a window.
+    """
+
+    def __init__(self, request, server, window=STREAM_WINDOW):
+        super(StreamChannel, self).__init__(request, server)
+        self.queue = gevent.queue.Queue()
+        self.window = window
+        self.endpoint = None
+        self.consumed = 0
+        self.finished = False
+        self.waiting = False
+
+    def expire(self, now):
+        if not self.waiting:
+            super(StreamChannel, self).expire(now)
+
+    def iter(self, timeout=1):
+        """
+        Yields the chunk messages of the stream. `timeout` applies to each
+        chunk.
+        """
+        self.waiting = True
+        try:
+            while True:
+                try:
+                    msg = self.queue.get(timeout=timeout)
+                except gevent.queue.Empty:
+                    raise Timeout(self.request)
+                if msg.type == Message.NACK:
+                    raise Nack(self.request)
+                elif msg.type == Message.ERROR:
+                    raise RemoteError.from_reply(self.request, msg)
+                stream = msg.headers.get('stream')
+                if stream == STREAM_END:
+                    self.finished = True
+                    return
+                if stream != STREAM_CHUNK:
+                    # A plain reply, e.g. from a method that doesn't stream.
+                    self.finished = True
+                    yield msg
+                    return
+                yield msg
+                self.consumed += 1
+                if self.consumed >= self.window // 2:
+                    self.server.send_stream_credits(self, {'credits': self.consumed})
+                    self.consumed = 0
+        finally:
+            self.close()
+
+    def recv(self, msg):
+        self.queue.put(msg)
+
+    def close(self):
+        if self.request.id not in self.server.channels:
+            return
+        super(StreamChannel, self).close()
+        if not self.finished and self.endpoint:
+            self.server.send_stream_credits(self, {'cancel': True})
+
+
+class RequestBatch(object):
+    """
+    Waits for the replies to several requests at once. The batch is
+    registered as the channel of each request.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.requests = []
+        self.replies = {}
+        self._done = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, request):
+        self.requests.append(request)
+        self._done.clear()
+        return self
+
+    def get_request(self, request_id):
+        for request in self.requests:
+            if request.id == request_id:
+                return request
+
+    def recv(self, msg):
+        self.replies[msg.subject] = msg
+        if len(self.replies) >= len(self.requests):
+            self._done.set()
+
+    def get(self, timeout=1):
+        """
+        Returns the reply, or the exception raised by `RequestChannel.get()`,
+        for each request in order.
+        """
+        if len(self.replies) < len(self.requests):
+            self._done.wait(timeout)
+        self.close()
+        results = []
+        for request in self.requests:
+            msg = self.replies.get(request.id)
+            if msg is None:
+                msg = Timeout(request)
+            elif msg.type == Message.NACK:
+                msg = Nack(request)
+            elif msg.type == Message.ERROR:
+                msg = RemoteError.from_reply(request, msg)
+            results.append(msg)
+        return results
+
+    def close(self):
+        for request in self.requests:
+            self.server.channels.pop(request.id, None)
+
+
+class ForwardChannel(Channel):
+    """
+    Relays a request that was forwarded to `endpoint` (a worker): replies
+    from the worker are sent on to the source of the request, stream credits
+    from the source are sent on to the worker.
+    """
+
+    __slots__ = ('endpoint', 'stale_at')
+
+    def __init__(self, request, server, endpoint, stale_at):
+        super(ForwardChannel, self).__init__(request, server)
+        self.endpoint = endpoint
+        self.stale_at = stale_at
+
+    def recv(self, msg):
+        if msg.source != self.endpoint:
+            self.server.forward_message(self.endpoint, msg)
+            return
+        headers = None
+        if 'subject_table' in msg.headers:
+            # Subject ids of the worker are of no use to the source.
+            headers = dict(msg.headers)
+            del headers['subject_table']
+            headers.pop('subject_ids', None)
+        self.server.forward_message(self.request.source, msg, headers=headers)
+        if msg.headers.get('stream') == STREAM_CHUNK:
+            self.stale_at = time.monotonic() + STALE_CHANNEL_TIMEOUT
+        else:
+            self.close()
+
+    def expire(self, now):
+        if now < self.stale_at:
+            self.server.timeouts.schedule(self.stale_at, self)
+        elif self.server.channels.get(self.request.id) is self:
+            logger.debug('closing stale channel: %s', self.request)
+            self.close()
+
+    def close(self):
+        self.server.channels.pop(self.request.id, None)
+        self.server.channels.pop(get_stream_subject(self.request.id), None)
 
 
 class ReplyChannel(Channel):
@@ -60,5 +448,83 @@ class ReplyChannel(Channel):
     def error(self, **body):
         self.server.send_reply(self.request, body, msg_type=Message.ERROR)
 
+    def stream(self, chunks):
+        """
+        Sends each item of `chunks` as a separate reply, as long as the
+        consumer grants credits. Requests that didn't ask for a stream get a
+        single reply with a list of all chunks.
+        """
+        credits = self.request.headers.get('stream')
+        if not credits:
+            self.reply(list(chunks))
+            return
+        self.credits = credits
+        self.cancelled = False
+        self._credit_event = gevent.event.Event()
+        subject = get_stream_subject(self.request.id)
+        self.server.channels[subject] = self
+        iterator = iter(chunks)
+        try:
+            while True:
+                # Only produce a chunk once the consumer can take it.
+                while not self.credits and not self.cancelled:
+                    self._credit_event.clear()
+                    if not self._credit_event.wait(STREAM_CREDIT_TIMEOUT):
+                        logger.warning('stream %s timed out waiting for credits', self.request.id)
+                        self.cancelled = True
+                if self.cancelled:
+                    self._sent_reply = True
+                    return
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                self.server.send_reply(self.request, chunk, headers={'stream': STREAM_CHUNK})
+                self.credits -= 1
+            self.server.send_reply(self.request, None, headers={'stream': STREAM_END})
+            self._sent_reply = True
+        finally:
+            self.server.channels.pop(subject, None)
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+
+    def recv(self, msg):
+        # Credit messages of the consumer of a stream.
+        if msg.body.get('cancel'):
+            self.cancelled = True
+        else:
+            self.credits += msg.body.get('credits', 0)
+        self._credit_event.set()
+
     def close(self):
         pass
+
+
+class MultiCallChannel(ReplyChannel):
+    """
+    Collects the reply to a single call of a multi-call request as a
+    `[type, body]` pair.
+    """
+
+    def __init__(self, request, server):
+        super(MultiCallChannel, self).__init__(request, server)
+        self.result = None
+
+    def _set_result(self, msg_type, body):
+        self.result = [msg_type, body]
+        self._sent_reply = True
+
+    def reply(self, body):
+        self._set_result(Message.REP, body)
+
+    def ack(self, unless_reply_sent=False):
+        if not (unless_reply_sent and self._sent_reply):
+            self._set_result(Message.ACK, None)
+
+    def nack(self, unless_reply_sent=False):
+        if not (unless_reply_sent and self._sent_reply):
+            self._set_result(Message.NACK, None)
+
+    def error(self, **body):
+        self._set_result(Message.ERROR, body)
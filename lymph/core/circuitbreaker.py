@@ -0,0 +1,117 @@
+import time
+
+from lymph.core.monitoring import metrics
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcomes of requests to a service instance. After
+    `failure_threshold` consecutive timeouts or NACKs the breaker opens and
+    the instance isn't picked for `reset_timeout` seconds. After that, a
+    single probe request is let through (half-open); the breaker closes if it
+    succeeds and opens again if it fails.
+    """
+
+    __slots__ = ('breakers', 'service_name', 'endpoint', 'state', 'failures', 'retry_at')
+
+    def __init__(self, breakers, service_name, endpoint):
+        self.breakers = breakers
+        self.service_name = service_name
+        self.endpoint = endpoint
+        self.state = CLOSED
+        self.failures = 0
+        self.retry_at = 0
+
+    def is_available(self, now):
+        return self.state == CLOSED or now >= self.retry_at
+
+    def probe(self, now):
+        self.state = HALF_OPEN
+        self.retry_at = now + self.breakers.reset_timeout
+
+    def record(self, success):
+        if success:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self.breakers.tripped[self.service_name].pop(self.endpoint, None)
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.breakers.failure_threshold:
+            if self.state != OPEN:
+                self.breakers.trip_counts.incr(service=self.service_name)
+            self.state = OPEN
+            self.retry_at = time.monotonic() + self.breakers.reset_timeout
+            self.breakers.tripped.setdefault(self.service_name, {})[self.endpoint] = self
+
+
+class CircuitBreakers(object):
+    """
+    The circuit breakers of a server, one per service name and endpoint.
+    Breakers that aren't closed are also kept in `tripped`, so looking up the
+    endpoints to skip is cheap while all breakers are closed.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=2):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.tripped = {}
+        self.trip_counts = metrics.TaggedCounter('rpc.circuit_breaker.trips')
+
+    def get(self, service_name, endpoint):
+        """
+        Returns the breaker for `endpoint` of `service_name`, or None if
+        circuit breaking is disabled.
+        """
+        if not self.failure_threshold:
+            return None
+        key = (service_name, endpoint)
+        try:
+            return self.breakers[key]
+        except KeyError:
+            breaker = self.breakers[key] = CircuitBreaker(self, service_name, endpoint)
+            return breaker
+
+    def get_unavailable(self, service_name):
+        """
+        Returns the endpoints of `service_name` that shouldn't be picked.
+        """
+        tripped = self.tripped.get(service_name)
+        if not tripped:
+            return ()
+        now = time.monotonic()
+        return set(endpoint for endpoint, breaker in tripped.items() if not breaker.is_available(now))
+
+    def on_pick(self, service_name, endpoint):
+        tripped = self.tripped.get(service_name)
+        if tripped and endpoint in tripped:
+            tripped[endpoint].probe(time.monotonic())
+
+    def remove(self, endpoint):
+        for key in [key for key in self.breakers if key[1] == endpoint]:
+            del self.breakers[key]
+            self.tripped.get(key[0], {}).pop(endpoint, None)
+
+    def get_status(self):
+        return [{
+            'service': breaker.service_name,
+            'endpoint': breaker.endpoint,
+            'state': breaker.state,
+            'failures': breaker.failures,
+        } for tripped in self.tripped.values() for breaker in tripped.values()]
+
+    def _get_metrics(self):
+        for tripped in self.tripped.values():
+            for breaker in tripped.values():
+                yield metrics.RawMetric('rpc.circuit_breaker', 1, {
+                    'service': breaker.service_name,
+                    'endpoint': breaker.endpoint,
+                    'state': breaker.state,
+                })
+        yield self.trip_counts
@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, unicode_literals
 
-import gevent
+import gevent.event
+import heapq
+import itertools
 import math
 import os
 import time
 import logging
 
+from lymph.core.messages import CLASSIC
 from lymph.utils import SampleWindow
-from lymph.exceptions import RpcError
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +20,66 @@ UNRESPONSIVE = 'unresponsive'
 CLOSED = 'closed'
 IDLE = 'idle'
 
+# Weight of a new sample in `Connection.latency_ewma`.
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class HeartbeatScheduler(object):
+    """
+    Drives heartbeats and status checks of all connections of a server from a
+    single greenlet. Connections are kept in a heap ordered by their next
+    check time.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.heap = []
+        self.greenlet = None
+        self._counter = itertools.count()
+        self._wakeup = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, connection, at=None):
+        if at is None:
+            at = time.monotonic()
+        if not self.heap or at < self.heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self.heap, (at, next(self._counter), connection))
+
+    def start(self):
+        self.greenlet = self.server.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                at, _, connection = heapq.heappop(self.heap)
+                if connection.status == CLOSED:
+                    continue
+                connection.heartbeat(now)
+                self.schedule(connection, now + connection.heartbeat_interval)
+            timeout = self.heap[0][0] - now if self.heap else None
+            self._wakeup.wait(timeout)
+
 
 class Connection(object):
+    __slots__ = (
+        'server', 'endpoint', 'timeout', 'heartbeat_interval', 'idle_timeout',
+        'unresponsive_disconnect', 'idle_disconnect', 'last_seen', 'idle_since',
+        'last_message', 'created_at', 'heartbeat_samples', 'explicit_heartbeat_count',
+        'heartbeat_request', 'heartbeat_sent_at', 'status', 'wire_format',
+        'subject_table', 'subject_ids', 'outstanding_requests', 'latency_ewma',
+        'received_message_count', 'sent_message_count',
+    )
+
     def __init__(self, server, endpoint, heartbeat_interval=1, timeout=3, idle_timeout=10, unresponsive_disconnect=30, idle_disconnect=60):
         assert heartbeat_interval < timeout < idle_timeout
         self.server = server
@@ -37,15 +97,20 @@ class Connection(object):
         self.created_at = now
         self.heartbeat_samples = SampleWindow(100, factor=1000)  # milliseconds
         self.explicit_heartbeat_count = 0
+        self.heartbeat_request = None
+        self.heartbeat_sent_at = 0
         self.status = UNKNOWN
+        self.wire_format = CLASSIC
+        self.subject_table = None
+        self.subject_ids = {}
+        # Send times of requests without reply, by message id.
+        self.outstanding_requests = {}
+        self.latency_ewma = 0
 
         self.received_message_count = 0
         self.sent_message_count = 0
 
-        self.heartbeat_loop_greenlet = self.server.spawn(self.heartbeat_loop)
-        self.live_check_loop_greenlet = self.server.spawn(self.live_check_loop)
-
-        self.pid = os.getpid()
+        self.server.heartbeat.schedule(self)
 
     def __str__(self):
         return "connection to=%s last_seen=%s" % (self.endpoint, self._dt())
@@ -63,31 +128,66 @@ class Connection(object):
     def set_status(self, status):
         self.status = status
 
-    def heartbeat_loop(self):
-        while True:
-            start = time.monotonic()
-            channel = self.server.ping(self.endpoint)
-            error = False
-            try:
-                channel.get(timeout=self.heartbeat_interval)
-            except RpcError as e:
-                logger.debug('hearbeat error on %s: %r', self, e)
-                error = True
-            took = time.monotonic() - start
-            if not error:
-                self.heartbeat_samples.add(took)
-                self.explicit_heartbeat_count += 1
-            gevent.sleep(max(0, self.heartbeat_interval - took))
-
-    def live_check_loop(self):
-        while True:
-            self.update_status()
+    def heartbeat(self, now):
+        if self.heartbeat_request is not None:
+            logger.debug('hearbeat timeout on %s', self)
+            self._cancel_heartbeat()
+        self.update_status(now)
+        self._expire_requests(now)
+        if logger.isEnabledFor(logging.DEBUG):
             self.log_stats()
-            gevent.sleep(1)
-
-    def update_status(self):
+        # Any message received from the peer proves liveness, so only idle
+        # connections have to be pinged explicitly.
+        if now - self.last_seen >= self.heartbeat_interval:
+            self.heartbeat_sent_at = time.monotonic()
+            self.heartbeat_request = self.server.send_heartbeat(self)
+
+    def recv(self, msg):
+        # Called by the server with the reply to `heartbeat_request`.
+        self._cancel_heartbeat()
+        if msg.type != msg.REP:
+            logger.debug('hearbeat error on %s: %s', self, msg.type)
+            return
+        self.heartbeat_samples.add(time.monotonic() - self.heartbeat_sent_at)
+        self.explicit_heartbeat_count += 1
+
+    def _cancel_heartbeat(self):
+        if self.heartbeat_request is not None:
+            self.server.channels.pop(self.heartbeat_request.id, None)
+            self.heartbeat_request = None
+
+    def learn_subjects(self, epoch, subject_ids):
+        """
+        Records subject ids of the peer's subject table, which are used
+        instead of subjects in compact requests to the peer.
+        """
+        if epoch != self.subject_table:
+            self.subject_table = epoch
+            self.subject_ids = {}
+        for subject, subject_id in subject_ids.items():
+            self.subject_ids[subject] = (subject_id, epoch)
+
+    def on_request(self, msg):
+        self.outstanding_requests[msg.id] = time.monotonic()
+
+    def _add_latency_sample(self, latency):
+        if self.latency_ewma:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+        else:
+            self.latency_ewma = latency
+
+    def _expire_requests(self, now):
+        # Requests that take longer than `timeout` most likely timed out, they
+        # are no longer counted as outstanding.
+        deadline = now - self.timeout
+        expired = [msg_id for msg_id, sent_at in self.outstanding_requests.items() if sent_at < deadline]
+        for msg_id in expired:
+            self._add_latency_sample(now - self.outstanding_requests.pop(msg_id))
+
+    def update_status(self, now=None):
         if self.last_seen:
-            now = time.monotonic()
+            if now is None:
+                now = time.monotonic()
             if now - self.last_seen >= self.timeout:
                 self.set_status(UNRESPONSIVE)
             elif now - self.last_message >= self.idle_timeout:
@@ -100,7 +200,7 @@ class Connection(object):
         roundtrip_stats = 'window (mean rtt={mean:.1f} ms; stddev rtt={stddev:.1f})'.format(**self.heartbeat_samples.stats)
         roundtrip_total_stats = 'total (mean rtt={mean:.1f} ms; stddev rtt={stddev:.1f})'.format(**self.heartbeat_samples.total.stats)
         logger.debug("pid=%s; endpoint=%s; %s; %s; phi=%.3f; ping/s=%.2f; status=%s" % (
-            self.pid,
+            os.getpid(),
             self.endpoint,
             roundtrip_stats,
             roundtrip_total_stats,
@@ -113,8 +213,7 @@ class Connection(object):
         if self.status == CLOSED:
             return
         self.status = CLOSED
-        self.heartbeat_loop_greenlet.kill()
-        self.live_check_loop_greenlet.kill()
+        self._cancel_heartbeat()
         self.server.disconnect(self.endpoint)
 
     def on_recv(self, msg):
@@ -122,6 +221,10 @@ class Connection(object):
         self.last_seen = now
         if not msg.is_idle_chatter():
             self.last_message = now
+        if self.outstanding_requests and msg.is_reply():
+            sent_at = self.outstanding_requests.pop(msg.subject, None)
+            if sent_at is not None:
+                self._add_latency_sample(now - sent_at)
         self.received_message_count += 1
 
     def on_send(self, msg):
@@ -140,5 +243,7 @@ class Connection(object):
             'phi': self.phi,
             'status': self.status,
             'sent': self.sent_message_count,
+            'outstanding': len(self.outstanding_requests),
+            'latency': self.latency_ewma,
             'received': self.received_message_count,
         }
@@ -1,3 +1,4 @@
+import functools
 import json
 import logging
 import os
@@ -14,7 +15,7 @@ from lymph.core.monitoring.pusher import MonitorPusher
 from lymph.core.monitoring.aggregator import Aggregator
 from lymph.core.services import ServiceInstance, Service
 from lymph.core.rpc import ZmqRPCServer
-from lymph.core.interfaces import DefaultInterface
+from lymph.core.interfaces import DefaultInterface, Interface
 from lymph.core.plugins import Hook
 from lymph.core import trace
 
@@ -54,6 +55,8 @@ class ServiceContainer(Componentized):
         self.events = events
 
         self.installed_interfaces = {}
+        # Request handlers indexed by the ids of `self.server.subjects`.
+        self.request_handlers = [None]
         self.installed_plugins = []
 
         self.debug = debug
@@ -107,10 +110,25 @@ class ServiceContainer(Componentized):
         interface = cls(self, **kwargs)
         self.add_component(interface)
         self.installed_interfaces[interface.name] = interface
+        self._register_subjects(interface)
         for plugin in self.installed_plugins:
             plugin.on_interface_installation(interface)
         return interface
 
+    def _register_subjects(self, interface):
+        for func_name in sorted(interface.methods):
+            subject_id = self.server.subjects.add('%s.%s' % (interface.name, func_name))
+            if six.get_unbound_function(type(interface).handle_request) is six.get_unbound_function(Interface.handle_request):
+                request_handler = interface.get_request_handler(func_name)
+            else:
+                # The interface customizes how it handles its requests.
+                request_handler = functools.partial(interface.handle_request, func_name)
+            handler = (interface.name, func_name, request_handler)
+            if subject_id < len(self.request_handlers):
+                self.request_handlers[subject_id] = handler
+            else:
+                self.request_handlers.append(handler)
+
     def install_plugin(self, cls, **kwargs):
         plugin = self.install(cls, **kwargs)
         self.installed_plugins.append(plugin)
@@ -141,6 +159,7 @@ class ServiceContainer(Componentized):
         description = interface.get_description()
         description.update({
             'endpoint': self.endpoint,
+            'endpoints': self.server.endpoints,
             'identity': self.identity,
             'log_endpoint': self.log_endpoint,
             'backdoor_endpoint': self.backdoor_endpoint,
@@ -188,20 +207,26 @@ class ServiceContainer(Componentized):
         event = Event(event_type, payload, source=self.identity, headers=headers)
         self.events.emit(event, **kwargs)
 
-    def send_request(self, address, subject, body, headers=None):
+    def send_request(self, address, subject, body, headers=None, **kwargs):
         service = self.lookup(address)
-        return self.server.send_request(service, subject, body, headers=headers)
+        return self.server.send_request(service, subject, body, headers=headers, **kwargs)
 
     def handle_request(self, channel):
-        interface_name, func_name = channel.request.subject.rsplit('.', 1)
-        try:
-            interface = self.installed_interfaces[interface_name]
-        except KeyError:
-            logger.warning('unsupported service type: %s', interface_name)
-            channel.nack(True)
-            return
+        msg = channel.request
+        subject_id = msg.subject_id or self.server.subjects.ids.get(msg.subject)
+        if subject_id:
+            interface_name, func_name, handler = self.request_handlers[subject_id]
+        else:
+            interface_name, func_name = msg.subject.rsplit('.', 1)
+            try:
+                interface = self.installed_interfaces[interface_name]
+            except KeyError:
+                logger.warning('unsupported service type: %s', interface_name)
+                channel.nack(True)
+                return
+            handler = functools.partial(interface.handle_request, func_name)
         try:
-            interface.handle_request(func_name, channel)
+            handler(channel)
         except Exception:
             logger.exception('Request error:')
             exc_info = sys.exc_info()
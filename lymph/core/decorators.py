@@ -31,6 +31,8 @@ class RPCBase(collections.Callable):
         2
     """
 
+    idempotent = False
+
     def __init__(self, func, assigned=functools.WRAPPER_ASSIGNMENTS):
         self.original = func
         self._func = func
@@ -80,6 +82,7 @@ class _RPCDecorator(RPCBase):
 
     def __init__(self, *args, **kwargs):
         self._raises = kwargs.pop('raises', ())
+        self.idempotent = kwargs.pop('idempotent', False)
         super(_RPCDecorator, self).__init__(*args, **kwargs)
 
     @property
@@ -95,12 +98,23 @@ class _RPCDecorator(RPCBase):
             channel.reply(ret)
 
 
+class _StreamRPCDecorator(_RPCDecorator):
+
+    def rpc_call(self, interface, channel, *args, **kwargs):
+        try:
+            channel.stream(self._func(interface, *args, **kwargs))
+        except self._raises as ex:
+            channel.error(type=ex.__class__.__name__, message=str(ex))
+
+
 def raw_rpc():
     return _RawRPCDecorator
 
 
-def rpc(raises=()):
-    return functools.partial(_RPCDecorator, raises=raises)
+def rpc(raises=(), stream=False, idempotent=False):
+    if stream:
+        return functools.partial(_StreamRPCDecorator, raises=raises, idempotent=idempotent)
+    return functools.partial(_RPCDecorator, raises=raises, idempotent=idempotent)
 
 
 def event(*event_types, **kwargs):
@@ -1,12 +1,20 @@
+import collections
 import re
 import logging
 from uuid import uuid4
+
+import gevent
+
 from lymph.core.interfaces import Component
 from lymph.core import trace
 
 
 logger = logging.getLogger(__name__)
 
+# The words matched by `*` and `#` in event patterns.
+_WORD = re.compile(r'\w+$')
+_HASH_WORD = re.compile(r'\w*$')
+
 
 class Event(object):
     def __init__(self, evt_type, body, source=None, headers=None, event_id=None):
@@ -42,8 +50,10 @@ class Event(object):
 
 
 class EventHandler(Component):
-    def __init__(self, interface, func, event_types, sequential=False, queue_name=None, active=True, once=False, broadcast=False):
+    def __init__(self, interface, func, event_types, sequential=False, queue_name=None, active=True, once=False, broadcast=False, concurrency=None, prefetch=None, batch_size=None, batch_timeout=1):
         assert not (once and broadcast), "Once and broadcast cannot be enabled at the same time"
+        assert not (once and batch_size), "Once handlers cannot receive batches"
+        assert not (sequential and concurrency), "Sequential handlers cannot have a concurrency"
         super(EventHandler, self).__init__()
         self.func = func
         self.event_types = event_types
@@ -52,6 +62,17 @@ class EventHandler(Component):
         self.interface = interface
         self.once = once
         self.broadcast = broadcast
+        # The maximum number of events handled at the same time, and the
+        # number of unacknowledged events the broker may deliver.
+        self.concurrency = concurrency
+        if prefetch is None and concurrency:
+            prefetch = concurrency * (batch_size or 1)
+        self.prefetch = prefetch
+        # Batch handlers are called with a list of at most `batch_size`
+        # events, at the latest `batch_timeout` seconds after the first one
+        # was received.
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
         self.unique_key = str(uuid4()) if once or broadcast else None
         self._queue_name = queue_name or func.__name__
 
@@ -70,49 +91,197 @@ class EventHandler(Component):
         self.interface.container.subscribe(self, consume=self.active)
 
     def __call__(self, event, *args, **kwargs):
-        trace.set_id(event.headers.get('trace_id'))
-        logger.debug('<E %s', event)
+        if self.batch_size:
+            trace.set_id()
+            logger.debug('<E %s events', len(event))
+        else:
+            trace.set_id(event.headers.get('trace_id'))
+            logger.debug('<E %s', event)
         return self.func(self.interface, event, *args, **kwargs)
 
 
+class EventBatch(object):
+    """
+    Collects items and calls `flush` with lists of at most `size` items, at
+    the latest `timeout` seconds after the first item of a list was added.
+    """
+
+    def __init__(self, flush, size, timeout=None):
+        self.flush_func = flush
+        self.size = size
+        self.timeout = timeout
+        self.items = []
+        self._flush_greenlet = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.size:
+            self.flush()
+        elif self._flush_greenlet is None and self.timeout is not None:
+            self._flush_greenlet = gevent.spawn_later(self.timeout, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_greenlet = None
+        self.flush()
+
+    def clear(self):
+        """
+        Removes and returns all items without flushing them.
+        """
+        if self._flush_greenlet is not None:
+            self._flush_greenlet.kill()
+            self._flush_greenlet = None
+        items, self.items = self.items, []
+        return items
+
+    def flush(self):
+        items = self.clear()
+        if items:
+            self.flush_func(items)
+
+
+class _TopicNode(object):
+    __slots__ = ('words', 'star', 'hash', 'handlers')
+
+    def __init__(self):
+        self.words = {}
+        self.star = None
+        self.hash = None
+        self.handlers = []
+
+    def __bool__(self):
+        return bool(self.words or self.star or self.hash or self.handlers)
+
+    __nonzero__ = __bool__
+
+
 class EventDispatcher(object):
+    """
+    Maps event types to the handlers registered for matching patterns.
+    Patterns are dot separated words, ``*`` matches exactly one word, ``#``
+    matches one or more words (the empty string being one word). Patterns
+    are kept in a trie of their words, and the handlers for an event type
+    are cached in an LRU of `cache_size` event types.
+    """
+
     wildcards = {
         '#': r'[\w.]*(?=\.|$)',
         '*': r'\w+',
     }
 
-    def __init__(self, patterns=()):
+    def __init__(self, patterns=(), cache_size=1024):
+        self.root = _TopicNode()
         self.patterns = []
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self._seq = 0
         self.update(patterns)
 
     def compile(self, key):
         words = (self.wildcards.get(word, re.escape(word)) for word in key.split('.'))
         return re.compile('^%s$' % r'\.'.join(words))
 
+    def _get_node(self, pattern, create=False):
+        node, path = self.root, []
+        for word in pattern.split('.'):
+            if word == '*':
+                child = node.star
+                if child is None and create:
+                    child = node.star = _TopicNode()
+            elif word == '#':
+                child = node.hash
+                if child is None and create:
+                    child = node.hash = _TopicNode()
+            else:
+                child = node.words.get(word)
+                if child is None and create:
+                    child = node.words[word] = _TopicNode()
+            if child is None:
+                return None, path
+            path.append((node, word))
+            node = child
+        return node, path
+
     def register(self, pattern, handler):
-        self.patterns.append((
-            self.compile(pattern),
-            pattern,
-            handler,
-        ))
+        node, path = self._get_node(pattern, create=True)
+        node.handlers.append((self._seq, pattern, handler))
+        self._seq += 1
+        self.patterns.append((pattern, handler))
+        self.cache.clear()
+
+    def unregister(self, handler, pattern=None):
+        """
+        Removes `handler` for `pattern`, or for all patterns.
+        """
+        patterns = set(p for p, h in self.patterns if h == handler and pattern in (None, p))
+        if not patterns:
+            raise KeyError('%r is not registered' % handler)
+        self.patterns = [(p, h) for p, h in self.patterns if not (h == handler and p in patterns)]
+        for p in patterns:
+            node, path = self._get_node(p)
+            node.handlers = [entry for entry in node.handlers if entry[2] != handler]
+            # Prune nodes that no longer lead to handlers.
+            for parent, word in reversed(path):
+                if node:
+                    break
+                if word == '*':
+                    parent.star = None
+                elif word == '#':
+                    parent.hash = None
+                else:
+                    del parent.words[word]
+                node = parent
+        self.cache.clear()
 
     def __iter__(self):
-        for regex, pattern, handler in self.patterns:
-            yield pattern, handler
+        return iter(self.patterns)
 
     def update(self, other):
         for pattern, handler in other:
             self.register(pattern, handler)
 
+    def _match(self, node, words, i, matches):
+        if i == len(words):
+            matches.extend(node.handlers)
+            return
+        word = words[i]
+        child = node.words.get(word)
+        if child is not None:
+            self._match(child, words, i + 1, matches)
+        if node.star is not None and _WORD.match(word):
+            self._match(node.star, words, i + 1, matches)
+        if node.hash is not None:
+            for j in range(i, len(words)):
+                if not _HASH_WORD.match(words[j]):
+                    break
+                self._match(node.hash, words, j + 1, matches)
+
+    def _lookup(self, evt_type):
+        try:
+            result = self.cache.pop(evt_type)
+        except KeyError:
+            entries = []
+            self._match(self.root, evt_type.split('.'), 0, entries)
+            # Patterns with several `#` can match in more than one way.
+            matches, handlers = [], []
+            for seq, pattern, handler in sorted(set(entries), key=lambda entry: entry[0]):
+                matches.append((pattern, handler))
+                if handler not in handlers:
+                    handlers.append(handler)
+            result = (matches, handlers)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[evt_type] = result
+        return result
+
     def dispatch(self, evt_type):
-        for regex, pattern, handler in self.patterns:
-            if regex.match(evt_type):
-                yield pattern, handler
+        return iter(self._lookup(evt_type)[0])
 
     def __call__(self, event):
-        handlers = set()
-        for pattern, handler in self.dispatch(event.evt_type):
-            if handler not in handlers:
-                handlers.add(handler)
-                handler(event)
+        handlers = self._lookup(event.evt_type)[1]
+        for handler in handlers:
+            handler(event)
         return bool(handlers)
@@ -0,0 +1,81 @@
+from lymph.core.monitoring import metrics
+from lymph.utils import Histogram
+
+
+class HedgePolicy(object):
+    """
+    Decides when a request is hedged, i.e. when a duplicate is sent to
+    another instance. A request is hedged once it has waited longer than the
+    `percentile` of the recent reply latencies of its subject.
+
+    Each request adds `max_rate` to a budget of at most `burst` hedges, so
+    only about `max_rate` of all requests are hedged under sustained load.
+
+    Only requests for `subjects`, and for methods a proxy learned to be
+    idempotent from `lymph.inspect`, are hedged.
+    """
+
+    def __init__(self, percentile=95, max_rate=0.05, burst=10, min_samples=20, update_interval=10, tags=None, subjects=()):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self.update_interval = update_interval
+        self.budget = burst
+        self.histograms = {}
+        self.delays = {}
+        self.disabled = set()
+        self.subjects = set(subjects)
+        self.hedge_counts = metrics.TaggedCounter('hedges', tags)
+
+    def get_delay(self, subject):
+        """
+        Returns how long to wait for a reply to a request for `subject` before
+        it is hedged, or None if it shouldn't be hedged.
+        """
+        self.budget = min(self.burst, self.budget + self.max_rate)
+        if subject not in self.subjects:
+            return None
+        return self.delays.get(subject)
+
+    def learn(self, methods):
+        """
+        Allows hedging the idempotent ones of `methods`, as described by
+        `lymph.inspect`.
+        """
+        for method in methods:
+            if method.get('idempotent'):
+                self.subjects.add(method['name'])
+
+    def acquire(self):
+        """
+        Returns whether another hedge may be sent.
+        """
+        if self.budget < 1:
+            self.hedge_counts.incr(result='throttled')
+            return False
+        self.budget -= 1
+        self.hedge_counts.incr(result='sent')
+        return True
+
+    def record(self, subject, latency, hedge_won=False):
+        if hedge_won:
+            self.hedge_counts.incr(result='won')
+        try:
+            histogram = self.histograms[subject]
+        except KeyError:
+            histogram = self.histograms[subject] = Histogram(decay=1000)
+        histogram.add(latency)
+        if subject in self.disabled:
+            return
+        if len(histogram) >= self.min_samples and not len(histogram) % self.update_interval:
+            self.delays[subject] = histogram.percentile(self.percentile)
+
+    def disable(self, subject):
+        """
+        Stops hedging requests for `subject`, e.g. because the receiving
+        method isn't idempotent.
+        """
+        self.hedge_counts.incr(result='rejected')
+        self.disabled.add(subject)
+        self.delays.pop(subject, None)
@@ -1,20 +1,36 @@
+import collections
+import contextlib
+import logging
 import textwrap
+import time
 import functools
 
 import six
 
+from lymph.core.channels import MultiCallChannel, RequestBatch, MULTI_CALL_MAX_SIZE
 from lymph.core.decorators import rpc, RPCBase
+from lymph.core.hedging import HedgePolicy
+from lymph.core.messages import Message
 from lymph.exceptions import RemoteError, EventHandlerTimeout, Timeout, Nack
 from lymph.core.components import Component, Componentized, ComponentizedBase
 from lymph.core.monitoring import metrics
+from lymph.core import trace
 
 import gevent
 from gevent.event import AsyncResult
 
 
+logger = logging.getLogger(__name__)
+
 REQUEST_TIMEOUT = 3  # seconds.
 
 
+def _time_left(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
 class AsyncResultWrapper(object):
     def __init__(self, container, handler, async_result):
         self.container = container
@@ -44,8 +60,10 @@ class InterfaceBase(ComponentizedBase):
 
 
 class ProxyMethod(object):
-    def __init__(self, func):
+    def __init__(self, func, proxy=None, subject=None):
         self.func = func
+        self.proxy = proxy
+        self.subject = subject
 
     def __call__(self, *args, **kwargs):
         return self.func(*args, **kwargs)
@@ -55,9 +73,126 @@ class ProxyMethod(object):
         gevent.spawn(self, *args, **kwargs).link(result)
         return result
 
+    def stream(self, **kwargs):
+        """
+        Calls a method decorated with `@rpc(stream=True)` and returns an
+        iterator over the chunks it yields.
+        """
+        return self.proxy._stream(self.subject, **kwargs)
+
+    def map(self, iterable, multi=False, return_exceptions=False):
+        """
+        Calls the method once for each dict of keyword arguments in
+        `iterable` and returns the results in order, see `Proxy.batch()`.
+        """
+        batch = self.proxy.batch(multi=multi)
+        for kwargs in iterable:
+            batch.call(self.subject, **kwargs)
+        return batch.get(return_exceptions=return_exceptions)
+
+
+class BatchProxy(object):
+    """
+    Adds a call of the remote method of the same name to `batch`.
+    """
+
+    def __init__(self, batch, namespace):
+        self._batch = batch
+        self._namespace = namespace
+
+    def __getattr__(self, name):
+        return functools.partial(self._batch.call, '%s.%s' % (self._namespace, name))
+
+
+class ProxyBatch(object):
+    """
+    Sends requests without waiting for the previous replies and collects all
+    replies with a single waiter. With `multi=True` calls of the same method
+    are sent as a single request when the batch is completed.
+
+    Calls are added with `batch.proxy.method(**kwargs)`, or with
+    `batch.call(subject, **kwargs)`.
+    """
+
+    def __init__(self, proxy, multi=False):
+        self._proxy = proxy
+        self.proxy = BatchProxy(self, proxy._namespace)
+        self.multi = multi
+        self.calls = []
+        self.requests = RequestBatch(proxy._container.server)
+        self.results = None
+        self.deadline = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self._wait()
+        else:
+            self.requests.close()
+
+    def call(self, __subject, **kwargs):
+        if self.results is not None:
+            raise RuntimeError('batch is already completed')
+        self.calls.append((__subject, kwargs))
+        if not self.multi:
+            self._send(__subject, kwargs)
+
+    def _send(self, subject, body, headers=None):
+        if not self.requests:
+            self.deadline = trace.get_deadline(self._proxy._timeout)
+        self._proxy._container.send_request(self._proxy._address, subject, body, headers=headers, batch=self.requests, deadline=self.deadline)
+
+    def _wait(self):
+        if self.results is not None:
+            return
+        if not self.multi:
+            self.results = [self._get_result(reply) for reply in self.requests.get(timeout=_time_left(self.deadline))]
+            return
+        subjects = collections.OrderedDict()
+        for i, (subject, kwargs) in enumerate(self.calls):
+            subjects.setdefault(subject, []).append(i)
+        groups = []
+        for subject, indexes in subjects.items():
+            for start in range(0, len(indexes), MULTI_CALL_MAX_SIZE):
+                groups.append(indexes[start:start + MULTI_CALL_MAX_SIZE])
+                self._send(subject, {'calls': [self.calls[i][1] for i in groups[-1]]}, headers={'multi': True})
+        self.results = [None] * len(self.calls)
+        replies = self.requests.get(timeout=_time_left(self.deadline))
+        for request, reply, indexes in zip(self.requests.requests, replies, groups):
+            if isinstance(reply, Exception):
+                results = [self._get_result(reply)] * len(indexes)
+            else:
+                results = [self._get_result(Message(msg_type, request.id, body=body, lazy=True), request) for msg_type, body in reply.body]
+            for i, result in zip(indexes, results):
+                self.results[i] = result
+
+    def _get_result(self, reply, request=None):
+        if isinstance(reply, Exception):
+            return self._proxy._get_error(reply)
+        if reply.type == Message.NACK:
+            return self._proxy._get_error(Nack(request))
+        elif reply.type == Message.ERROR:
+            return self._proxy._get_error(RemoteError.from_reply(request, reply))
+        return reply.body
+
+    def get(self, return_exceptions=False):
+        """
+        Returns the results of all calls in order. Failed calls raise their
+        exception, unless `return_exceptions` is true, in which case the
+        exception is returned in place of the result.
+        """
+        self._wait()
+        if not return_exceptions:
+            for result in self.results:
+                if isinstance(result, Exception):
+                    raise result
+        return self.results
+
 
 class Proxy(Component):
-    def __init__(self, container, address, timeout=REQUEST_TIMEOUT, namespace='', error_map=None):
+    def __init__(self, container, address, timeout=REQUEST_TIMEOUT, namespace='', error_map=None, hedge=None):
         super(Proxy, self).__init__()
         self._container = container
         self._address = address
@@ -65,38 +200,95 @@ class Proxy(Component):
         self._timeout = timeout
         self._namespace = namespace or address
         self._error_map = error_map or {}
+        if hedge is True:
+            hedge = HedgePolicy(tags={'address': address})
+        self._hedge = hedge or None
+        self._hedge_inspected = False
 
         self.timeout_counts = metrics.Counter('timeout', {'address': address})
         self.exception_counts = metrics.TaggedCounter('exceptions', {'address': address})
 
     def _call(self, __name, **kwargs):
-        channel = self._container.send_request(self._address, __name, kwargs)
+        # Nested calls don't wait longer than the call that is being handled.
+        deadline = trace.get_deadline(self._timeout)
+        if self._hedge is not None and not self._hedge_inspected:
+            self._hedge_inspected = True
+            self._container.spawn(self._inspect_hedged_methods)
+        channel = self._container.send_request(self._address, __name, kwargs, hedge=self._hedge, deadline=deadline)
+        with self._handle_errors():
+            return channel.get(timeout=_time_left(deadline)).body
+
+    def _inspect_hedged_methods(self):
+        # Requests are only hedged for methods the service declares idempotent.
+        try:
+            reply = self._container.send_request(self._address, 'lymph.inspect', {}).get(timeout=self._timeout)
+        except (Timeout, Nack, RemoteError) as e:
+            logger.warning('cannot inspect %s for hedging: %r', self._address, e)
+            self._hedge_inspected = False
+            return
+        self._hedge.learn(reply.body['methods'])
+
+    def _stream(self, __name, **kwargs):
+        channel = self._container.send_request(self._address, __name, kwargs, stream=True)
+        return self._iter_stream(channel)
+
+    def _iter_stream(self, channel):
+        try:
+            with self._handle_errors():
+                for msg in channel.iter(timeout=self._timeout):
+                    yield msg.body
+        finally:
+            # Cancels the stream if the caller stops early.
+            channel.close()
+
+    @contextlib.contextmanager
+    def _handle_errors(self):
         try:
-            return channel.get(timeout=self._timeout).body
-        except RemoteError as e:
+            yield
+        except (RemoteError, Timeout, Nack) as e:
+            error = self._get_error(e)
+            if error is e:
+                raise
+            raise error
+
+    def _get_error(self, e):
+        # Records the error and returns the exception the caller should see.
+        if isinstance(e, RemoteError):
             error_type = str(e.__class__)
             self.exception_counts.incr(name=e.__class__.__name__)
             if error_type in self._error_map:
-                raise self._error_map[error_type]()
-            raise
-        except Timeout:
+                return self._error_map[error_type]()
+        elif isinstance(e, Timeout):
             self.timeout_counts += 1
-            raise
-        except Nack:
+        elif isinstance(e, Nack):
             self.exception_counts.incr(name='nack')
-            raise
+        return e
+
+    def batch(self, multi=False):
+        """
+        Returns a `ProxyBatch` to send several requests at once::
+
+            with proxy.batch() as batch:
+                for user_id in user_ids:
+                    batch.proxy.get_user(id=user_id)
+            users = batch.get()
+        """
+        return ProxyBatch(self, multi=multi)
 
     def __getattr__(self, name):
         try:
             return self._method_cache[name]
         except KeyError:
-            method = ProxyMethod(functools.partial(self._call, '%s.%s' % (self._namespace, name)))
+            subject = '%s.%s' % (self._namespace, name)
+            method = ProxyMethod(functools.partial(self._call, subject), proxy=self, subject=subject)
             self._method_cache[name] = method
             return method
 
     def _get_metrics(self):
         yield self.timeout_counts
         yield self.exception_counts
+        if self._hedge is not None:
+            yield self._hedge.hedge_counts
 
 
 @six.add_metaclass(InterfaceBase)
@@ -115,11 +307,62 @@ class Interface(Componentized):
         return {}
 
     def handle_request(self, func_name, channel):
-        self.methods[func_name].rpc_call(self, channel, **channel.request.body)
+        self.get_request_handler(func_name)(channel)
+
+    def get_request_handler(self, func_name):
+        """
+        Returns a callable that handles requests for `func_name` given their
+        channel, like `handle_request()`.
+        """
+        method = self.methods[func_name]
+        rpc_call = functools.partial(method.rpc_call, self)
+
+        def handle_request(channel):
+            headers = channel.request.headers
+            if headers.get('hedge') and not method.idempotent:
+                # Only idempotent methods may run twice for the same call.
+                logger.debug('rejected hedged request for %s', channel.request.subject)
+                channel.nack()
+                return
+            if headers.get('multi'):
+                self.handle_multi_call(rpc_call, channel)
+                return
+            rpc_call(channel, **channel.request.body)
+        return handle_request
+
+    def handle_multi_call(self, rpc_call, channel):
+        """
+        Calls `rpc_call` for each dict of keyword arguments in the `calls` of
+        a multi-call request, at most `server.get_multi_call_concurrency()` at
+        a time, and replies with a list of `[type, body]` pairs. Requests
+        with more than `MULTI_CALL_MAX_SIZE` calls are NACKed.
+        """
+        calls = channel.request.body['calls']
+        if len(calls) > MULTI_CALL_MAX_SIZE:
+            logger.warning('rejected multi-call request with %s calls', len(calls))
+            channel.nack()
+            return
+        sub_channels = [MultiCallChannel(channel.request, channel.server) for kwargs in calls]
+        pending = iter(list(zip(sub_channels, calls)))
+        deadline = trace.get_deadline()
+
+        def run_calls():
+            trace.set_deadline(deadline)
+            for sub_channel, kwargs in pending:
+                try:
+                    rpc_call(sub_channel, **kwargs)
+                except Exception:
+                    logger.exception('Request error:')
+                sub_channel.nack(True)
+
+        concurrency = min(len(calls), channel.server.get_multi_call_concurrency())
+        gevent.joinall([self.spawn(run_calls) for i in range(concurrency)])
+        channel.reply([sub_channel.result for sub_channel in sub_channels])
 
     def request(self, address, subject, body, timeout=REQUEST_TIMEOUT):
-        channel = self.container.send_request(address, subject, body)
-        return channel.get(timeout=timeout)
+        deadline = trace.get_deadline(timeout)
+        channel = self.container.send_request(address, subject, body, deadline=deadline)
+        return channel.get(timeout=_time_left(deadline))
 
     def emit(self, event_type, payload, delay=0):
         self.container.emit_event(event_type, payload, delay=delay)
@@ -149,18 +392,19 @@ class Interface(Componentized):
 class DefaultInterface(Interface):
     register_with_coordinator = False
 
-    @rpc()
+    @rpc(idempotent=True)
     def ping(self, payload=None):
         return payload
 
-    @rpc()
+    @rpc(idempotent=True)
     def status(self):
         return {
             'endpoint': self.container.endpoint,
             'identity': self.container.identity,
+            'circuit_breakers': self.container.server.breakers.get_status(),
         }
 
-    @rpc()
+    @rpc(idempotent=True)
     def inspect(self):
         """
         Returns a description of all available rpc methods of this service
@@ -172,11 +416,12 @@ class DefaultInterface(Interface):
                     'name': '%s.%s' % (interface_name, name),
                     'params': list(func.args.args),
                     'help': textwrap.dedent(func.__doc__ or '').strip(),
+                    'idempotent': func.idempotent,
                 })
         return {
             'methods': methods,
         }
 
-    @rpc()
+    @rpc(idempotent=True)
     def get_metrics(self):
         return list(self.container.metrics_aggregator.get_metrics())
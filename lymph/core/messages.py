@@ -1,19 +1,107 @@
+import binascii
+import random
+import struct
+
+import six
+
 from lymph.serializers import msgpack_serializer
 from lymph.utils import make_id
 
 
+CLASSIC = 'classic'
+COMPACT = 'compact'
+WIRE_FORMATS = (CLASSIC, COMPACT)
+
+COMPACT_VERSION = 1
+# version, type, binary message id, subject id, subject length (or subject
+# table epoch), headers length
+_compact_header = struct.Struct('!BB16sHII')
+
+# Values of the subject id field of compact messages. Ids in between refer to
+# the receiver's `SubjectTable`.
+SUBJECT_INLINE = 0
+SUBJECT_MAX_ID = 0xfffe
+SUBJECT_MSG_ID = 0xffff
+
+
+def _frame_bytes(frame):
+    # Frames received with `copy=False` are `zmq.Frame` objects.
+    return getattr(frame, 'bytes', frame)
+
+
+if six.PY2:
+    def _buffer(data, start=0, end=None):
+        # msgpack < 0.5 only supports the old buffer interface on python 2.
+        if end is None:
+            return buffer(data, start)  # NOQA
+        return buffer(data, start, end - start)  # NOQA
+else:
+    def _buffer(data, start=0, end=None):
+        return memoryview(data)[start:end]
+
+
+_undecoded = object()
+
+
+class SubjectTable(object):
+    """
+    Assigns ids to the request subjects a server handles. Peers learn these
+    ids from replies and send them in compact messages instead of the subject.
+
+    Ids are only valid together with the table's random `epoch`, messages
+    that refer to the table of another process can be told apart.
+    """
+
+    def __init__(self, epoch=None):
+        # Wide enough that a restarted process practically never reuses it.
+        self.epoch = epoch or random.randint(1, 0xffffffff)
+        self.ids = {}
+        self.subjects = [None]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, subject):
+        try:
+            return self.ids[subject]
+        except KeyError:
+            pass
+        subject_id = len(self.subjects)
+        if subject_id > SUBJECT_MAX_ID:
+            raise ValueError('too many subjects')
+        self.subjects.append(subject)
+        self.ids[subject] = subject_id
+        return subject_id
+
+    def get(self, subject_id, epoch):
+        if epoch != self.epoch:
+            return None
+        try:
+            return self.subjects[subject_id]
+        except IndexError:
+            return None
+
+
 class Message(object):
+    __slots__ = ('id', 'type', 'subject', 'subject_id', 'source', 'serializer', '_headers', '_packed_headers', '_body', '_packed_body')
+
     ACK = b'ACK'
     REP = b'REP'
     REQ = b'REQ'
     NACK = b'NACK'
     ERROR = b'ERROR'
 
-    def __init__(self, msg_type, subject, packed_body=None, headers=None, packed_headers=None, msg_id=None, source=None, lazy=False, **kwargs):
+    _type_codes = {REQ: 1, REP: 2, ACK: 3, NACK: 4, ERROR: 5}
+    _types = {code: msg_type for msg_type, code in _type_codes.items()}
+
+    def __init__(self, msg_type, subject, packed_body=None, headers=None, packed_headers=None, msg_id=None, source=None, lazy=False, serializer=None, **kwargs):
         self.id = msg_id if msg_id else make_id()
         self.type = msg_type
         self.subject = subject
+        self.subject_id = SUBJECT_INLINE
         self.source = source
+        # Packs the body, headers always use the default msgpack serializer.
+        self.serializer = serializer or msgpack_serializer
 
         if headers and packed_headers:
             raise TypeError("Message takes either 'headers' or 'packed_headers' not both")
@@ -28,6 +116,8 @@ class Message(object):
             self._body = kwargs['body']
         elif packed_body is None:
             raise TypeError("Message requires either 'body' or 'packed_body'")
+        else:
+            self._body = _undecoded
 
         self._packed_body = packed_body
         if not lazy:
@@ -47,14 +137,14 @@ class Message(object):
 
     @property
     def body(self):
-        if not hasattr(self, '_body'):
-            self._body = msgpack_serializer.loads(self._packed_body)
+        if self._body is _undecoded:
+            self._body = self.serializer.loads(self._packed_body)
         return self._body
 
     @property
     def packed_body(self):
         if self._packed_body is None:
-            self._packed_body = msgpack_serializer.dumps(self._body)
+            self._packed_body = self.serializer.dumps(self._body)
         return self._packed_body
 
     @property
@@ -69,21 +159,129 @@ class Message(object):
             self._packed_headers = msgpack_serializer.dumps(self._headers)
         return self._packed_headers
 
-    def pack_frames(self):
+    def pack_frames(self, headers=None):
+        """
+        Returns the frames of this message in the classic wire format. If
+        `headers` are given, they are sent instead of this message's headers.
+        """
         return [
             self.id.encode('utf-8'),
             self.type,
             self.subject.encode('utf-8'),
-            self.packed_headers,
+            self.packed_headers if headers is None else msgpack_serializer.dumps(headers),
             self.packed_body,
         ]
 
+    def pack_compact(self, interned=None):
+        """
+        Returns this message in the compact wire format: a single frame with a
+        fixed size header followed by the subject, headers, and body sections.
+        Raises ValueError if the message cannot be represented in this format.
+
+        `interned` is a `(subject_id, epoch)` tuple from the receiver's
+        `SubjectTable`, it replaces the subject. The epoch is sent in place of
+        the subject length.
+        """
+        try:
+            msg_id = binascii.unhexlify(self.id)
+        except (TypeError, binascii.Error):
+            raise ValueError('message id is not a hex encoded uuid: %r' % self.id)
+        if len(msg_id) != 16:
+            raise ValueError('message id is not a hex encoded uuid: %r' % self.id)
+        subject_id = SUBJECT_INLINE
+        subject = self.subject.encode('utf-8')
+        subject_len = len(subject)
+        if interned:
+            subject_id, subject_len = interned
+            subject = b''
+        elif self.is_reply() and len(subject) == 32:
+            try:
+                subject = binascii.unhexlify(subject)
+            except (TypeError, binascii.Error):
+                pass
+            else:
+                subject_id = SUBJECT_MSG_ID
+                subject_len = len(subject)
+        packed_headers = self.packed_headers
+        header = _compact_header.pack(
+            COMPACT_VERSION,
+            self._type_codes[self.type],
+            msg_id,
+            subject_id,
+            subject_len,
+            len(packed_headers),
+        )
+        return b''.join((header, subject, bytes(packed_headers), bytes(self.packed_body)))
+
+    @classmethod
+    def unpack_compact(cls, source, payload, subjects=None):
+        """
+        Creates a message from a compact `payload`. Interned subject ids are
+        resolved with the `subjects` table, the subject of messages with
+        unknown ids is None.
+        """
+        try:
+            version, type_code, msg_id, subject_id, subject_len, headers_len = _compact_header.unpack_from(payload)
+        except struct.error as e:
+            raise ValueError('bad compact message header: %s' % e)
+        if version != COMPACT_VERSION:
+            raise ValueError('unsupported compact message version: %s' % version)
+        try:
+            msg_type = cls._types[type_code]
+        except KeyError:
+            raise ValueError('unknown compact message type: %s' % type_code)
+        offset = _compact_header.size
+        interned = SUBJECT_INLINE < subject_id <= SUBJECT_MAX_ID
+        if interned:
+            subject = subjects.get(subject_id, subject_len) if subjects is not None else None
+        else:
+            subject = bytes(_buffer(payload, offset, offset + subject_len))
+            if len(subject) != subject_len:
+                raise ValueError('truncated compact message')
+            offset += subject_len
+            if subject_id == SUBJECT_MSG_ID:
+                subject = binascii.hexlify(subject)
+            subject = subject.decode('utf-8')
+        if offset + headers_len > len(payload):
+            raise ValueError('truncated compact message')
+        headers = _buffer(payload, offset, offset + headers_len)
+        body = _buffer(payload, offset + headers_len)
+        msg = Message(
+            msg_type=msg_type,
+            subject=subject,
+            msg_id=binascii.hexlify(msg_id).decode('ascii'),
+            source=source.decode('utf-8'),
+            packed_body=body,
+            packed_headers=headers,
+            lazy=True,
+        )
+        if interned:
+            msg.subject_id = subject_id
+        return msg
+
     @classmethod
-    def unpack_frames(self, frames):
+    def unpack_frames(self, frames, copy=True, subjects=None):
+        """
+        Creates a message from received `frames`. With `copy=False` the frames
+        are expected to be `zmq.Frame` objects and headers and body are decoded
+        from buffers that share the frames' memory.
+
+        Headers and body are only decoded when they are accessed.
+
+        Messages in the compact wire format consist of two frames, classic
+        messages of six. Compact messages may refer to the `subjects` table.
+        """
+        if len(frames) == 2:
+            source, payload = frames
+            return self.unpack_compact(_frame_bytes(source), payload, subjects=subjects)
         try:
             source, msg_id, msg_type, subject, headers, body = frames
         except ValueError:
-            raise ValueError('bad message frame count: got %s, expected 6' % len(frames))
+            raise ValueError('bad message frame count: got %s, expected 6 or 2' % len(frames))
+
+        if not copy:
+            source, msg_id, msg_type, subject = map(_frame_bytes, (source, msg_id, msg_type, subject))
+            headers, body = _buffer(headers), _buffer(body)
 
         try:
             msg_id = msg_id.decode('utf-8')
@@ -99,6 +297,7 @@ class Message(object):
             source=source,
             packed_body=body,
             packed_headers=headers,
+            lazy=True,
         )
 
     def __str__(self):
@@ -1,41 +1,93 @@
 import errno
 import hashlib
 import logging
+import os
 import random
+import tempfile
 import time
 
 import gevent
 import zmq.green as zmq
 
-from lymph.core.channels import RequestChannel, ReplyChannel
+from lymph.core.admission import AdmissionController
+from lymph.core.balancing import get_balancer_class
+from lymph.core.circuitbreaker import CircuitBreakers
+from lymph.core.channels import RequestChannel, ReplyChannel, StreamChannel, HedgedRequestChannel, ChannelTimeouts, ForwardChannel
+from lymph.core.channels import get_stream_subject, STREAM_WINDOW, STALE_CHANNEL_TIMEOUT
 from lymph.core.components import Component
-from lymph.core.connection import Connection
-from lymph.core.messages import Message
+from lymph.core.connection import Connection, HeartbeatScheduler
+from lymph.core.messages import Message, SubjectTable, CLASSIC, COMPACT, WIRE_FORMATS
 from lymph.core.monitoring import metrics
+from lymph.core.sendqueue import SendQueue
 from lymph.core.services import Service
 from lymph.core import services
 from lymph.core import trace
 from lymph.exceptions import NotConnected
+from lymph.serializers import msgpack_serializer, msgpack_ext_serializer
+from lymph.utils.gpool import RejectExcecutionError
 
 
 logger = logging.getLogger(__name__)
 
+# Larger messages are sent in the classic format to avoid copying their body
+# into a single frame.
+COMPACT_MAX_BODY_SIZE = 64 * 1024
+
+# Peers are connected to via the cheapest transport that reaches them.
+TRANSPORT_COSTS = {'inproc': 0, 'ipc': 1, 'tcp': 2}
+
+# The inproc endpoints bound in this process.
+_inproc_endpoints = set()
+
 
 class ZmqRPCServer(Component):
-    def __init__(self, ip='127.0.0.1', port=None, pool=None):
+    def __init__(self, ip='127.0.0.1', port=None, pool=None, send_queue=False, send_queue_max_size=100, send_queue_max_delay=0, connect_timeout=1, zero_copy=False, wire_format=CLASSIC, balancer='random', admission=False, admission_max_queue_size=1000, admission_target_delay=.1, circuit_breaker_failures=5, circuit_breaker_reset_timeout=2, transports=('tcp',), ipc_dir=None, ext_types=False, multi_call_concurrency=10):
         super(ZmqRPCServer, self).__init__(pool=pool)
         self.ip = ip
         self.port = port
+        self.connect_timeout = connect_timeout
+        self.zero_copy = zero_copy
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError('unknown wire format: %r' % wire_format)
+        self.wire_format = wire_format
+        # Packs the bodies of messages sent by this server.
+        self.serializer = msgpack_ext_serializer if ext_types else msgpack_serializer
+        for transport in transports:
+            if transport not in TRANSPORT_COSTS:
+                raise ValueError('unknown transport: %r' % transport)
+        if 'tcp' not in transports:
+            raise ValueError('transports must include tcp')
+        self.transports = transports
+        self.ipc_dir = ipc_dir or tempfile.gettempdir()
 
         self.zctx = zmq.Context.instance()
         self.endpoint = None
+        self.endpoints = []
+        self.routes = {}
         self.bound = False
         self.request_counts = metrics.TaggedCounter('rpc')
+        self.expired_request_counts = metrics.TaggedCounter('rpc.expired')
+        self.shed_request_counts = metrics.TaggedCounter('rpc.shed')
         self.recv_loop_greenlet = None
         self.channels = {}
+        self.timeouts = ChannelTimeouts(self)
+        self.subjects = SubjectTable()
         self.connections = {}
+        self.heartbeat = HeartbeatScheduler(self)
+        self.breakers = CircuitBreakers(failure_threshold=circuit_breaker_failures, reset_timeout=circuit_breaker_reset_timeout)
+        self.balancer = get_balancer_class(balancer)(self)
+        self.pending = {}
         self.running = False
         self.request_handler = lambda channel: None
+        # Set by a `WorkerFront` to forward requests to worker processes.
+        self.workers = None
+        self.multi_call_concurrency = multi_call_concurrency
+        self.admission = None
+        if admission:
+            self.admission = AdmissionController(self, max_queue_size=admission_max_queue_size, target_delay=admission_target_delay)
+        self.send_queue = None
+        if send_queue:
+            self.send_queue = SendQueue(self._send_messages, max_size=send_queue_max_size, max_delay=send_queue_max_delay)
 
     @classmethod
     def from_config(cls, config, **kwargs):
@@ -47,6 +99,22 @@ class ZmqRPCServer(Component):
             ip=config.get('ip', kwargs.get('ip') or '127.0.0.1'),
             port=config.get('port', kwargs.get('port')),
             pool=pool,
+            send_queue=config.get('send_queue', False),
+            send_queue_max_size=config.get('send_queue_max_size', 100),
+            send_queue_max_delay=config.get('send_queue_max_delay', 0),
+            connect_timeout=config.get('connect_timeout', 1),
+            zero_copy=config.get('zero_copy', False),
+            wire_format=config.get('wire_format', CLASSIC),
+            balancer=config.get('balancer', 'random'),
+            admission=config.get('admission', False),
+            admission_max_queue_size=config.get('admission_max_queue_size', 1000),
+            admission_target_delay=config.get('admission_target_delay', .1),
+            circuit_breaker_failures=config.get('circuit_breaker_failures', 5),
+            circuit_breaker_reset_timeout=config.get('circuit_breaker_reset_timeout', 2),
+            transports=config.get('transports', ('tcp',)),
+            ipc_dir=config.get('ipc_dir'),
+            ext_types=config.get('ext_types', False),
+            multi_call_concurrency=config.get('multi_call_concurrency', 10),
         )
 
     @property
@@ -58,6 +126,9 @@ class ZmqRPCServer(Component):
         assert not self.bound, 'already bound (endpoint=%s)' % self.endpoint
         self.send_sock = self.zctx.socket(zmq.ROUTER)
         self.recv_sock = self.zctx.socket(zmq.ROUTER)
+        # Fail with EHOSTUNREACH instead of silently dropping messages to
+        # peers that are not routable (yet), see `_send_messages()`.
+        self.send_sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
         port = self.port
         retries = 0
         while True:
@@ -81,13 +152,56 @@ class ZmqRPCServer(Component):
                 self.port = port
                 self.bound = True
                 break
+        self.endpoints = [self.endpoint]
+        # The tcp endpoint identifies this server on all transports.
+        if 'ipc' in self.transports:
+            self._bind_local('ipc://%s' % os.path.join(self.ipc_dir, 'lymph-%s.sock' % self.identity))
+        if 'inproc' in self.transports:
+            self._bind_local('inproc://lymph-%s' % self.identity)
+            _inproc_endpoints.add(self.endpoints[-1])
+
+    def _bind_local(self, endpoint):
+        try:
+            self.recv_sock.bind(endpoint)
+        except zmq.ZMQError as e:
+            logger.warning('failed to bind %s (errno=%s)', endpoint, e.errno)
+        else:
+            self.endpoints.append(endpoint)
+
+    def is_reachable(self, endpoint):
+        transport, address = endpoint.split('://', 1)
+        if transport not in self.transports:
+            return False
+        if transport == 'inproc':
+            return endpoint in _inproc_endpoints
+        if transport == 'ipc':
+            return os.path.exists(address)
+        return True
+
+    def add_route(self, endpoint, endpoints):
+        """
+        Connects to the server at `endpoint` via the cheapest of its
+        `endpoints` that is reachable from here, once it is connected.
+        """
+        endpoints = [e for e in endpoints if e != endpoint and self.is_reachable(e)]
+        if endpoints:
+            self.routes[endpoint] = min(endpoints, key=lambda e: TRANSPORT_COSTS[e.split('://', 1)[0]])
+
+    def get_multi_call_concurrency(self):
+        """
+        Returns how many calls of a multi-call request may run at the same
+        time: with admission control, the free slots of the concurrency limit
+        plus the one of the request itself.
+        """
+        if self.admission is not None:
+            return max(1, int(self.admission.limit) - self.admission.running + 1)
+        return self.multi_call_concurrency
 
     def connect(self, endpoint):
         if endpoint not in self.connections:
             logger.debug("connecting to %s", endpoint)
             self.connections[endpoint] = Connection(self, endpoint)
-            self.send_sock.connect(endpoint)
-            gevent.sleep(0.02)
+            self.send_sock.connect(self.routes.get(endpoint, endpoint))
         return self.connections[endpoint]
 
     def disconnect(self, endpoint, socket=False):
@@ -99,15 +213,21 @@ class ZmqRPCServer(Component):
         connection.close()
         logger.debug("disconnecting from %s", endpoint)
         if socket:
-            self.send_sock.disconnect(endpoint)
+            self.send_sock.disconnect(self.routes.get(endpoint, endpoint))
 
     def on_start(self):
         self._bind()
         self.running = True
         self.recv_loop_greenlet = self.spawn(self._recv_loop)
+        self.heartbeat.start()
+        self.timeouts.start()
 
     def on_stop(self, **kwargs):
+        if self.send_queue is not None:
+            self.send_queue.close()
         self.running = False
+        self.heartbeat.stop()
+        self.timeouts.stop()
         for connection in list(self.connections.values()):
             connection.close()
         if self.recv_loop_greenlet:
@@ -117,73 +237,255 @@ class ZmqRPCServer(Component):
     def _close_sockets(self):
         self.recv_sock.close()
         self.send_sock.close()
+        for endpoint in self.endpoints:
+            transport, address = endpoint.split('://', 1)
+            if transport == 'ipc' and os.path.exists(address):
+                os.unlink(address)
+            _inproc_endpoints.discard(endpoint)
 
     def _on_service_instance_unavailable(self, instance, action=None):
         self.disconnect(instance.endpoint)
+        self.breakers.remove(instance.endpoint)
+        self.routes.pop(instance.endpoint, None)
 
     def _send_message(self, endpoint, msg):
         if not self.running:
             # FIXME: This should raise an Error instead of failing silently.
             logger.error('cannot send message (not started): %s', msg)
             return
+        if self.send_queue is not None:
+            self.send_queue.put(endpoint, msg)
+        else:
+            self._send_messages(endpoint, [msg])
+
+    def _send_messages(self, endpoint, msgs):
         connection = self.connect(endpoint)
-        self.send_sock.send(endpoint.encode('utf-8'), flags=zmq.SNDMORE)
-        self.send_sock.send_multipart(msg.pack_frames())
-        logger.debug('-> %s to %s', msg, endpoint)
-        connection.on_send(msg)
+        try:
+            pending = self.pending[endpoint]
+        except KeyError:
+            pass
+        else:
+            pending.extend(msgs)
+            return
+        unsent = self._try_send(endpoint, connection, msgs)
+        if unsent:
+            # The connection handshake hasn't finished yet. Buffer messages
+            # until the peer becomes routable instead of blocking the caller.
+            self.pending[endpoint] = unsent
+            self.spawn(self._send_pending, endpoint, connection)
 
-    def prepare_headers(self, headers):
+    def _pack_frames(self, connection, msg):
+        if connection.wire_format == COMPACT and len(msg.packed_body) <= COMPACT_MAX_BODY_SIZE:
+            try:
+                return [msg.pack_compact(connection.subject_ids.get(msg.subject) if msg.type == Message.REQ else None)]
+            except ValueError:
+                pass
+        headers = None
+        if self.wire_format == COMPACT:
+            # Advertise compact format support in all classic messages, so the
+            # peer can tell if it talks to a classic service again.
+            headers = dict(msg.headers)
+            headers['wire_formats'] = [COMPACT]
+        if len(self.endpoints) > 1 and not connection.received_message_count:
+            # Tell the peer how to connect back until it replied.
+            headers = dict(headers or msg.headers)
+            headers['endpoints'] = self.endpoints
+        if headers is not None:
+            return msg.pack_frames(headers=headers)
+        return msg.pack_frames()
+
+    def _try_send(self, endpoint, connection, msgs):
+        address = endpoint.encode('utf-8')
+        for i, msg in enumerate(msgs):
+            try:
+                self.send_sock.send_multipart([address] + self._pack_frames(connection, msg))
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                return msgs[i:]
+            logger.debug('-> %s to %s', msg, endpoint)
+            connection.on_send(msg)
+        return []
+
+    def _send_pending(self, endpoint, connection):
+        deadline = time.monotonic() + self.connect_timeout
+        delay = 0.001
+        while True:
+            gevent.sleep(delay)
+            if not self.running or self.connections.get(endpoint) is not connection:
+                msgs = self.pending.pop(endpoint)
+                logger.debug('dropping %s pending messages to %s (disconnected)', len(msgs), endpoint)
+                return
+            unsent = self._try_send(endpoint, connection, self.pending[endpoint])
+            if not unsent:
+                del self.pending[endpoint]
+                return
+            if time.monotonic() >= deadline:
+                del self.pending[endpoint]
+                logger.warning('dropping %s pending messages to %s (not reachable after %ss)', len(unsent), endpoint, self.connect_timeout)
+                return
+            self.pending[endpoint] = unsent
+            delay = min(2 * delay, .1)
+
+    def prepare_headers(self, headers, deadline=None):
+        """
+        Adds the trace id and, given a `deadline`, the time left until the
+        deadline (as `timeout` in seconds) to `headers`.
+        """
         headers = headers or {}
         headers.setdefault('trace_id', trace.get_id())
+        if deadline is not None:
+            headers.setdefault('timeout', max(0, deadline - time.monotonic()))
         return headers
 
     def _pick_endpoint(self, service):
         if not isinstance(service, Service):
             return service
         service.observe(services.REMOVED, self._on_service_instance_unavailable)
-        choices = []
-        for instance in service:
-            try:
-                connection = self.connections[instance.endpoint]
-            except KeyError:
-                choices.append(instance.endpoint)
-                continue
-            if connection.is_alive():
-                choices.append(instance.endpoint)
-        if not choices:
+        endpoint = self.balancer.pick(service)
+        if endpoint is None:
             raise NotConnected('Not connected to %s' % service.name)
-        return random.choice(choices)
+        self.breakers.on_pick(service.name, endpoint)
+        if endpoint not in self.connections and len(self.transports) > 1:
+            for instance in service:
+                if instance.endpoint == endpoint:
+                    self.add_route(endpoint, getattr(instance, 'endpoints', ()))
+        return endpoint
 
-    def send_request(self, service, subject, body, headers=None):
-        msg = Message(
+    def _create_request(self, subject, body, headers=None, deadline=None):
+        return Message(
             msg_type=Message.REQ,
             subject=subject,
             body=body,
             source=self.endpoint,
-            headers=self.prepare_headers(headers),
+            headers=self.prepare_headers(headers, deadline=deadline),
+            serializer=self.serializer,
         )
-        channel = RequestChannel(msg, self)
+
+    def send_request(self, service, subject, body, headers=None, stream=False, batch=None, hedge=None, deadline=None):
+        """
+        Sends a request and returns the channel that receives the reply. The
+        request expires at `deadline` (a `time.monotonic()` value), or at the
+        deadline of the current trace if that is earlier.
+        """
+        if stream:
+            headers = dict(headers or {}, stream=STREAM_WINDOW)
+        else:
+            inherited = trace.get_deadline()
+            if deadline is None or (inherited is not None and inherited < deadline):
+                deadline = inherited
+        msg = self._create_request(subject, body, headers=headers, deadline=deadline)
+        if batch is not None:
+            channel = batch.add(msg)
+        else:
+            if stream:
+                channel = StreamChannel(msg, self)
+            elif hedge is not None:
+                channel = HedgedRequestChannel(msg, self, service, hedge)
+            else:
+                channel = RequestChannel(msg, self)
+            # Closes the channel if nobody calls `get()` or `iter()`.
+            channel.stale_at = deadline or time.monotonic() + STALE_CHANNEL_TIMEOUT
+            self.timeouts.schedule(channel.stale_at, channel)
         self.channels[msg.id] = channel
+        if deadline is not None and deadline <= time.monotonic():
+            logger.debug('not sending expired request: %s', msg)
+            return channel
         try:
             endpoint = self._pick_endpoint(service)
         except NotConnected:
             logger.error('cannot send message (no instance): %s', msg)
         else:
-            self._send_message(endpoint, msg)
+            if stream or hedge is not None:
+                channel.endpoint = endpoint
+            if batch is None and isinstance(service, Service):
+                channel.breaker = self.breakers.get(service.name, endpoint)
+            self._send_request(endpoint, msg)
         return channel
 
+    def _send_request(self, endpoint, msg):
+        self._send_message(endpoint, msg)
+        connection = self.connections.get(endpoint)
+        if connection is not None:
+            connection.on_request(msg)
+
+    def send_hedge(self, channel):
+        """
+        Sends a duplicate of the request of `channel` to another instance of
+        its service, and returns it. Returns None if there is no other
+        instance or the hedge policy doesn't allow another hedge.
+        """
+        if not isinstance(channel.service, Service):
+            return None
+        endpoint = self.balancer.pick_other(channel.service, channel.endpoint)
+        if endpoint is None or not channel.policy.acquire():
+            return None
+        request = channel.request
+        headers = dict(request.headers, hedge=True)
+        if 'timeout' in headers:
+            headers['timeout'] = max(0, headers['timeout'] - (time.monotonic() - channel.sent_at))
+        msg = self._create_request(request.subject, request.body, headers=headers)
+        self.channels[msg.id] = channel
+        self._send_request(endpoint, msg)
+        return msg
+
+    def forward_message(self, endpoint, msg, headers=None):
+        """
+        Sends a copy of `msg` from this server to `endpoint` without decoding
+        its body. If `headers` are given, they replace the headers of `msg`.
+        """
+        copy = Message(
+            msg_type=msg.type,
+            subject=msg.subject,
+            packed_body=msg.packed_body,
+            headers=headers,
+            packed_headers=msg.packed_headers if headers is None else None,
+            msg_id=msg.id,
+            source=self.endpoint,
+            lazy=True,
+        )
+        if copy.is_request():
+            self._send_request(endpoint, copy)
+        else:
+            self._send_message(endpoint, copy)
+        return copy
+
+    def send_stream_credits(self, channel, body):
+        msg = Message(
+            msg_type=Message.ACK,
+            subject=get_stream_subject(channel.request.id),
+            body=body,
+            source=self.endpoint,
+            serializer=self.serializer,
+        )
+        self._send_message(channel.endpoint, msg)
+
     def send_reply(self, msg, body, msg_type=Message.REP, headers=None):
+        headers = self.prepare_headers(headers)
+        if not msg.subject_id and msg.subject in self.subjects.ids:
+            connection = self.connections.get(msg.source)
+            if connection is not None and connection.wire_format == COMPACT:
+                # Tell the peer the id to use for this subject from now on.
+                headers['subject_ids'] = {msg.subject: self.subjects.ids[msg.subject]}
+                headers['subject_table'] = self.subjects.epoch
         reply_msg = Message(
             msg_type=msg_type,
             subject=msg.id,
             body=body,
             source=self.endpoint,
-            headers=self.prepare_headers(headers),
+            headers=headers,
+            serializer=self.serializer,
         )
         self._send_message(msg.source, reply_msg)
         return reply_msg
 
-    def dispatch_request(self, msg):
+    def dispatch_request(self, msg, deadline=None):
+        if deadline is not None and deadline <= time.monotonic():
+            # The request waited too long for a greenlet.
+            self.drop_expired_request(msg)
+            return
+        # Requests sent while handling this one inherit its deadline.
+        trace.set_deadline(deadline)
         loglevel = self._get_loglevel(msg)
         logger.log(loglevel, '%s source=%s', msg.subject, msg.source)
         start = time.time()
@@ -195,40 +497,131 @@ class ZmqRPCServer(Component):
             elapsed = time.time() - start
             logger.log(loglevel, 'subject=%s duration=%f (seconds)', msg.subject, elapsed)
 
+    def drop_expired_request(self, msg):
+        # The caller doesn't wait for a reply anymore.
+        logger.debug('dropping expired request: %s', msg)
+        self.expired_request_counts.incr(subject=msg.subject)
+
+    def shed_request(self, msg, reason):
+        logger.debug('shedding request (%s): %s', reason, msg)
+        self.shed_request_counts.incr(reason=reason)
+        self.send_reply(msg, None, msg_type=Message.NACK)
+
     def _get_loglevel(self, msg):
         return logging.DEBUG if msg.subject == 'lymph.ping' else logging.INFO
 
-    def recv_message(self, msg):
+    def recv_message(self, msg, compact=False):
         trace.set_id(msg.headers.get('trace_id'))
         logger.debug('<- %s', msg)
+        if msg.source not in self.connections and 'endpoints' in msg.headers:
+            self.add_route(msg.source, msg.headers['endpoints'])
         connection = self.connect(msg.source)
         connection.on_recv(msg)
+        if self.wire_format == COMPACT:
+            self._update_wire_format(connection, msg, compact)
         if msg.is_request():
-            self.spawn(self.dispatch_request, msg)
+            if msg.subject is None:
+                # The peer used a subject id from another subject table, e.g.
+                # of a previous process bound to the same endpoint.
+                logger.info('unknown subject id: %s (msg-id=%s)', msg.subject_id, msg.id)
+                self.send_reply(msg, None, msg_type=Message.NACK, headers={
+                    'subject_ids': {},
+                    'subject_table': self.subjects.epoch,
+                    'unknown_subject': True,
+                })
+                return
+            deadline = None
+            timeout = msg.headers.get('timeout')
+            if timeout is not None:
+                if timeout <= 0:
+                    self.drop_expired_request(msg)
+                    return
+                deadline = time.monotonic() + timeout
+            if self.workers is not None and self.workers.forward(msg, deadline):
+                return
+            if self.admission is not None:
+                self.admission.admit(msg, deadline)
+                return
+            try:
+                self.spawn(self.dispatch_request, msg, deadline)
+            except RejectExcecutionError:
+                self.shed_request(msg, 'pool_full')
         elif msg.is_reply():
+            if 'subject_table' in msg.headers:
+                connection.learn_subjects(msg.headers['subject_table'], msg.headers['subject_ids'])
             try:
                 channel = self.channels[msg.subject]
             except KeyError:
                 logger.debug('reply to unknown subject: %s (msg-id=%s)', msg.subject, msg.id)
                 return
+            if msg.headers.get('unknown_subject') and self._resend_request(connection, channel, msg):
+                return
             channel.recv(msg)
         else:
             logger.warning('unknown message type: %s (msg-id=%s)', msg.type, msg.id)
 
+    def _resend_request(self, connection, channel, msg):
+        # The peer doesn't know the subject id of the request `msg` replies to
+        # (e.g. it restarted with a new subject table): the request is sent
+        # again with its subject. Returns False if the request is unknown.
+        get_request = getattr(channel, 'get_request', None)
+        request = get_request(msg.subject) if get_request is not None else None
+        if request is None:
+            return False
+        connection.subject_ids.pop(request.subject, None)
+        logger.info('resending %s with inline subject to %s', request, msg.source)
+        if isinstance(channel, ForwardChannel):
+            self.forward_message(msg.source, request)
+        else:
+            self._send_message(msg.source, request)
+        return True
+
+    def _update_wire_format(self, connection, msg, compact):
+        # Compact services send it, or advertise it in classic messages. A
+        # classic message without the header comes from a peer that doesn't
+        # support it (anymore), e.g. after it was restarted.
+        if compact or COMPACT in msg.headers.get('wire_formats', ()):
+            connection.wire_format = COMPACT
+        elif connection.wire_format == COMPACT:
+            logger.info('%s uses the classic wire format again', connection.endpoint)
+            connection.wire_format = CLASSIC
+
     def _recv_loop(self):
+        copy = not self.zero_copy
         while True:
-            frames = self.recv_sock.recv_multipart()
+            frames = self.recv_sock.recv_multipart(copy=copy)
             try:
-                msg = Message.unpack_frames(frames)
+                msg = Message.unpack_frames(frames, copy=copy, subjects=self.subjects)
+                # Messages are decoded lazily, but the headers are always
+                # needed by `recv_message()`.
+                msg.headers
             except ValueError as e:
                 msg_id = frames[1] if len(frames) >= 2 else None
                 logger.warning('bad message format %s: %r (msg-id=%s)', e, (frames), msg_id)
                 continue
-            self.recv_message(msg)
+            self.recv_message(msg, compact=len(frames) == 2)
 
     def ping(self, address):
         return self.send_request(address, 'lymph.ping', {'payload': ''})
 
+    def send_heartbeat(self, connection):
+        msg = self._create_request('lymph.ping', {'payload': ''})
+        # The connection itself receives the reply, no channel is needed.
+        self.channels[msg.id] = connection
+        self._send_message(connection.endpoint, msg)
+        return msg
+
     def _get_metrics(self):
         yield metrics.RawMetric('rpc.connection_count', len(self.connections))
+        yield metrics.RawMetric('rpc.pending_messages', sum(len(msgs) for msgs in self.pending.values()))
         yield self.request_counts
+        yield self.expired_request_counts
+        yield self.shed_request_counts
+        for metric in self.breakers._get_metrics():
+            yield metric
+        if self.admission is not None:
+            for metric in self.admission._get_metrics():
+                yield metric
+        if self.send_queue is not None:
+            for metric in self.send_queue._get_metrics():
+                yield metric
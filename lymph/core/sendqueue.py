@@ -0,0 +1,87 @@
+import collections
+import logging
+
+import gevent
+
+from lymph.core.monitoring import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class SendQueue(object):
+    """
+    Collects outgoing messages per endpoint and hands them to `send` in
+    batches.
+
+    Messages queued during the same hub iteration are flushed together by a
+    single greenlet. With `max_delay` > 0 the flush is postponed for at most
+    that many seconds, a queue that reaches `max_size` messages is flushed
+    immediately.
+    """
+
+    def __init__(self, send, max_size=100, max_delay=0):
+        self.send = send
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.queues = collections.OrderedDict()
+        self.depth = 0
+        self.max_flush_size = 0
+        self.flush_count = metrics.Counter('rpc.send_queue.flushes')
+        self.flushed_count = metrics.Counter('rpc.send_queue.messages')
+        self._flush_greenlet = None
+
+    def __len__(self):
+        return self.depth
+
+    def put(self, endpoint, msg):
+        try:
+            queue = self.queues[endpoint]
+        except KeyError:
+            queue = self.queues[endpoint] = []
+        queue.append(msg)
+        self.depth += 1
+        if len(queue) >= self.max_size:
+            self.flush_endpoint(endpoint)
+        elif self._flush_greenlet is None:
+            if self.max_delay:
+                self._flush_greenlet = gevent.spawn_later(self.max_delay, self._flush_later)
+            else:
+                self._flush_greenlet = gevent.spawn(self._flush_later)
+
+    def _flush_later(self):
+        self._flush_greenlet = None
+        self.flush()
+
+    def flush(self):
+        while self.queues:
+            endpoint, msgs = self.queues.popitem(last=False)
+            self._flush(endpoint, msgs)
+
+    def flush_endpoint(self, endpoint):
+        msgs = self.queues.pop(endpoint, None)
+        if msgs:
+            self._flush(endpoint, msgs)
+
+    def _flush(self, endpoint, msgs):
+        n = len(msgs)
+        self.depth -= n
+        self.flush_count += 1
+        self.flushed_count += n
+        self.max_flush_size = max(self.max_flush_size, n)
+        try:
+            self.send(endpoint, msgs)
+        except Exception:
+            logger.exception('failed to send %s queued messages to %s', n, endpoint)
+
+    def close(self):
+        if self._flush_greenlet is not None:
+            self._flush_greenlet.kill()
+            self._flush_greenlet = None
+        self.flush()
+
+    def _get_metrics(self):
+        yield metrics.RawMetric('rpc.send_queue.depth', self.depth)
+        yield metrics.RawMetric('rpc.send_queue.max_flush_size', self.max_flush_size)
+        yield self.flush_count
+        yield self.flushed_count
@@ -0,0 +1,88 @@
+import time
+import unittest
+
+import gevent
+import gevent.event
+
+from lymph.core.admission import AdmissionController, ConcurrencyLimit
+from lymph.core.messages import Message
+
+
+class StubServer(object):
+    def __init__(self):
+        self.release = gevent.event.Event()
+        self.dispatched = []
+        self.shed = []
+        self.expired = []
+
+    def spawn(self, func, *args):
+        return gevent.spawn(func, *args)
+
+    def dispatch_request(self, msg, deadline=None):
+        self.dispatched.append(msg.subject)
+        if msg.subject != 'lymph.ping':
+            self.release.wait()
+
+    def shed_request(self, msg, reason):
+        self.shed.append((msg.subject, reason))
+
+    def drop_expired_request(self, msg):
+        self.expired.append(msg.subject)
+
+
+def request(subject):
+    return Message(Message.REQ, subject, body={})
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.admission = AdmissionController(self.server, max_queue_size=3, limit=ConcurrencyLimit(initial=2, max_limit=2))
+
+    def test_queue(self):
+        for i in range(6):
+            self.admission.admit(request('upper.upper%s' % i))
+        self.admission.admit(request('lymph.ping'))
+        gevent.sleep(0)
+        self.assertEqual(self.server.dispatched, ['upper.upper0', 'upper.upper1', 'lymph.ping'])
+        self.assertEqual(len(self.admission.queue), 3)
+        self.assertEqual(self.server.shed, [('upper.upper5', 'queue_full')])
+
+        self.server.release.set()
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.dispatched[3:], ['upper.upper2', 'upper.upper3', 'upper.upper4'])
+        self.assertEqual(self.admission.running, 0)
+
+    def test_queue_delay(self):
+        self.admission.target_delay = 0.001
+        self.admission.interval = 0
+        for i in range(5):
+            self.admission.admit(request('upper.upper%s' % i))
+        gevent.sleep(0.01)
+        self.server.release.set()
+        gevent.sleep(0.01)
+        # The first request that waited too long starts the interval, the
+        # next one is shed, and the last one is never shed.
+        self.assertEqual(self.server.dispatched, ['upper.upper0', 'upper.upper1', 'upper.upper2', 'upper.upper4'])
+        self.assertEqual(self.server.shed, [('upper.upper3', 'queue_delay')])
+
+    def test_expired_requests(self):
+        self.admission.admit(request('upper.upper0'))
+        self.admission.admit(request('upper.upper1'))
+        self.admission.admit(request('upper.upper2'), time.monotonic())
+        gevent.sleep(0)
+        self.server.release.set()
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.expired, ['upper.upper2'])
+
+
+class ConcurrencyLimitTest(unittest.TestCase):
+    def test_adapt(self):
+        limit = ConcurrencyLimit(initial=10, max_limit=100, window=1)
+        for i in range(20):
+            limit.add(.01)
+        self.assertGreater(int(limit), 20)
+        high = int(limit)
+        for i in range(20):
+            limit.add(.1)
+        self.assertLess(int(limit), high / 2)
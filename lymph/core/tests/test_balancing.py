@@ -0,0 +1,94 @@
+import collections
+import unittest
+
+from lymph.core import balancing
+from lymph.core.circuitbreaker import CircuitBreakers
+from lymph.core.connection import Connection, HeartbeatScheduler
+from lymph.core.messages import Message
+from lymph.core.services import Service, ServiceInstance
+
+
+class StubServer(object):
+    def __init__(self):
+        self.heartbeat = HeartbeatScheduler(self)
+        self.connections = {}
+        self.breakers = CircuitBreakers()
+
+    def connect(self, endpoint):
+        connection = self.connections[endpoint] = Connection(self, endpoint)
+        return connection
+
+
+class BalancerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.service = Service('upper', instances=[
+            ServiceInstance(endpoint='tcp://127.0.0.1:%s' % port) for port in (1, 2, 3)
+        ])
+
+    def pick(self, balancer_name, n=300):
+        balancer = balancing.get_balancer_class(balancer_name)(self.server)
+        return collections.Counter(balancer.pick(self.service) for i in range(n))
+
+    def test_random(self):
+        self.assertEqual(set(self.pick('random')), set(instance.endpoint for instance in self.service))
+
+    def test_skip_dead_connections(self):
+        self.server.connect('tcp://127.0.0.1:1').set_status('unresponsive')
+        self.server.connect('tcp://127.0.0.1:2').set_status('closed')
+        for name in balancing.BALANCERS:
+            self.assertEqual(set(self.pick(name)), set(['tcp://127.0.0.1:3']))
+
+    def test_no_candidates(self):
+        self.service = Service('upper')
+        for name in balancing.BALANCERS:
+            self.assertEqual(set(self.pick(name)), set([None]))
+
+    def test_endpoints_are_cached(self):
+        balancer = balancing.RandomBalancer(self.server)
+        endpoints = balancer.get_endpoints(self.service)
+        self.assertIs(balancer.get_endpoints(self.service), endpoints)
+        self.service.update('tcp://127.0.0.1:4', endpoint='tcp://127.0.0.1:4')
+        self.assertIn('tcp://127.0.0.1:4', balancer.get_endpoints(self.service))
+        self.service.remove('tcp://127.0.0.1:4')
+        self.assertNotIn('tcp://127.0.0.1:4', balancer.get_endpoints(self.service))
+
+    def test_least_outstanding(self):
+        for port, outstanding in ((1, 5), (2, 0), (3, 1)):
+            connection = self.server.connect('tcp://127.0.0.1:%s' % port)
+            for i in range(outstanding):
+                connection.on_request(Message(Message.REQ, 'upper.upper', body={}))
+        picks = self.pick('p2c')
+        self.assertNotIn('tcp://127.0.0.1:1', picks)
+        self.assertGreater(picks['tcp://127.0.0.1:2'], picks['tcp://127.0.0.1:3'])
+
+    def test_ewma(self):
+        for port, latency in ((1, 0.5), (2, 0.001), (3, 0.01)):
+            self.server.connect('tcp://127.0.0.1:%s' % port).latency_ewma = latency
+        picks = self.pick('ewma')
+        self.assertNotIn('tcp://127.0.0.1:1', picks)
+        self.assertGreater(picks['tcp://127.0.0.1:2'], picks['tcp://127.0.0.1:3'])
+
+    def test_phi(self):
+        for port, silence in ((1, 30), (2, 0), (3, 0)):
+            connection = self.server.connect('tcp://127.0.0.1:%s' % port)
+            connection.last_seen = connection.created_at - silence
+        picks = self.pick('phi', n=1000)
+        self.assertLess(picks['tcp://127.0.0.1:1'], picks['tcp://127.0.0.1:2'] / 5)
+
+    def test_skip_open_circuit_breakers(self):
+        for i in range(5):
+            self.server.breakers.get('upper', 'tcp://127.0.0.1:1').record(False)
+        for name in balancing.BALANCERS:
+            self.assertNotIn('tcp://127.0.0.1:1', self.pick(name))
+        for port in (2, 3):
+            self.server.breakers.get('upper', 'tcp://127.0.0.1:%s' % port).record(False)
+        self.assertIn('tcp://127.0.0.1:2', self.pick('random'))
+        for i in range(5):
+            self.server.breakers.get('upper', 'tcp://127.0.0.1:2').record(False)
+            self.server.breakers.get('upper', 'tcp://127.0.0.1:3').record(False)
+        # All breakers are open, requests go to any instance.
+        self.assertEqual(len(self.pick('random')), 3)
+
+    def test_import_path(self):
+        self.assertIs(balancing.get_balancer_class('lymph.core.balancing:PhiBalancer'), balancing.PhiBalancer)
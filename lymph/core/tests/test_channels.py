@@ -0,0 +1,136 @@
+import gc
+import sys
+import time
+import unittest
+
+import gevent
+
+from lymph.core.channels import ChannelTimeouts, RequestChannel, HedgedRequestChannel, StreamChannel
+from lymph.core.hedging import HedgePolicy
+from lymph.core.messages import Message
+from lymph.exceptions import Timeout, Nack
+
+
+class StubServer(object):
+    def __init__(self):
+        self.channels = {}
+        self.timeouts = ChannelTimeouts(self)
+        self.timeouts.start()
+
+    def create_channel(self, stale_after=None, cls=RequestChannel, **kwargs):
+        msg = Message(Message.REQ, 'upper.upper', body={})
+        channel = self.channels[msg.id] = cls(msg, self, **kwargs)
+        if stale_after is not None:
+            channel.stale_at = time.monotonic() + stale_after
+            self.timeouts.schedule(channel.stale_at, channel)
+        return channel
+
+
+def reply(channel, msg_type=Message.REP, body='FOO'):
+    return Message(msg_type, channel.request.id, body=body)
+
+
+class RequestChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+
+    def tearDown(self):
+        self.server.timeouts.stop()
+
+    def test_reply_before_get(self):
+        channel = self.server.create_channel()
+        channel.recv(reply(channel))
+        channel.recv(reply(channel, body='BAR'))
+        self.assertEqual(channel.get().body, 'FOO')
+        self.assertEqual(self.server.channels, {})
+
+    def test_reply_during_get(self):
+        channel = self.server.create_channel()
+        gevent.spawn_later(0.01, channel.recv, reply(channel))
+        self.assertEqual(channel.get(timeout=1).body, 'FOO')
+
+    def test_nack(self):
+        channel = self.server.create_channel()
+        gevent.spawn(channel.recv, reply(channel, Message.NACK, None))
+        self.assertRaises(Nack, channel.get)
+
+    def test_timeout(self):
+        channel = self.server.create_channel()
+        start = time.monotonic()
+        self.assertRaises(Timeout, channel.get, timeout=0.02)
+        self.assertGreaterEqual(time.monotonic() - start, 0.02)
+        self.assertEqual(self.server.channels, {})
+        self.assertRaises(Timeout, self.server.create_channel().get, timeout=0)
+
+    def test_timeouts_share_a_greenlet(self):
+        channels = [self.server.create_channel() for i in range(10)]
+        greenlets = [gevent.spawn(channel.get, timeout=0.01 * (i + 1)) for i, channel in enumerate(channels)]
+        gevent.sleep(0)
+        self.assertEqual(len(self.server.timeouts), 10)
+        channels[5].recv(reply(channels[5]))
+        gevent.joinall(greenlets)
+        self.assertEqual([isinstance(g.exception, Timeout) for g in greenlets], [True] * 5 + [False] + [True] * 4)
+        self.assertEqual(len(self.server.timeouts), 0)
+
+    def test_completed_channels_are_not_referenced(self):
+        channel = self.server.create_channel(stale_after=10)
+        channel.recv(reply(channel))
+        self.assertEqual(channel.get().body, 'FOO')
+        self.assertEqual(len(self.server.timeouts), 1)
+        frame = sys._getframe()
+        self.assertEqual([ref for ref in gc.get_referrers(channel) if ref is not frame], [])
+
+    def test_stale_channels_are_closed(self):
+        stale = self.server.create_channel(stale_after=0.01)
+        waiting = self.server.create_channel(stale_after=0.01)
+        greenlet = gevent.spawn(waiting.get, timeout=1)
+        gevent.sleep(0.02)
+        self.assertEqual(list(self.server.channels), [waiting.request.id])
+        waiting.recv(reply(waiting))
+        self.assertEqual(greenlet.get().body, 'FOO')
+        self.assertRaises(Timeout, stale.get, timeout=1)
+
+
+class HedgedRequestChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+
+    def tearDown(self):
+        self.server.timeouts.stop()
+
+    def create_channel(self, **kwargs):
+        return self.server.create_channel(cls=HedgedRequestChannel, service=None, policy=HedgePolicy(), **kwargs)
+
+    def test_get_without_timeout(self):
+        channel = self.create_channel()
+        gevent.spawn_later(0.01, channel.recv, reply(channel))
+        self.assertEqual(channel.get(timeout=None).body, 'FOO')
+        self.assertEqual(self.server.channels, {})
+
+    def test_stale_channels_are_closed(self):
+        stale = self.create_channel(stale_after=0.01)
+        waiting = self.create_channel(stale_after=0.01)
+        greenlet = gevent.spawn(waiting.get, timeout=1)
+        gevent.sleep(0.02)
+        self.assertEqual(list(self.server.channels), [waiting.request.id])
+        waiting.recv(reply(waiting))
+        self.assertEqual(greenlet.get().body, 'FOO')
+        self.assertRaises(Timeout, stale.get, timeout=0.01)
+
+
+class StreamChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+
+    def tearDown(self):
+        self.server.timeouts.stop()
+
+    def test_stale_channels_are_closed(self):
+        stale = self.server.create_channel(stale_after=0.01, cls=StreamChannel)
+        waiting = self.server.create_channel(stale_after=0.01, cls=StreamChannel)
+        greenlet = gevent.spawn(list, waiting.iter(timeout=1))
+        gevent.sleep(0.02)
+        self.assertEqual(list(self.server.channels), [waiting.request.id])
+        waiting.recv(reply(waiting, body=None))
+        self.assertEqual([msg.body for msg in greenlet.get()], [None])
+        self.assertNotIn(stale.request.id, self.server.channels)
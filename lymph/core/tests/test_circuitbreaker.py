@@ -0,0 +1,53 @@
+import time
+import unittest
+
+from lymph.core.circuitbreaker import CircuitBreakers, CLOSED, OPEN, HALF_OPEN
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breakers = CircuitBreakers(failure_threshold=3, reset_timeout=10)
+        self.breaker = self.breakers.get('upper', 'tcp://127.0.0.1:1')
+
+    def trip_counts(self):
+        return list(self.breakers.trip_counts)
+
+    def test_open_after_consecutive_failures(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.breaker.record(True)
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breakers.get_unavailable('upper'), ())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breakers.get_unavailable('upper'), set(['tcp://127.0.0.1:1']))
+        self.assertEqual(self.breakers.get_unavailable('lower'), ())
+        self.assertEqual(self.trip_counts(), [('rpc.circuit_breaker.trips', 1, {'service': 'upper'})])
+        self.assertEqual(self.breakers.get_status(), [{
+            'service': 'upper', 'endpoint': 'tcp://127.0.0.1:1', 'state': OPEN, 'failures': 3,
+        }])
+
+    def test_half_open(self):
+        for i in range(3):
+            self.breaker.record(False)
+        self.breaker.retry_at = time.monotonic()
+        self.assertEqual(self.breakers.get_unavailable('upper'), set())
+
+        # A single probe is let through.
+        self.breakers.on_pick('upper', 'tcp://127.0.0.1:1')
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertEqual(self.breakers.get_unavailable('upper'), set(['tcp://127.0.0.1:1']))
+
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.breaker.retry_at = time.monotonic()
+        self.breakers.on_pick('upper', 'tcp://127.0.0.1:1')
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breakers.get_unavailable('upper'), ())
+        self.assertEqual(self.breakers.get_status(), [])
+
+    def test_disabled(self):
+        self.assertIsNone(CircuitBreakers(failure_threshold=0).get('upper', 'tcp://127.0.0.1:1'))
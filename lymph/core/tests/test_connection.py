@@ -0,0 +1,99 @@
+import time
+import unittest
+
+import mock
+
+from lymph.core import connection
+from lymph.core.connection import Connection, HeartbeatScheduler
+from lymph.core.messages import Message
+
+
+class StubServer(object):
+    def __init__(self):
+        self.heartbeat = HeartbeatScheduler(self)
+        self.channels = {}
+        self.heartbeats = []
+
+    def send_heartbeat(self, connection):
+        msg = Message(Message.REQ, 'lymph.ping', body={'payload': ''})
+        self.channels[msg.id] = connection
+        self.heartbeats.append(msg)
+        return msg
+
+    def disconnect(self, endpoint):
+        pass
+
+
+class ConnectionHeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.connection = Connection(self.server, 'tcp://127.0.0.1:1')
+
+    def reply(self, msg, msg_type=Message.REP):
+        reply = Message(msg_type, msg.id, body=None)
+        self.connection.on_recv(reply)
+        self.server.channels[msg.id].recv(reply)
+
+    def test_schedule_on_creation(self):
+        self.assertEqual(len(self.server.heartbeat), 1)
+
+    def test_ping_idle_connection(self):
+        self.connection.heartbeat(time.monotonic())
+        self.assertEqual(len(self.server.heartbeats), 1)
+        self.reply(self.server.heartbeats[0])
+        self.assertEqual(self.server.channels, {})
+        self.assertEqual(self.connection.explicit_heartbeat_count, 1)
+        self.assertEqual(self.connection.status, connection.UNKNOWN)
+        self.connection.update_status()
+        self.assertEqual(self.connection.status, connection.RESPONSIVE)
+
+    def test_traffic_is_implicit_heartbeat(self):
+        self.connection.on_recv(Message(Message.REQ, 'upper.upper', body={}))
+        self.connection.heartbeat(time.monotonic())
+        self.assertEqual(self.server.heartbeats, [])
+        self.assertEqual(self.connection.status, connection.RESPONSIVE)
+
+    def test_reap_unanswered_heartbeat(self):
+        self.connection.heartbeat(time.monotonic())
+        self.assertEqual(len(self.server.channels), 1)
+        self.connection.heartbeat(time.monotonic() + 1)
+        self.assertEqual(len(self.server.heartbeats), 2)
+        self.assertEqual(list(self.server.channels), [self.server.heartbeats[1].id])
+
+    def test_heartbeat_error(self):
+        self.connection.heartbeat(time.monotonic())
+        self.reply(self.server.heartbeats[0], Message.NACK)
+        self.assertEqual(self.connection.explicit_heartbeat_count, 0)
+        self.assertEqual(self.server.channels, {})
+
+    def test_unresponsive(self):
+        self.connection.on_recv(Message(Message.REP, 'x', body=None))
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 5):
+            self.connection.update_status()
+        self.assertEqual(self.connection.status, connection.UNRESPONSIVE)
+
+    def test_close(self):
+        self.connection.heartbeat(time.monotonic())
+        self.connection.close()
+        self.assertEqual(self.connection.status, connection.CLOSED)
+        self.assertEqual(self.server.channels, {})
+
+
+class ConnectionLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.connection = Connection(self.server, 'tcp://127.0.0.1:1')
+
+    def test_outstanding_requests(self):
+        requests = [Message(Message.REQ, 'upper.upper', body={}) for i in range(3)]
+        for msg in requests:
+            self.connection.on_request(msg)
+        self.assertEqual(len(self.connection.outstanding_requests), 3)
+        self.connection.on_recv(Message(Message.REP, requests[0].id, body='FOO'))
+        self.assertEqual(len(self.connection.outstanding_requests), 2)
+        self.assertGreater(self.connection.latency_ewma, 0)
+
+        latency = self.connection.latency_ewma
+        self.connection.heartbeat(time.monotonic() + self.connection.timeout + 1)
+        self.assertEqual(self.connection.outstanding_requests, {})
+        self.assertGreater(self.connection.latency_ewma, latency)
@@ -1,6 +1,10 @@
+import itertools
 import unittest
 
-from lymph.core.events import EventDispatcher
+import gevent
+
+from lymph.benchmarks.events import dispatch_events
+from lymph.core.events import Event, EventBatch, EventDispatcher
 
 
 class EventDispatcherTest(unittest.TestCase):
@@ -73,3 +77,83 @@ class EventDispatcherTest(unittest.TestCase):
 
         self.assert_dispatched_handlers_equal('foo', {'foo', 'base_foo', 'hash'})
         self.assert_dispatched_handlers_equal('bar', {'hash', 'bar'})
+
+    def test_dispatch_matches_patterns_like_regexes(self):
+        words = ['foo', 'bar', '*', '#', '']
+        patterns = ['.'.join(p) for n in range(1, 4) for p in itertools.product(words, repeat=n)]
+        regexes = [(pattern, self.dispatcher.compile(pattern)) for pattern in patterns]
+        for pattern in patterns:
+            self.dispatcher.register(pattern, self.make_handler(pattern))
+        for evt_type in ['.'.join(p) for n in range(1, 5) for p in itertools.product(['foo', 'bar', '', 'a-b'], repeat=n)]:
+            expected = set(pattern for pattern, regex in regexes if regex.match(evt_type))
+            self.assert_dispatched_patterns_equal(evt_type, expected)
+
+    def test_multiple_hashes_dispatch_once(self):
+        self.dispatcher.register('#.#', self.make_handler('hash_hash'))
+        self.assertEqual([pattern for pattern, handler in self.dispatcher.dispatch('a.b.c')], ['#.#'])
+
+    def test_call(self):
+        self.dispatcher.register('foo.*', self.make_handler('foo_star'))
+        self.dispatcher.register('#', self.make_handler('foo_star'))
+        self.dispatcher.register('#', self.make_handler('hash'))
+        event = Event('foo.bar', {})
+        self.assertTrue(self.dispatcher(event))
+        self.assertEqual(self.handler_log, [('foo_star', (event,)), ('hash', (event,))])
+        self.assertFalse(self.dispatcher(Event('foo-bar', {})))
+
+    def test_register_invalidates_cache(self):
+        self.dispatcher.register('foo', self.make_handler('foo'))
+        self.assert_dispatched_handlers_equal('foo', {'foo'})
+        self.dispatcher.register('*', self.make_handler('star'))
+        self.assert_dispatched_handlers_equal('foo', {'foo', 'star'})
+
+    def test_cache_size(self):
+        dispatcher = EventDispatcher(cache_size=2)
+        for evt_type in ('a', 'b', 'a', 'c'):
+            list(dispatcher.dispatch(evt_type))
+        self.assertEqual(list(dispatcher.cache), ['a', 'c'])
+
+    def test_unregister(self):
+        self.dispatcher.register('foo.*', self.make_handler('foo'))
+        self.dispatcher.register('foo.#', self.make_handler('foo'))
+        self.dispatcher.register('foo.*', self.make_handler('bar'))
+        self.assert_dispatched_handlers_equal('foo.bar', {'foo', 'bar'})
+
+        self.dispatcher.unregister(self.make_handler('foo'), 'foo.*')
+        self.assert_dispatched_patterns_equal('foo.bar', {'foo.#', 'foo.*'})
+        self.dispatcher.unregister(self.make_handler('foo'))
+        self.assert_dispatched_handlers_equal('foo.bar', {'bar'})
+        self.dispatcher.unregister(self.make_handler('bar'))
+        self.assert_dispatched_handlers_equal('foo.bar', [])
+        self.assertFalse(self.dispatcher.root)
+        self.assertEqual(list(self.dispatcher), [])
+        with self.assertRaises(KeyError):
+            self.dispatcher.unregister(self.make_handler('bar'))
+
+    def test_benchmark(self):
+        results = dispatch_events(patterns=100, n=10)
+        self.assertEqual(set(results), {'cached', 'uncached', 'regex'})
+
+
+class EventBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.flushed = []
+        self.batch = EventBatch(self.flushed.append, 3, timeout=0.01)
+
+    def test_flush_when_full(self):
+        for i in range(4):
+            self.batch.add(i)
+        self.assertEqual(self.flushed, [[0, 1, 2]])
+        self.assertEqual(len(self.batch), 1)
+
+    def test_flush_after_timeout(self):
+        self.batch.add(0)
+        gevent.sleep(0.05)
+        self.assertEqual(self.flushed, [[0]])
+        self.assertEqual(len(self.batch), 0)
+
+    def test_clear(self):
+        self.batch.add(0)
+        self.assertEqual(self.batch.clear(), [0])
+        gevent.sleep(0.05)
+        self.assertEqual(self.flushed, [])
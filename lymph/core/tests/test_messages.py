@@ -0,0 +1,121 @@
+import datetime
+import unittest
+
+import zmq
+
+from lymph.core.messages import Message, SubjectTable
+from lymph.serializers import msgpack_ext_serializer
+
+
+class MessageTest(unittest.TestCase):
+    def create_frames(self, **kwargs):
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'}, headers={'trace_id': 'abc'}, **kwargs)
+        return msg, [b'tcp://127.0.0.1:1'] + msg.pack_frames()
+
+    def test_unpack_frames(self):
+        msg, frames = self.create_frames()
+        received = Message.unpack_frames(frames)
+        self.assertEqual(received.id, msg.id)
+        self.assertEqual(received.type, Message.REQ)
+        self.assertEqual(received.subject, 'upper.upper')
+        self.assertEqual(received.source, 'tcp://127.0.0.1:1')
+        self.assertEqual(received.headers, {'trace_id': 'abc'})
+        self.assertEqual(received.body, {'text': 'foo'})
+
+    def test_unpack_frames_is_lazy(self):
+        msg, frames = self.create_frames()
+        received = Message.unpack_frames(frames)
+        self.assertIsNone(received._headers)
+        self.assertNotEqual(received._body, {'text': 'foo'})
+        self.assertEqual(received.headers, {'trace_id': 'abc'})
+        self.assertNotEqual(received._body, {'text': 'foo'})
+        self.assertEqual(received.body, {'text': 'foo'})
+        self.assertEqual(received.pack_frames(), frames[1:])
+
+    def test_unpack_frames_without_copy(self):
+        msg, frames = self.create_frames()
+        received = Message.unpack_frames([zmq.Frame(frame) for frame in frames], copy=False)
+        self.assertEqual(received.id, msg.id)
+        self.assertEqual(received.type, Message.REQ)
+        self.assertEqual(received.subject, 'upper.upper')
+        self.assertEqual(received.source, 'tcp://127.0.0.1:1')
+        self.assertEqual(received.headers, {'trace_id': 'abc'})
+        self.assertEqual(received.body, {'text': 'foo'})
+
+    def test_unpack_frames_bad_frame_count(self):
+        msg, frames = self.create_frames()
+        with self.assertRaises(ValueError):
+            Message.unpack_frames(frames[1:])
+
+    def test_body_serializer(self):
+        body = {'at': datetime.datetime(2015, 1, 2, 3, 4, 5)}
+        classic = Message(Message.REQ, 'upper.upper', body=body)
+        ext = Message(Message.REQ, 'upper.upper', body=body, serializer=msgpack_ext_serializer)
+        self.assertLess(len(ext.packed_body), len(classic.packed_body))
+        self.assertEqual(ext.packed_headers, classic.packed_headers)
+        for msg in (classic, ext):
+            received = Message.unpack_frames([b'tcp://127.0.0.1:1'] + msg.pack_frames())
+            self.assertEqual(received.body, body)
+
+    def test_compact_format(self):
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'}, headers={'trace_id': 'abc'})
+        payload = msg.pack_compact()
+        received = Message.unpack_frames([b'tcp://127.0.0.1:1', payload])
+        self.assertEqual(received.id, msg.id)
+        self.assertEqual(received.type, Message.REQ)
+        self.assertEqual(received.subject, 'upper.upper')
+        self.assertEqual(received.source, 'tcp://127.0.0.1:1')
+        self.assertEqual(received.headers, {'trace_id': 'abc'})
+        self.assertEqual(received.body, {'text': 'foo'})
+
+    def test_compact_format_reply(self):
+        request = Message(Message.REQ, 'upper.upper', body={})
+        msg = Message(Message.ERROR, request.id, body={'type': 'ValueError'})
+        payload = msg.pack_compact()
+        self.assertLess(len(payload), len(b''.join(msg.pack_frames())))
+        received = Message.unpack_frames([zmq.Frame(b'tcp://127.0.0.1:1'), zmq.Frame(payload)], copy=False)
+        self.assertEqual(received.type, Message.ERROR)
+        self.assertEqual(received.subject, request.id)
+        self.assertEqual(received.body, {'type': 'ValueError'})
+
+    def test_compact_format_interned_subject(self):
+        subjects = SubjectTable()
+        subject_id = subjects.add('upper.upper')
+        self.assertEqual(subjects.add('upper.upper'), subject_id)
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'})
+        payload = msg.pack_compact((subject_id, subjects.epoch))
+        self.assertEqual(len(payload), len(msg.pack_compact()) - len('upper.upper'))
+        received = Message.unpack_frames([b'tcp://127.0.0.1:1', payload], subjects=subjects)
+        self.assertEqual(received.subject, 'upper.upper')
+        self.assertEqual(received.subject_id, subject_id)
+        self.assertEqual(received.body, {'text': 'foo'})
+
+        stale = SubjectTable(epoch=subjects.epoch % 0xffffffff + 1)
+        stale.add('upper.upper')
+        received = Message.unpack_frames([b'tcp://127.0.0.1:1', payload], subjects=stale)
+        self.assertIsNone(received.subject)
+        self.assertEqual(received.body, {'text': 'foo'})
+
+        # Epochs that only differ above 16 bits are told apart.
+        subjects = SubjectTable(epoch=0x10001)
+        stale = SubjectTable(epoch=0x20001)
+        subject_id = subjects.add('upper.upper')
+        stale.add('upper.upper')
+        payload = msg.pack_compact((subject_id, subjects.epoch))
+        self.assertEqual(Message.unpack_frames([b'tcp://127.0.0.1:1', payload], subjects=subjects).subject, 'upper.upper')
+        self.assertIsNone(Message.unpack_frames([b'tcp://127.0.0.1:1', payload], subjects=stale).subject)
+
+    def test_compact_format_requires_uuid(self):
+        msg = Message(Message.REQ, 'upper.upper', body={}, msg_id='foo')
+        with self.assertRaises(ValueError):
+            msg.pack_compact()
+
+    def test_bad_compact_message(self):
+        payload = Message(Message.REQ, 'upper.upper', body={}).pack_compact()
+        with self.assertRaises(ValueError):
+            Message.unpack_frames([b'tcp://127.0.0.1:1', payload[:10]])
+        with self.assertRaises(ValueError):
+            Message.unpack_frames([b'tcp://127.0.0.1:1', b'\x02' + payload[1:]])
+        payload = Message(Message.REQ, 'upper.upper', body={}, headers={'trace_id': 'abc'}).pack_compact()
+        with self.assertRaises(ValueError):
+            Message.unpack_frames([b'tcp://127.0.0.1:1', payload[:-3]])
@@ -0,0 +1,56 @@
+import unittest
+
+import gevent
+
+from lymph.core.sendqueue import SendQueue
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.queue = SendQueue(self.send, max_size=3)
+
+    def send(self, endpoint, msgs):
+        self.sent.append((endpoint, list(msgs)))
+
+    def test_coalesce_per_endpoint(self):
+        self.queue.put('a', 1)
+        self.queue.put('b', 2)
+        self.queue.put('a', 3)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(len(self.queue), 3)
+        gevent.sleep(0)
+        self.assertEqual(self.sent, [('a', [1, 3]), ('b', [2])])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_flush_when_full(self):
+        for i in range(4):
+            self.queue.put('a', i)
+        self.assertEqual(self.sent, [('a', [0, 1, 2])])
+        gevent.sleep(0)
+        self.assertEqual(self.sent, [('a', [0, 1, 2]), ('a', [3])])
+
+    def test_max_delay(self):
+        self.queue.max_delay = .05
+        self.queue.put('a', 1)
+        gevent.sleep(0)
+        self.assertEqual(self.sent, [])
+        gevent.sleep(.1)
+        self.assertEqual(self.sent, [('a', [1])])
+
+    def test_close_flushes(self):
+        self.queue.put('a', 1)
+        self.queue.close()
+        self.assertEqual(self.sent, [('a', [1])])
+
+    def test_metrics(self):
+        for i in range(4):
+            self.queue.put('a', i)
+        self.queue.flush()
+        metrics = dict((name, value) for metric in self.queue._get_metrics() for name, value, tags in metric)
+        self.assertEqual(metrics, {
+            'rpc.send_queue.depth': 0,
+            'rpc.send_queue.max_flush_size': 3,
+            'rpc.send_queue.flushes': 2,
+            'rpc.send_queue.messages': 4,
+        })
@@ -1,4 +1,5 @@
 import logging
+import time
 import uuid
 
 import gevent
@@ -20,6 +21,9 @@ class GreenletWithTrace(gevent.Greenlet):
     def __init__(self, *args, **kwargs):
         super(GreenletWithTrace, self).__init__(*args, **kwargs)
         self._lymph_trace = get_trace().copy()
+        # Greenlets may outlive the request that spawned them, they only get
+        # its deadline with an explicit `set_deadline()`.
+        self._lymph_trace.pop('lymph_deadline', None)
 
 
 class Group(NonBlockingPool):
@@ -42,6 +46,23 @@ def get_id():
     return get_trace().get('lymph_trace_id')
 
 
+def set_deadline(deadline):
+    trace(lymph_deadline=deadline)
+
+
+def get_deadline(timeout=None):
+    """
+    Returns the deadline of the current trace as a `time.monotonic()` value,
+    or the time `timeout` seconds from now if that is earlier.
+    """
+    deadline = get_trace().get('lymph_deadline')
+    if timeout is not None:
+        limit = time.monotonic() + timeout
+        if deadline is None or limit < deadline:
+            return limit
+    return deadline
+
+
 class TraceFormatter(logging.Formatter):
     def format(self, record):
         record.trace_id = get_id()
@@ -14,7 +14,7 @@ class StaticServiceRegistryHub(object):
         try:
             instances = self.registry[service_name]
             for instance in instances:
-                service.update(instance.identity, endpoint=instance.endpoint)
+                service.update(instance.identity, endpoint=instance.endpoint, **instance.info)
         except KeyError:
             raise LookupFailure()
         return service
@@ -1,15 +1,22 @@
 from __future__ import absolute_import
 
+import collections
 import sys
+import time
 from contextlib import contextmanager
 
+import gevent.lock
+import gevent.queue
 import logging
 import kombu
 import kombu.mixins
 import kombu.pools
 
 from lymph.events.base import BaseEventSystem
-from lymph.core.events import Event
+from lymph.core.events import Event, EventBatch
+from lymph.core.monitoring import metrics
+from lymph.exceptions import PartialBatchFailure
+from lymph.utils import Histogram
 from lymph.utils.logging import setup_logger
 
 
@@ -19,61 +26,238 @@ logger = logging.getLogger(__name__)
 DEFAULT_SERIALIZER = 'lymph-msgpack'
 DEFAULT_EXCHANGE = 'lymph'
 
+RETRY_POLICY = {
+    'max_retries': 3,
+    'interval_start': 0,
+    'interval_step': 1,
+    'interval_max': 1,
+}
+
+# The maximum time in seconds to wait for the broker to confirm a batch.
+CONFIRM_TIMEOUT = 10
+
+# Tells the emitter greenlet to publish what it has and exit.
+_STOP = object()
+
+
+class PublisherConfirms(object):
+    """
+    Tracks the publisher confirms of an amqp channel. Published messages get
+    consecutive delivery tags, which the broker acks or nacks, possibly
+    several at once.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.delivery_tag = 0
+        self.unconfirmed = set()
+        self.nacked = set()
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self.on_ack)
+        channel.events['basic_nack'].add(self.on_nack)
+
+    @classmethod
+    def select(cls, channel):
+        """
+        Returns confirms for `channel`, or None if its transport doesn't
+        support them.
+        """
+        if not hasattr(channel, 'confirm_select'):
+            return None
+        return cls(channel)
+
+    def published(self):
+        self.delivery_tag += 1
+        self.unconfirmed.add(self.delivery_tag)
+        return self.delivery_tag
+
+    def _confirm(self, delivery_tag, multiple):
+        if multiple:
+            tags = set(tag for tag in self.unconfirmed if tag <= delivery_tag)
+        else:
+            tags = set([delivery_tag])
+        self.unconfirmed -= tags
+        return tags
+
+    def on_ack(self, delivery_tag, multiple):
+        self._confirm(delivery_tag, multiple)
+
+    def on_nack(self, delivery_tag, multiple, requeue=False):
+        self.nacked |= self._confirm(delivery_tag, multiple)
+
+    def wait(self, timeout=None):
+        """
+        Waits until all published messages are confirmed and returns the
+        delivery tags of the nacked ones.
+        """
+        while self.unconfirmed:
+            # Basic.Ack / Basic.Nack
+            self.channel.wait([(60, 80), (60, 120)], timeout=timeout)
+        nacked, self.nacked = self.nacked, set()
+        return nacked
+
 
 class EventConsumer(kombu.mixins.ConsumerMixin):
+    # How often the length of the queue is sampled, in seconds.
+    queue_length_interval = 10
+
     def __init__(self, event_system, connection, queue, handler):
         self.connection = connection
         self.queue = queue
         self.handler = handler
         self.greenlet = None
         self.event_system = event_system
+        self.in_flight = 0
+        # Handlers that wait for one of the `concurrency` running handlers to
+        # finish. There are at most `prefetch` unacknowledged messages, so
+        # this is bounded too.
+        self.waiting = collections.deque()
+        self.queue_length = None
+        self.sampler = None
+        self.batch = None
+        if handler.batch_size:
+            self.batch = EventBatch(self.on_batch, handler.batch_size, handler.batch_timeout)
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=[self.queue], callbacks=[self.on_kombu_message])]
+        consumer = Consumer(queues=[self.queue], callbacks=[self.on_kombu_message])
+        if self.handler.prefetch:
+            consumer.qos(prefetch_count=self.handler.prefetch)
+        return [consumer]
 
     def create_connection(self):
         return kombu.pools.connections[self.connection].acquire(block=True)
 
     def on_kombu_message(self, body, message):
         logger.debug("received kombu message %r", body)
+        if self.batch is not None:
+            self.batch.add((body, message))
+            return
 
         def message_handler():
             try:
                 event = Event.deserialize(body)
                 self.handler(event)
                 message.ack()
-            except:
+            except Exception:
                 logger.exception('failed to handle event from queue %r', self.handler.queue_name)
                 # FIXME: add requeue support here
                 message.reject()
                 # Since the message handler can be run sequentially, we are catching all exception
                 # and reporting them here.
                 self.event_system.container.error_hook(sys.exc_info())
+
+        self._run(message_handler)
+
+    def on_batch(self, items):
+        def batch_handler():
+            try:
+                events = [Event.deserialize(body) for body, message in items]
+                try:
+                    self.handler(events)
+                except PartialBatchFailure as e:
+                    logger.warning('failed to handle %s of %s events from queue %r', len(e.failed), len(events), self.handler.queue_name)
+                    failed = set(id(event) for event in e.failed)
+                    for event, (body, message) in zip(events, items):
+                        if id(event) in failed:
+                            message.reject()
+                        else:
+                            message.ack()
+                else:
+                    for body, message in items:
+                        message.ack()
+            except Exception:
+                logger.exception('failed to handle %s events from queue %r', len(items), self.handler.queue_name)
+                for body, message in items:
+                    message.reject()
+                self.event_system.container.error_hook(sys.exc_info())
+
+        self._run(batch_handler)
+
+    def _run(self, handler):
+        concurrency = self.handler.concurrency
+        if concurrency and self.in_flight >= concurrency:
+            self.waiting.append(handler)
+            return
+        self._start(handler)
+
+    def _start(self, handler):
+        def run():
+            try:
+                handler()
             finally:
+                self._release()
                 if self.handler.once:
                     self.event_system.unsubscribe(self.handler)
 
+        self.in_flight += 1
         if self.handler.sequential:
-            message_handler()
+            run()
         else:
-            self.event_system.container.spawn(message_handler)
+            try:
+                self.event_system.container.spawn(run)
+            except Exception:
+                self.in_flight -= 1
+                raise
+
+    def _release(self):
+        self.in_flight -= 1
+        if self.waiting and self.greenlet is not None:
+            self._start(self.waiting.popleft())
 
     def start(self):
         if self.greenlet:
             return
         self.should_stop = False
         self.greenlet = self.event_system.container.spawn(self.run)
+        self.sampler = self.event_system.container.spawn(self.sample_queue_length)
 
     def stop(self, **kwargs):
         if not self.greenlet:
             return
+        self.sampler.kill()
+        self.sampler = None
         self.should_stop = True
         self.greenlet.join()
         self.greenlet = None
+        # The broker redelivers these unacknowledged messages.
+        self.waiting.clear()
+        if self.batch is not None:
+            self.batch.clear()
+
+    def get_queue_length(self):
+        with kombu.pools.connections[self.connection].acquire(block=True) as conn:
+            return self.queue(conn).queue_declare(passive=True).message_count
+
+    def sample_queue_length(self):
+        while True:
+            try:
+                self.queue_length = self.get_queue_length()
+            except Exception:
+                logger.warning('cannot get the length of queue %r', self.queue.name, exc_info=True)
+                self.queue_length = None
+            gevent.sleep(self.queue_length_interval)
+
+    def _get_metrics(self):
+        tags = {'queue': self.queue.name}
+        yield metrics.RawMetric('events.consumer.in_flight', self.in_flight, tags)
+        yield metrics.RawMetric('events.consumer.waiting', len(self.waiting), tags)
+        if self.queue_length is not None:
+            yield metrics.RawMetric('events.queue.length', self.queue_length, tags)
 
 
 class KombuEventSystem(BaseEventSystem):
-    def __init__(self, connection, exchange_name, serializer=DEFAULT_SERIALIZER):
+    """
+    Events are published by a long-lived producer with its own connection.
+    With `batch_size` > 0 `emit()` only buffers the event, an emitter
+    greenlet publishes buffered events in batches of at most `batch_size`,
+    waiting at most `max_delay` seconds for a batch to fill up. On amqp
+    connections, the emitter waits once per batch for the broker to confirm
+    it, and publishes events that weren't confirmed again, so they may be
+    published more than once. If `max_pending` events are buffered, `emit()`
+    blocks until there is room again.
+    """
+
+    def __init__(self, connection, exchange_name, serializer=DEFAULT_SERIALIZER, batch_size=0, max_delay=0.01, max_pending=10000):
         super(KombuEventSystem, self).__init__()
         self.connection = connection
         self.exchange = kombu.Exchange(exchange_name, 'topic', durable=True)
@@ -81,19 +265,42 @@ class KombuEventSystem(BaseEventSystem):
         self.waiting_queues = {}
         self.serializer = serializer
         self.consumers_by_queue = {}
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = gevent.queue.Queue(maxsize=max_pending)
+        self.producer = None
+        self.producer_connection = None
+        self.confirms = None
+        self.stopping = False
+        self.producer_lock = gevent.lock.RLock()
+        self.emitter = None
+        self.emit_latency = Histogram(decay=10000)
+        self.max_batch_size = 0
+        self.emitted_count = metrics.Counter('events.emitted')
+        self.batch_count = metrics.Counter('events.emit.batches')
+        self.failed_count = metrics.Counter('events.emit.failed')
+        self.retry_count = metrics.Counter('events.emit.retries')
 
     def on_start(self):
         setup_logger('kombu')
+        self.stopping = False
 
     def on_stop(self, **kwargs):
         for consumer in self.consumers_by_queue.values():
             consumer.stop(**kwargs)
         self.consumers_by_queue.clear()
+        # Buffered events are retried at most `max_retries` times from now on.
+        self.stopping = True
+        self.flush()
+        self.close_producer()
 
     @classmethod
     def from_config(cls, config, **kwargs):
         exchange_name = config.get('exchange', DEFAULT_EXCHANGE)
         serializer = config.get('serializer', DEFAULT_SERIALIZER)
+        kwargs.setdefault('batch_size', config.get('batch_size', 0))
+        kwargs.setdefault('max_delay', config.get('max_delay', 0.01))
+        kwargs.setdefault('max_pending', config.get('max_pending', 10000))
         connection = kombu.Connection(**config)
         return cls(connection, exchange_name, serializer=serializer, **kwargs)
 
@@ -157,14 +364,136 @@ class KombuEventSystem(BaseEventSystem):
         self.waiting_queues[queue_name] = queue
         return queue
 
-    def emit(self, event, delay=0):
-        with self._get_connection() as conn:
-            producer = conn.Producer(serializer=self.serializer)
-            if delay:
+    def get_producer(self):
+        if self.producer is None:
+            self.producer_connection = self.connection.clone()
+            # The producer declares the exchange once, and again whenever it
+            # is revived after a connection error.
+            self.producer = kombu.Producer(self.producer_connection, exchange=self.exchange, serializer=self.serializer)
+            if self.batch_size:
+                self.confirms = PublisherConfirms.select(self.producer.channel)
+        return self.producer
+
+    def close_producer(self):
+        with self.producer_lock:
+            if self.producer_connection is not None:
+                self.producer_connection.release()
+            self.producer = None
+            self.producer_connection = None
+            self.confirms = None
+
+    def _publish(self, producer, event, delay, **kwargs):
+        if delay:
+            with self._get_connection() as conn:
                 queue = self._get_waiting_queue(conn, event.evt_type, delay)
-                routing_key = queue.name
-                exchange = self.waiting_exchange
+            routing_key = queue.name
+            exchange = self.waiting_exchange
+        else:
+            routing_key = event.evt_type
+            exchange = self.exchange
+        producer.publish(event.serialize(), routing_key=routing_key, exchange=exchange, **kwargs)
+
+    def publish(self, event, delay=0):
+        with self.producer_lock:
+            self._publish(self.get_producer(), event, delay, retry=True, retry_policy=RETRY_POLICY)
+
+    def publish_batch(self, items):
+        """
+        Publishes a batch of `(event, delay)` pairs, waits for the broker to
+        confirm them, and returns the pairs that were nacked.
+        """
+        with self.producer_lock:
+            producer = self.get_producer()
+            confirms = self.confirms
+            delivery_tags = {}
+            for item in items:
+                self._publish(producer, *item)
+                if confirms is not None:
+                    delivery_tags[confirms.published()] = item
+            if confirms is None:
+                return []
+            return [delivery_tags[tag] for tag in confirms.wait(timeout=CONFIRM_TIMEOUT) if tag in delivery_tags]
+
+    def emit(self, event, delay=0):
+        if self.batch_size:
+            if self.emitter is None:
+                self.emitter = self.container.spawn(self._emit_batches)
+            self.pending.put((event, delay, time.monotonic()))
+            return
+        start = time.monotonic()
+        self.publish(event, delay)
+        self.emit_latency.add(time.monotonic() - start)
+        self.emitted_count += 1
+
+    def _emit_batches(self):
+        while True:
+            item = self.pending.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.pending.get(timeout=max(0, deadline - time.monotonic()))
+                except gevent.queue.Empty:
+                    break
+                if item is _STOP:
+                    self._publish_batch(batch)
+                    return
+                batch.append(item)
+            self._publish_batch(batch)
+
+    def _publish_batch(self, batch):
+        items = [(event, delay) for event, delay, emitted_at in batch]
+        retries = 0
+        while True:
+            try:
+                items = self.publish_batch(items)
+            except Exception:
+                logger.exception('failed to publish %s events', len(items))
+                # Reconnect, the whole batch is published again.
+                self.close_producer()
             else:
-                routing_key = event.evt_type
-                exchange = self.exchange
-            producer.publish(event.serialize(), routing_key=routing_key, exchange=exchange, declare=[self.exchange])
+                if not items:
+                    break
+                logger.warning('%s events were nacked by the broker', len(items))
+            if self.stopping and retries >= RETRY_POLICY['max_retries']:
+                logger.error('dropping %s events', len(items))
+                self.failed_count += len(items)
+                break
+            self.retry_count += 1
+            gevent.sleep(min(RETRY_POLICY['interval_start'] + retries * RETRY_POLICY['interval_step'], RETRY_POLICY['interval_max']))
+            retries += 1
+        now = time.monotonic()
+        for event, delay, emitted_at in batch:
+            self.emit_latency.add(now - emitted_at)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.batch_count += 1
+        self.emitted_count += len(batch) - len(items)
+
+    def flush(self):
+        """
+        Publishes all buffered events.
+        """
+        if self.emitter is None or self.emitter.ready():
+            self.emitter = None
+            return
+        self.pending.put(_STOP)
+        self.emitter.join()
+        self.emitter = None
+
+    def _get_metrics(self):
+        for consumer in self.consumers_by_queue.values():
+            for metric in consumer._get_metrics():
+                yield metric
+        for p in (50, 99):
+            latency = self.emit_latency.percentile(p)
+            if latency is not None:
+                yield metrics.RawMetric('events.emit.latency', latency, {'percentile': str(p)})
+        if self.batch_size:
+            yield metrics.RawMetric('events.emit.pending', self.pending.qsize())
+            yield metrics.RawMetric('events.emit.max_batch_size', self.max_batch_size)
+            yield self.batch_count
+        yield self.emitted_count
+        yield self.failed_count
+        yield self.retry_count
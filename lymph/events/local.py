@@ -1,23 +1,49 @@
+import logging
+
 import gevent
 
-from lymph.core.events import EventDispatcher
+from lymph.core.events import EventBatch, EventDispatcher
 from lymph.events.base import BaseEventSystem
 
 
+logger = logging.getLogger(__name__)
+
+
 class LocalEventSystem(BaseEventSystem):
     def __init__(self, **kwargs):
         super(LocalEventSystem, self).__init__(**kwargs)
         self.dispatcher = EventDispatcher()
+        self.batches = {}
+
+    def on_stop(self, **kwargs):
+        for batch in list(self.batches.values()):
+            batch.flush()
 
     def subscribe(self, handler, **kwargs):
+        callback = handler
+        if handler.batch_size:
+            batch = EventBatch(lambda events: self.handle_batch(handler, events), handler.batch_size, handler.batch_timeout)
+            self.batches[handler] = batch
+            callback = batch.add
         for event_type in handler.event_types:
-            self.dispatcher.register(event_type, handler)
+            self.dispatcher.register(event_type, callback)
 
     def unsubscribe(self, handler):
-        raise NotImplementedError()
+        callback = handler
+        if handler in self.batches:
+            batch = self.batches.pop(handler)
+            batch.flush()
+            callback = batch.add
+        self.dispatcher.unregister(callback)
 
     def emit(self, event, delay=0):
         if delay:
             gevent.spawn_later(delay, self.dispatcher, event)
         else:
             self.dispatcher(event)
+
+    def handle_batch(self, handler, events):
+        try:
+            handler(events)
+        except Exception:
+            logger.exception('failed to handle a batch of %s events', len(events))
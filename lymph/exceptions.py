@@ -32,6 +32,17 @@ class EventHandlerTimeout(Exception):
     pass
 
 
+class PartialBatchFailure(Exception):
+    """
+    Raised by batch event handlers to reject the `failed` events of a batch
+    and acknowledge the others.
+    """
+
+    def __init__(self, failed, *args):
+        super(PartialBatchFailure, self).__init__(*args)
+        self.failed = failed
+
+
 class _RemoteException(type):
 
     # Hold dynamically generated exception classes.
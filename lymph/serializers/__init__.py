@@ -1 +1 @@
-from lymph.serializers.base import msgpack_serializer, json_serializer  # NOQA
+from lymph.serializers.base import msgpack_serializer, msgpack_ext_serializer, json_serializer, register_type, unregister_type, ExtensionTypeSerializer  # NOQA
@@ -2,7 +2,9 @@ import abc
 import datetime
 import decimal
 import functools
+import inspect
 import json
+import struct
 import uuid
 
 import pytz
@@ -12,8 +14,39 @@ import six
 from lymph.utils import Undefined
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+_UTC_EPOCH = pytz.utc.localize(_EPOCH)
+_int64 = struct.Struct('!q')
+_int32 = struct.Struct('!i')
+_datetime = struct.Struct('!qB')
+
+# Time zone field of binary datetimes, named time zones are followed by their
+# name.
+TZ_NAIVE = 0
+TZ_UTC = 1
+TZ_NAMED = 2
+
+_timezones = {}
+
+
+def _get_timezone(name):
+    try:
+        return _timezones[name]
+    except KeyError:
+        tzinfo = _timezones[name] = pytz.timezone(name)
+        return tzinfo
+
+
+def _timedelta_to_micros(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
 @six.add_metaclass(abc.ABCMeta)
 class ExtensionTypeSerializer(object):
+    # The msgpack ExtType code used for `pack()`ed objects, or None if the
+    # type has no binary representation.
+    ext_code = None
+
     @abc.abstractmethod
     def serialize(self, obj):
         raise NotImplementedError
@@ -22,9 +55,16 @@ class ExtensionTypeSerializer(object):
     def deserialize(self, obj):
         raise NotImplementedError
 
+    def pack(self, obj):
+        raise NotImplementedError
+
+    def unpack(self, data):
+        raise NotImplementedError
+
 
 class DatetimeSerializer(ExtensionTypeSerializer):
     format = '%Y-%m-%dT%H:%M:%SZ'
+    ext_code = 1
 
     def serialize(self, obj):
         result = obj.strftime(self.format)
@@ -42,9 +82,32 @@ class DatetimeSerializer(ExtensionTypeSerializer):
             return result
         return pytz.timezone(tzinfo).localize(result)
 
+    def pack(self, obj):
+        # Microseconds since the epoch (UTC for aware datetimes) and the
+        # time zone.
+        tzinfo = obj.tzinfo
+        if tzinfo is None:
+            return _datetime.pack(_timedelta_to_micros(obj - _EPOCH), TZ_NAIVE)
+        micros = _timedelta_to_micros(obj - _UTC_EPOCH)
+        if tzinfo is pytz.utc:
+            return _datetime.pack(micros, TZ_UTC)
+        return _datetime.pack(micros, TZ_NAMED) + str(tzinfo).encode('utf-8')
+
+    def unpack(self, data):
+        micros, tz = _datetime.unpack_from(data)
+        delta = datetime.timedelta(microseconds=micros)
+        if tz == TZ_NAIVE:
+            return _EPOCH + delta
+        result = _UTC_EPOCH + delta
+        if tz == TZ_UTC:
+            return result
+        tzinfo = _get_timezone(data[_datetime.size:].decode('utf-8'))
+        return result.astimezone(tzinfo)
+
 
 class DateSerializer(ExtensionTypeSerializer):
     format = '%Y-%m-%d'
+    ext_code = 2
 
     def serialize(self, obj):
         return obj.strftime(self.format)
@@ -52,9 +115,16 @@ class DateSerializer(ExtensionTypeSerializer):
     def deserialize(self, obj):
         return datetime.datetime.strptime(obj, self.format).date()
 
+    def pack(self, obj):
+        return _int32.pack(obj.toordinal())
+
+    def unpack(self, data):
+        return datetime.date.fromordinal(_int32.unpack(data)[0])
+
 
 class TimeSerializer(ExtensionTypeSerializer):
     format = '%H:%M:%SZ'
+    ext_code = 3
 
     def serialize(self, obj):
         return obj.strftime(self.format)
@@ -62,10 +132,20 @@ class TimeSerializer(ExtensionTypeSerializer):
     def deserialize(self, obj):
         return datetime.datetime.strptime(obj, self.format).time()
 
+    def pack(self, obj):
+        return _int64.pack(((obj.hour * 60 + obj.minute) * 60 + obj.second) * 1000000 + obj.microsecond)
+
+    def unpack(self, data):
+        seconds, micros = divmod(_int64.unpack(data)[0], 1000000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return datetime.time(hours, minutes, seconds, micros)
+
 
 class StrSerializer(ExtensionTypeSerializer):
-    def __init__(self, factory):
+    def __init__(self, factory, ext_code=None):
         self.factory = factory
+        self.ext_code = ext_code
 
     def serialize(self, obj):
         return str(obj)
@@ -73,6 +153,23 @@ class StrSerializer(ExtensionTypeSerializer):
     def deserialize(self, obj):
         return self.factory(obj)
 
+    def pack(self, obj):
+        return str(obj).encode('ascii')
+
+    def unpack(self, data):
+        return self.factory(data.decode('ascii'))
+
+
+class UUIDSerializer(StrSerializer):
+    def __init__(self):
+        super(UUIDSerializer, self).__init__(uuid.UUID, ext_code=5)
+
+    def pack(self, obj):
+        return obj.bytes
+
+    def unpack(self, data):
+        return uuid.UUID(bytes=bytes(data))
+
 
 class SetSerializer(ExtensionTypeSerializer):
     def serialize(self, obj):
@@ -83,22 +180,93 @@ class SetSerializer(ExtensionTypeSerializer):
 
 
 class UndefinedSerializer(ExtensionTypeSerializer):
+    ext_code = 6
+
     def serialize(self, obj):
         return ''
 
     def deserialize(self, obj):
         return Undefined
 
+    def pack(self, obj):
+        return b''
+
+    def unpack(self, data):
+        return Undefined
+
 
-_extension_type_serializers = {
-    'datetime': DatetimeSerializer(),
-    'date': DateSerializer(),
-    'time': TimeSerializer(),
-    'Decimal': StrSerializer(decimal.Decimal),
-    'UUID': StrSerializer(uuid.UUID),
-    'set': SetSerializer(),
-    'UndefinedType': UndefinedSerializer(),
-}
+# Registered types and (name, serializer) pairs.
+_type_serializers = {}
+# Serializers by the name used in the dict form and by ExtType code.
+_extension_type_serializers = {}
+_ext_code_serializers = {}
+# The result of `get_type_serializer()` per type, including misses.
+_dispatch_cache = {}
+
+# Returned by `get_type_serializer()` for types with a `_lymph_dump_` method.
+LYMPH_DUMP = object()
+
+
+def register_type(cls, serializer, name=None):
+    """
+    Registers an `ExtensionTypeSerializer` for `cls` and its subclasses.
+    Objects are serialized as `{'__type__': name, '_': ...}` dicts, or as
+    msgpack ExtTypes if the serializer has an `ext_code`. `name` defaults to
+    the name of `cls` and has to be the same for all services.
+    """
+    name = name or cls.__name__
+    if serializer.ext_code is not None:
+        registered = _ext_code_serializers.get(serializer.ext_code)
+        if registered is not None and registered is not serializer:
+            raise ValueError('ext code %s is already used by %r' % (serializer.ext_code, registered))
+        _ext_code_serializers[serializer.ext_code] = serializer
+    _type_serializers[cls] = (name, serializer)
+    _extension_type_serializers[name] = serializer
+    _dispatch_cache.clear()
+
+
+def unregister_type(cls):
+    """
+    Removes the serializer registered for `cls` with `register_type()`, if
+    there is one.
+    """
+    try:
+        name, serializer = _type_serializers.pop(cls)
+    except KeyError:
+        return
+    if _extension_type_serializers.get(name) is serializer:
+        del _extension_type_serializers[name]
+    if serializer.ext_code is not None and _ext_code_serializers.get(serializer.ext_code) is serializer:
+        del _ext_code_serializers[serializer.ext_code]
+    _dispatch_cache.clear()
+
+
+def get_type_serializer(obj_type):
+    """
+    Returns the `(name, serializer)` registered for `obj_type` or its closest
+    base class, `LYMPH_DUMP` if the type implements `_lymph_dump_`, or None.
+    """
+    try:
+        return _dispatch_cache[obj_type]
+    except KeyError:
+        pass
+    for cls in inspect.getmro(obj_type):
+        result = _type_serializers.get(cls)
+        if result is not None:
+            break
+    else:
+        result = LYMPH_DUMP if hasattr(obj_type, '_lymph_dump_') else None
+    _dispatch_cache[obj_type] = result
+    return result
+
+
+register_type(datetime.datetime, DatetimeSerializer())
+register_type(datetime.date, DateSerializer())
+register_type(datetime.time, TimeSerializer())
+register_type(decimal.Decimal, StrSerializer(decimal.Decimal, ext_code=4))
+register_type(uuid.UUID, UUIDSerializer())
+register_type(set, SetSerializer())
+register_type(type(Undefined), UndefinedSerializer())
 
 
 class BaseSerializer(object):
@@ -109,16 +277,16 @@ class BaseSerializer(object):
         self._dump = dump
 
     def dump_object(self, obj):
-        obj_type = type(obj)
-        serializer = _extension_type_serializers.get(obj_type.__name__)
-        if serializer:
-            obj = {
-                '__type__': obj_type.__name__,
-                '_': serializer.serialize(obj),
-            }
-        elif hasattr(obj, '_lymph_dump_'):
-            obj = obj._lymph_dump_()
-        return obj
+        entry = get_type_serializer(type(obj))
+        if entry is None:
+            return obj
+        if entry is LYMPH_DUMP:
+            return obj._lymph_dump_()
+        name, serializer = entry
+        return {
+            '__type__': name,
+            '_': serializer.serialize(obj),
+        }
 
     def load_object(self, obj):
         obj_type = obj.get('__type__')
@@ -140,11 +308,41 @@ class BaseSerializer(object):
         return self._load(f, object_hook=self.load_object)
 
 
-msgpack_serializer = BaseSerializer(
-    dumps=functools.partial(msgpack.dumps, use_bin_type=True),
-    loads=functools.partial(msgpack.loads, encoding='utf-8'),
-    dump=functools.partial(msgpack.dump, use_bin_type=True),
-    load=functools.partial(msgpack.load, encoding='utf-8'),
-)
+class MsgpackSerializer(BaseSerializer):
+    """
+    With `ext_types` enabled, objects of extension types that have a binary
+    representation are encoded as msgpack ExtTypes instead of
+    `{'__type__': ..., '_': ...}` dicts. Both forms are always decoded.
+    """
+
+    def __init__(self, ext_types=False):
+        super(MsgpackSerializer, self).__init__(
+            dumps=functools.partial(msgpack.dumps, use_bin_type=True),
+            loads=functools.partial(msgpack.loads, encoding='utf-8', ext_hook=self.load_ext),
+            dump=functools.partial(msgpack.dump, use_bin_type=True),
+            load=functools.partial(msgpack.load, encoding='utf-8', ext_hook=self.load_ext),
+        )
+        self.ext_types = ext_types
+
+    def dump_object(self, obj):
+        if self.ext_types:
+            entry = get_type_serializer(type(obj))
+            if entry is not None and entry is not LYMPH_DUMP:
+                name, serializer = entry
+                if serializer.ext_code is not None:
+                    return msgpack.ExtType(serializer.ext_code, serializer.pack(obj))
+        return super(MsgpackSerializer, self).dump_object(obj)
+
+    def load_ext(self, code, data):
+        try:
+            serializer = _ext_code_serializers[code]
+        except KeyError:
+            return msgpack.ExtType(code, data)
+        return serializer.unpack(data)
+
+
+msgpack_serializer = MsgpackSerializer()
+
+msgpack_ext_serializer = MsgpackSerializer(ext_types=True)
 
 json_serializer = BaseSerializer(dumps=json.dumps, loads=json.loads, dump=json.dump, load=json.load)
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 
 from kombu.serialization import BytesIO
 
-from lymph.serializers.base import msgpack_serializer, json_serializer
+from lymph.serializers.base import msgpack_serializer, msgpack_ext_serializer, json_serializer
 
 
 def _load_msgpack(s):
@@ -15,3 +15,5 @@ def _load_json(s):
 
 json_serializer_args = (json_serializer.dumps, _load_json, 'application/lymph+json', 'utf-8')
 msgpack_serializer_args = (msgpack_serializer.dumps, _load_msgpack, 'application/lymph+x-msgpack', 'binary')
+# Consumers decode extension types with either content type.
+msgpack_ext_serializer_args = (msgpack_ext_serializer.dumps, _load_msgpack, 'application/lymph+x-msgpack-ext', 'binary')
@@ -186,3 +186,120 @@ class SerializerBaseTest(unittest.TestCase):
     def test_undefined(self):
         self.assertJsonEquals(self.json_serializer.dumps(Undefined), {'__type__': 'UndefinedType', '_': ''})
         self.assertIs(self.json_serializer.loads('{"__type__": "UndefinedType", "_": ""}'), Undefined)
+
+
+class MsgpackSerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.serializer = base.MsgpackSerializer(ext_types=True)
+        self.legacy_serializer = base.MsgpackSerializer()
+
+    def assertRoundtrip(self, obj):
+        self.assertEqual(self.serializer.loads(self.serializer.dumps(obj)), obj)
+
+    def test_ext_types(self):
+        berlin = pytz.timezone('Europe/Berlin')
+        self.assertRoundtrip(datetime.datetime(2014, 9, 12, 8, 33, 12, 34))
+        self.assertRoundtrip(datetime.datetime(1900, 1, 1))
+        self.assertRoundtrip(pytz.utc.localize(datetime.datetime(2014, 9, 12, 8, 33, 12, 34)))
+        self.assertRoundtrip(datetime.date(2014, 9, 12))
+        self.assertRoundtrip(datetime.time(8, 33, 12, 34))
+        self.assertRoundtrip(decimal.Decimal('3.1415'))
+        self.assertRoundtrip(uuid.UUID('00000000-0000-4000-8000-000000000000'))
+        self.assertRoundtrip(set([datetime.date(2014, 9, 12)]))
+        self.assertIs(self.serializer.loads(self.serializer.dumps(Undefined)), Undefined)
+
+        dt = berlin.localize(datetime.datetime(2014, 9, 12, 8, 33, 12))
+        loaded = self.serializer.loads(self.serializer.dumps(dt))
+        self.assertEqual(loaded, dt)
+        self.assertEqual(str(loaded.tzinfo), 'Europe/Berlin')
+        self.assertEqual(loaded.utcoffset(), dt.utcoffset())
+
+    def test_ext_types_are_smaller(self):
+        payload = {'created_at': datetime.datetime(2014, 9, 12), 'id': uuid.uuid4()}
+        self.assertLess(len(self.serializer.dumps(payload)), len(self.legacy_serializer.dumps(payload)))
+
+    def test_decode_both_forms(self):
+        payload = {'created_at': datetime.datetime(2014, 9, 12, 8, 33, 12), 'price': decimal.Decimal('2.50')}
+        self.assertEqual(self.serializer.loads(self.legacy_serializer.dumps(payload)), payload)
+        self.assertEqual(self.legacy_serializer.loads(self.serializer.dumps(payload)), payload)
+
+
+class Money(object):
+    def __init__(self, amount, currency):
+        self.amount = amount
+        self.currency = currency
+
+    def __eq__(self, other):
+        return (self.amount, self.currency) == (other.amount, other.currency)
+
+
+class MoneySerializer(base.ExtensionTypeSerializer):
+    def serialize(self, obj):
+        return [str(obj.amount), obj.currency]
+
+    def deserialize(self, obj):
+        return Money(decimal.Decimal(obj[0]), obj[1])
+
+
+class TypeRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.serializer = base.MsgpackSerializer()
+
+    def tearDown(self):
+        base.unregister_type(Money)
+
+    def test_register_type(self):
+        base.register_type(Money, MoneySerializer(), name='test.Money')
+        money = Money(decimal.Decimal('2.50'), 'EUR')
+        self.assertEqual(base.json_serializer.dump_object(money), {'__type__': 'test.Money', '_': ['2.50', 'EUR']})
+        self.assertEqual(self.serializer.loads(self.serializer.dumps({'price': money})), {'price': money})
+
+    def test_subclasses(self):
+        class Timestamp(datetime.datetime):
+            pass
+
+        class MyMoney(Money):
+            pass
+
+        base.register_type(Money, MoneySerializer(), name='test.Money')
+        self.assertEqual(
+            base.json_serializer.dump_object(Timestamp(2014, 9, 12, 8, 33, 12)),
+            {'__type__': 'datetime', '_': '2014-09-12T08:33:12Z'},
+        )
+        self.assertEqual(
+            self.serializer.loads(self.serializer.dumps(MyMoney(decimal.Decimal('1'), 'EUR'))),
+            Money(decimal.Decimal('1'), 'EUR'),
+        )
+
+    def test_dispatch_cache(self):
+        class Dumpable(object):
+            def _lymph_dump_(self):
+                return 'dumped'
+
+        class Unknown(object):
+            pass
+
+        self.assertIs(base.get_type_serializer(Dumpable), base.LYMPH_DUMP)
+        self.assertEqual(self.serializer.loads(self.serializer.dumps(Dumpable())), 'dumped')
+        self.assertIsNone(base.get_type_serializer(Unknown))
+        self.assertIn(Unknown, base._dispatch_cache)
+        base.register_type(Unknown, MoneySerializer(), name='test.Unknown')
+        self.addCleanup(base.unregister_type, Unknown)
+        self.assertEqual(base.get_type_serializer(Unknown)[0], 'test.Unknown')
+
+    def test_unregister_type(self):
+        serializer = MoneySerializer()
+        serializer.ext_code = 42
+        base.register_type(Money, serializer, name='test.Money')
+        self.assertIsNotNone(base.get_type_serializer(Money))
+        base.unregister_type(Money)
+        self.assertIsNone(base.get_type_serializer(Money))
+        self.assertNotIn('test.Money', base._extension_type_serializers)
+        self.assertNotIn(42, base._ext_code_serializers)
+        base.unregister_type(Money)
+
+    def test_ext_code_conflict(self):
+        serializer = MoneySerializer()
+        serializer.ext_code = base.DatetimeSerializer.ext_code
+        with self.assertRaises(ValueError):
+            base.register_type(Money, serializer)
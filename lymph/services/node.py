@@ -23,9 +23,24 @@ class Process(object):
         self._process = None
         self._popen = None
 
+    @property
+    def pid(self):
+        if self._process is not None:
+            return self._process.pid
+
     def is_running(self):
         return self._process and self._process.is_running()
 
+    def is_dead(self):
+        """
+        Returns whether the process exited or became a zombie.
+        """
+        try:
+            status = self._process.status()
+        except psutil.NoSuchProcess:
+            return True
+        return status in (psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD)
+
     def start(self):
         self._popen = subprocess.Popen(
             self.cmd, env=self.env, close_fds=False)
@@ -121,15 +136,8 @@ class Node(Interface):
     def watch_processes(self):
         while True:
             for process in self.processes:
-                try:
-                    status = process._process.status()
-                except psutil.NoSuchProcess:
-                    if self.running:
-                        process.start()
-                    continue
-                if status in (psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD):
-                    if self.running:
-                        process.restart()
+                if process.is_dead() and self.running:
+                    process.restart()
             gevent.sleep(1)
 
     def _get_metrics(self):
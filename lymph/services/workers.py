@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import time
+
+import gevent
+import six
+from six.moves import range
+
+from lymph.core.channels import ForwardChannel, get_stream_subject, STALE_CHANNEL_TIMEOUT
+from lymph.core.decorators import rpc
+from lymph.core.interfaces import Interface
+from lymph.core.monitoring.metrics import RawMetric, TaggedCounter
+from lymph.core.services import ServiceInstance
+from lymph.exceptions import RegistrationFailure, Timeout, Nack
+from lymph.services.node import Process
+
+
+logger = logging.getLogger(__name__)
+
+# Worker processes find the endpoints of their front in this variable.
+WORKER_FRONT_ENV = 'LYMPH_WORKER_FRONT'
+
+# The name of the `WorkerFront` interface.
+FRONT_NAME = '_workers'
+
+# Requests for these subjects are handled by the front itself.
+FRONT_SUBJECTS = frozenset(['lymph.ping', 'lymph.status', 'lymph.get_metrics'])
+
+
+class WorkerFront(Interface):
+    """
+    Runs `numprocesses` worker processes with `command` and forwards the
+    requests it receives to them, preferring the worker with the fewest
+    outstanding requests. The front registers the interfaces of its workers
+    as a single service instance.
+    """
+
+    register_with_coordinator = False
+
+    def __init__(self, *args, **kwargs):
+        super(WorkerFront, self).__init__(*args, **kwargs)
+        self.command = None
+        self.numprocesses = 0
+        self.register = True
+        self.processes = []
+        self.running = False
+        # Worker endpoints in the order the workers joined, and their pids.
+        self.endpoints = []
+        self.pids = {}
+        self.registered = False
+        self.local_subjects = FRONT_SUBJECTS
+        self.forwarded_counts = TaggedCounter('rpc.forwarded')
+        self._next = 0
+
+    def apply_config(self, config):
+        super(WorkerFront, self).apply_config(config)
+        self.command = config.get('command')
+        self.numprocesses = config.get('numprocesses', 0)
+        self.register = config.get('register', True)
+
+    def on_start(self):
+        super(WorkerFront, self).on_start()
+        self.local_subjects = FRONT_SUBJECTS | set('%s.%s' % (self.name, name) for name in self.methods)
+        self.container.server.workers = self
+        self.running = True
+        env = os.environ.copy()
+        env[WORKER_FRONT_ENV] = json.dumps(self.container.server.endpoints)
+        for i in range(self.numprocesses):
+            process = Process(self.command, env=env, service_type='worker')
+            self.processes.append(process)
+            process.start()
+        if self.processes:
+            self.container.spawn(self.watch_processes)
+
+    def on_stop(self, **kwargs):
+        self.running = False
+        for process in self.processes:
+            process.stop(**kwargs)
+        super(WorkerFront, self).on_stop(**kwargs)
+
+    def watch_processes(self):
+        while True:
+            for process in self.processes:
+                if process.is_dead() and self.running:
+                    logger.warning('worker died (pid=%s)', process.pid)
+                    self.remove_worker(process.pid)
+                    process.restart()
+            gevent.sleep(1)
+
+    @rpc()
+    def add_worker(self, endpoint, pid=None, interfaces=None):
+        """
+        Called by worker processes once they handle requests.
+        """
+        if endpoint not in self.pids:
+            logger.info('worker joined: %s (pid=%s)', endpoint, pid)
+            self.endpoints.append(endpoint)
+        self.pids[endpoint] = pid
+        if interfaces and self.register and not self.registered:
+            self.registered = True
+            self.register_interfaces(interfaces)
+
+    def remove_worker(self, pid):
+        for endpoint, worker_pid in list(self.pids.items()):
+            if worker_pid == pid:
+                del self.pids[endpoint]
+                self.endpoints.remove(endpoint)
+                self.container.server.disconnect(endpoint, socket=True)
+
+    def register_interfaces(self, interfaces):
+        # The description of the front without interface specific parts.
+        front = self.container.get_instance_description(self)
+        for name, description in six.iteritems(interfaces):
+            description.update(front)
+            try:
+                self.container.service_registry.register(name, ServiceInstance(**description))
+            except RegistrationFailure:
+                logger.error("registration failed %s", name)
+
+    def pick(self):
+        """
+        Returns the endpoint of a live worker with the fewest outstanding
+        requests, or None. Ties are broken round robin.
+        """
+        server = self.container.server
+        n = len(self.endpoints)
+        best, best_load = None, None
+        for i in range(n):
+            endpoint = self.endpoints[(self._next + i) % n]
+            connection = server.connect(endpoint)
+            if not connection.is_alive():
+                continue
+            load = len(connection.outstanding_requests)
+            if best is None or load < best_load:
+                best, best_load = endpoint, load
+        self._next += 1
+        return best
+
+    def forward(self, msg, deadline=None):
+        """
+        Forwards the request `msg` to a worker, unless the front handles it
+        itself. Returns True if the request was forwarded (or shed because
+        there is no worker).
+        """
+        if msg.subject in self.local_subjects:
+            return False
+        server = self.container.server
+        endpoint = self.pick()
+        if endpoint is None:
+            server.shed_request(msg, 'no_worker')
+            return True
+        stale_at = deadline or time.monotonic() + STALE_CHANNEL_TIMEOUT
+        channel = ForwardChannel(msg, server, endpoint, stale_at)
+        server.channels[msg.id] = channel
+        if 'stream' in msg.headers:
+            server.channels[get_stream_subject(msg.id)] = channel
+        server.timeouts.schedule(stale_at, channel)
+        headers = None
+        if deadline is not None:
+            # The request may have waited in the front, pass on the time left.
+            headers = dict(msg.headers, timeout=max(0, deadline - time.monotonic()))
+        server.forward_message(endpoint, msg, headers=headers)
+        self.forwarded_counts.incr(worker=endpoint)
+        return True
+
+    def _get_metrics(self):
+        connections = self.container.server.connections
+        alive, outstanding = 0, 0
+        for endpoint in self.endpoints:
+            connection = connections.get(endpoint)
+            if connection is None:
+                continue
+            tags = {'worker': endpoint}
+            load = len(connection.outstanding_requests)
+            yield RawMetric('rpc.worker.outstanding', load, tags)
+            yield RawMetric('rpc.worker.latency', connection.latency_ewma, tags)
+            alive += connection.is_alive()
+            outstanding += load
+        yield RawMetric('rpc.workers', alive)
+        yield RawMetric('rpc.workers.outstanding', outstanding)
+        yield self.forwarded_counts
+
+
+def join_front(container, endpoints, timeout=1, retry_delay=1, interval=10):
+    """
+    Announces the worker `container` to the front at `endpoints` (the first
+    one being its tcp endpoint), retrying until the front replies. The worker
+    announces itself again every `interval` seconds, so that a restarted
+    front learns about it.
+    """
+    endpoint = endpoints[0]
+    container.server.add_route(endpoint, endpoints)
+    container.metrics_aggregator.add_tags(front=endpoint)
+    body = {
+        'endpoint': container.endpoint,
+        'pid': os.getpid(),
+        'interfaces': {
+            name: container.get_instance_description(interface)
+            for name, interface in six.iteritems(container.installed_interfaces)
+            if interface.register_with_coordinator
+        },
+    }
+    while not _announce(container, endpoint, body, timeout):
+        logger.warning('front %s not reachable, retrying in %ss', endpoint, retry_delay)
+        gevent.sleep(retry_delay)
+    container.spawn(_rejoin_front, container, endpoint, body, timeout, interval)
+
+
+def _announce(container, endpoint, body, timeout):
+    try:
+        container.send_request(endpoint, '%s.add_worker' % FRONT_NAME, body).get(timeout=timeout)
+    except (Timeout, Nack):
+        return False
+    return True
+
+
+def _rejoin_front(container, endpoint, body, timeout, interval):
+    while True:
+        gevent.sleep(interval)
+        if not _announce(container, endpoint, body, timeout):
+            logger.warning('front %s not reachable', endpoint)
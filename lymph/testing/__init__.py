@@ -134,7 +134,7 @@ class LymphIntegrationTestCase(KazooTestHarness):
     def create_event_system(self, **kwargs):
         return self.events
 
-    def create_container(self, interface_cls=None, interface_name=None, events=None, registry=None, **kwargs):
+    def create_container(self, interface_cls=None, interface_name=None, events=None, registry=None, rpc=None, **kwargs):
         if not events:
             events = self.create_event_system(**kwargs)
         if not registry:
@@ -142,7 +142,7 @@ class LymphIntegrationTestCase(KazooTestHarness):
         container = ServiceContainer(
             events=events,
             registry=registry,
-            rpc=ZmqRPCServer(),
+            rpc=rpc or ZmqRPCServer(),
             **kwargs)
         interface = None
         if interface_cls:
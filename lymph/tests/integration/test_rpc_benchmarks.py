@@ -0,0 +1,20 @@
+import json
+import unittest
+
+from lymph.benchmarks.rpc import SCENARIOS, run
+
+
+class RPCBenchmarksTest(unittest.TestCase):
+    def test_run(self):
+        results = run(n=20, concurrency=2, instances=2, payload_size=1024)
+        self.assertEqual(sorted(results['scenarios']), sorted(SCENARIOS))
+        for result in results['scenarios'].values():
+            self.assertGreater(result['requests_per_second'], 0)
+            self.assertGreater(result['greenlet_switches'], 0)
+            self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99.9'])
+        json.dumps(results)
+
+    def test_run_scenario_with_rpc_options(self):
+        results = run(n=10, concurrency=2, instances=1, scenarios=['echo'], wire_format='compact', send_queue=True)
+        self.assertEqual(list(results['scenarios']), ['echo'])
+        self.assertEqual(results['rpc'], {'wire_format': 'compact', 'send_queue': True})
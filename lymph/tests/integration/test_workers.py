@@ -0,0 +1,104 @@
+import os
+
+import gevent
+
+import lymph
+from lymph.core.interfaces import Proxy
+from lymph.core.rpc import ZmqRPCServer
+from lymph.discovery.static import StaticServiceRegistryHub
+from lymph.events.null import NullEventSystem
+from lymph.exceptions import Nack
+from lymph.services.workers import WorkerFront, FRONT_NAME, join_front
+from lymph.testing import LymphIntegrationTestCase
+
+
+class Upper(lymph.Interface):
+    @lymph.rpc()
+    def upper(self, text=None):
+        return text.upper()
+
+    @lymph.rpc(stream=True)
+    def split(self, text=None):
+        for word in text.split():
+            yield word.upper()
+
+    @lymph.rpc()
+    def endpoint(self, delay=0):
+        gevent.sleep(delay)
+        return self.container.endpoint
+
+    @lymph.raw_rpc()
+    def time_left(self, channel):
+        channel.reply(channel.request.headers.get('timeout'))
+
+
+class WorkerFrontTest(LymphIntegrationTestCase):
+    def setUp(self):
+        super(WorkerFrontTest, self).setUp()
+        self.events = NullEventSystem()
+        self.discovery_hub = StaticServiceRegistryHub()
+        self.front_container, self.front = self.create_container(WorkerFront, FRONT_NAME, rpc=ZmqRPCServer(transports=('tcp', 'ipc')))
+        self.workers = [self.create_worker() for i in range(2)]
+        self.client = self.create_client()
+
+    def create_registry(self, **kwargs):
+        return self.discovery_hub.create_registry()
+
+    def create_worker(self, **kwargs):
+        # Workers are only reachable through the front.
+        registry = StaticServiceRegistryHub().create_registry()
+        container, interface = self.create_container(Upper, 'upper', registry=registry, rpc=ZmqRPCServer(transports=('tcp', 'ipc')))
+        join_front(container, self.front_container.server.endpoints, **kwargs)
+        return container
+
+    def test_register_front_as_single_instance(self):
+        instances = self.discovery_hub.registry['upper']
+        self.assertEqual([instance.endpoint for instance in instances], [self.front_container.endpoint])
+        self.assertEqual(self.front.endpoints, [worker.endpoint for worker in self.workers])
+
+    def test_forward_request(self):
+        reply = self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.body, 'FOO')
+        self.assertEqual(reply.source, self.front_container.endpoint)
+        self.assertEqual(self.front_container.server.channels, {})
+
+    def test_forward_stream(self):
+        text = ' '.join('word%s' % i for i in range(100))
+        proxy = Proxy(self.client.container, 'upper')
+        self.assertEqual(list(proxy.split.stream(text=text)), text.upper().split())
+
+    def test_spread_load(self):
+        proxy = Proxy(self.client.container, 'upper')
+        results = [gevent.spawn(proxy.endpoint, delay=.05) for i in range(6)]
+        gevent.joinall(results)
+        endpoints = [result.value for result in results]
+        for worker in self.workers:
+            self.assertEqual(endpoints.count(worker.endpoint), 3)
+
+    def test_front_subjects(self):
+        reply = self.client.request('upper', 'lymph.status', {})
+        self.assertEqual(reply.body['endpoint'], self.front_container.endpoint)
+        reply = self.client.request('upper', 'lymph.get_metrics', {})
+        metrics = {name: value for name, value, tags in reply.body if 'worker' not in tags}
+        self.assertEqual(metrics['rpc.workers'], 2)
+        reply = self.client.request('upper', 'lymph.inspect', {})
+        self.assertIn('upper.upper', [method['name'] for method in reply.body['methods']])
+
+    def test_forward_time_left(self):
+        reply = self.client.container.send_request('upper', 'upper.time_left', {}, headers={'timeout': 5}).get()
+        self.assertLess(reply.body, 5)
+        self.assertGreater(reply.body, 4)
+
+    def test_rejoin_front(self):
+        worker = self.create_worker(interval=.05)
+        # All workers of this test run in this process.
+        self.front.remove_worker(os.getpid())
+        gevent.sleep(.2)
+        self.assertEqual(self.front.endpoints, [worker.endpoint])
+
+    def test_no_worker(self):
+        # All workers of this test run in this process.
+        self.front.remove_worker(os.getpid())
+        self.assertEqual(self.front.endpoints, [])
+        with self.assertRaises(Nack):
+            self.client.request('upper', 'upper.upper', {'text': 'foo'})
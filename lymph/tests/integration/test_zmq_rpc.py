@@ -0,0 +1,201 @@
+import os
+
+import gevent
+import mock
+
+import lymph
+from lymph.core.hedging import HedgePolicy
+from lymph.core.interfaces import Proxy
+from lymph.core.messages import CLASSIC, COMPACT, WIRE_FORMATS
+from lymph.core.rpc import ZmqRPCServer
+from lymph.core.container import ServiceContainer
+from lymph.discovery.static import StaticServiceRegistryHub
+from lymph.events.null import NullEventSystem
+from lymph.testing import LymphIntegrationTestCase
+from lymph.utils.sockets import get_unused_port
+
+
+class Upper(lymph.Interface):
+    @lymph.rpc()
+    def upper(self, text=None):
+        return text.upper()
+
+    @lymph.rpc(stream=True)
+    def split(self, text=None):
+        for word in text.split():
+            yield word.upper()
+
+
+class ShoutingUpper(Upper):
+    def handle_request(self, func_name, channel):
+        channel.request.body['text'] += '!'
+        super(ShoutingUpper, self).handle_request(func_name, channel)
+
+
+class Endpoint(lymph.Interface):
+    delays = {}
+
+    @lymph.rpc(idempotent=True)
+    def endpoint(self):
+        gevent.sleep(self.delays.get(self.container.endpoint, 0))
+        return self.container.endpoint
+
+
+class ZmqRPCIntegrationTest(LymphIntegrationTestCase):
+    def setUp(self):
+        super(ZmqRPCIntegrationTest, self).setUp()
+        self.events = NullEventSystem()
+        self.discovery_hub = StaticServiceRegistryHub()
+        self.upper_container, interface = self.create_container(Upper, 'upper')
+        self.lymph_client = self.create_client()
+
+    def create_registry(self, **kwargs):
+        return self.discovery_hub.create_registry()
+
+    def test_upper(self):
+        reply = self.lymph_client.request('upper', 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.body, 'FOO')
+
+    def test_buffer_messages_until_peer_is_reachable(self):
+        port = get_unused_port()
+        container = ServiceContainer(rpc=ZmqRPCServer(port=port), registry=self.create_registry(), events=self.events)
+        container.install_interface(Upper, name='upper')
+        self._containers.append(container)
+
+        endpoint = 'tcp://127.0.0.1:%s' % port
+        channel = self.lymph_client.container.send_request(endpoint, 'upper.upper', {'text': 'foo'})
+        self.assertEqual(len(self.lymph_client.container.server.pending[endpoint]), 1)
+        gevent.sleep(.1)
+        container.start()
+        self.assertEqual(channel.get().body, 'FOO')
+        self.assertEqual(self.lymph_client.container.server.pending, {})
+
+    def create_rpc_pair(self, client_format, server_format):
+        server, interface = self.create_container(Upper, 'upper', rpc=ZmqRPCServer(wire_format=server_format))
+        client, interface = self.create_container(rpc=ZmqRPCServer(wire_format=client_format))
+        self.rpc_client = client
+        for i in range(2):
+            reply = client.send_request(server.endpoint, 'upper.upper', {'text': 'foo'}).get()
+            self.assertEqual(reply.body, 'FOO')
+        return client.server.connections[server.endpoint], server.server.connections[client.endpoint]
+
+    def test_negotiate_compact_wire_format(self):
+        client_connection, server_connection = self.create_rpc_pair(COMPACT, COMPACT)
+        self.assertEqual(client_connection.wire_format, COMPACT)
+        self.assertEqual(server_connection.wire_format, COMPACT)
+
+    def test_compact_wire_format_with_classic_peers(self):
+        for client_format, server_format in [(COMPACT, CLASSIC), (CLASSIC, COMPACT)]:
+            client_connection, server_connection = self.create_rpc_pair(client_format, server_format)
+            self.assertEqual(client_connection.wire_format, CLASSIC)
+            self.assertEqual(server_connection.wire_format, CLASSIC)
+
+    def test_peer_falls_back_to_classic_wire_format(self):
+        client_connection, server_connection = self.create_rpc_pair(COMPACT, COMPACT)
+        # The server restarts as a classic service.
+        server = server_connection.server
+        server.wire_format = CLASSIC
+        server_connection.wire_format = CLASSIC
+        client = client_connection.server
+        reply = client.send_request(server.endpoint, 'upper.upper', {'text': 'foo'}).get()
+        self.assertEqual(reply.body, 'FOO')
+        self.assertEqual(client_connection.wire_format, CLASSIC)
+
+    def test_intern_subjects(self):
+        client_connection, server_connection = self.create_rpc_pair(COMPACT, COMPACT)
+        server = server_connection.server
+        self.assertEqual(client_connection.subject_table, server.subjects.epoch)
+        self.assertEqual(
+            client_connection.subject_ids['upper.upper'],
+            (server.subjects.ids['upper.upper'], server.subjects.epoch))
+
+    def test_stale_subject_ids(self):
+        client_connection, server_connection = self.create_rpc_pair(COMPACT, COMPACT)
+        client = client_connection.server
+        stale_epoch = server_connection.server.subjects.epoch % 0xffffffff + 1
+        client_connection.learn_subjects(stale_epoch, {'upper.upper': 1})
+        # The request is sent again with its subject.
+        reply = client.send_request(server_connection.server.endpoint, 'upper.upper', {'text': 'foo'}).get()
+        self.assertEqual(reply.body, 'FOO')
+        self.assertEqual(client_connection.subject_table, server_connection.server.subjects.epoch)
+        self.assertNotEqual(client_connection.subject_ids.get('upper.upper'), (1, stale_epoch))
+
+    def test_handle_request_override_with_compact_wire_format(self):
+        server, interface = self.create_container(ShoutingUpper, 'upper', rpc=ZmqRPCServer(wire_format=COMPACT))
+        client, interface = self.create_container(rpc=ZmqRPCServer(wire_format=COMPACT))
+        for i in range(3):
+            reply = client.send_request(server.endpoint, 'upper.upper', {'text': 'foo'}).get()
+            self.assertEqual(reply.body, 'FOO!')
+        self.assertIn('upper.upper', client.server.connections[server.endpoint].subject_ids)
+
+    def test_stale_subject_ids_batch(self):
+        client_connection, server_connection = self.create_rpc_pair(COMPACT, COMPACT)
+        stale_epoch = server_connection.server.subjects.epoch % 0xffffffff + 1
+        client_connection.learn_subjects(stale_epoch, {'upper.upper': 1})
+        proxy = Proxy(self.rpc_client, server_connection.server.endpoint, namespace='upper')
+        with proxy.batch() as batch:
+            batch.proxy.upper(text='foo')
+            batch.proxy.upper(text='bar')
+        self.assertEqual(batch.get(), ['FOO', 'BAR'])
+        self.assertEqual(proxy.upper.map([{'text': 'baz'}]), ['BAZ'])
+
+    def test_stale_subject_ids_hedge(self):
+        slow, interface = self.create_container(Endpoint, 'endpoint', rpc=ZmqRPCServer(wire_format=COMPACT))
+        fast, interface = self.create_container(Endpoint, 'endpoint', rpc=ZmqRPCServer(wire_format=COMPACT))
+        client, interface = self.create_container(rpc=ZmqRPCServer(wire_format=COMPACT))
+        for container in (slow, fast):
+            for i in range(2):
+                client.send_request(container.endpoint, 'endpoint.endpoint', {}).get()
+        # The fast instance restarted.
+        connection = client.server.connections[fast.endpoint]
+        connection.learn_subjects(fast.server.subjects.epoch % 0xffffffff + 1, {'endpoint.endpoint': 1})
+        Endpoint.delays = {slow.endpoint: .5}
+        self.addCleanup(setattr, Endpoint, 'delays', {})
+        policy = HedgePolicy(subjects=['endpoint.endpoint'])
+        policy.delays['endpoint.endpoint'] = .01
+        proxy = Proxy(client, 'endpoint', hedge=policy, timeout=2)
+        with mock.patch.object(client.server.balancer, 'pick', return_value=slow.endpoint):
+            self.assertEqual(proxy.endpoint(), fast.endpoint)
+        counts = dict((tags['result'], count) for name, count, tags in policy.hedge_counts)
+        self.assertEqual(counts, {'sent': 1, 'won': 1})
+
+    def test_stream(self):
+        text = ' '.join('word%s' % i for i in range(100))
+        for wire_format in WIRE_FORMATS:
+            server, interface = self.create_container(Upper, 'upper', rpc=ZmqRPCServer(wire_format=wire_format))
+            client, interface = self.create_container(rpc=ZmqRPCServer(wire_format=wire_format))
+            proxy = Proxy(client, server.endpoint, namespace='upper')
+            self.assertEqual(list(proxy.split.stream(text=text)), text.upper().split())
+
+    def create_local_pair(self, client_transports, server_transports, name='local'):
+        server, interface = self.create_container(Upper, name, rpc=ZmqRPCServer(transports=server_transports))
+        client, interface = self.create_container(rpc=ZmqRPCServer(transports=client_transports))
+        reply = client.send_request(name, '%s.upper' % name, {'text': 'foo'}).get()
+        self.assertEqual(reply.body, 'FOO')
+        return client.server, server.server
+
+    def test_ipc_transport(self):
+        client, server = self.create_local_pair(('tcp', 'ipc'), ('tcp', 'ipc'))
+        self.assertEqual([e.split('://')[0] for e in server.endpoints], ['tcp', 'ipc'])
+        self.assertEqual(client.routes, {server.endpoint: server.endpoints[1]})
+        self.assertEqual(server.routes, {client.endpoint: client.endpoints[1]})
+
+    def test_inproc_transport(self):
+        client, server = self.create_local_pair(('tcp', 'ipc', 'inproc'), ('tcp', 'ipc', 'inproc'))
+        self.assertEqual(client.routes, {server.endpoint: server.endpoints[2]})
+        self.assertEqual(server.routes, {client.endpoint: client.endpoints[2]})
+
+    def test_local_transports_fall_back_to_tcp(self):
+        client, server = self.create_local_pair(('tcp',), ('tcp', 'ipc'))
+        self.assertEqual(client.routes, {})
+        self.assertEqual(server.routes, {})
+        client, server = self.create_local_pair(('tcp', 'ipc'), ('tcp',), name='tcp_only')
+        self.assertEqual(client.routes, {})
+        self.assertEqual(server.routes, {})
+
+    def test_remove_ipc_socket_on_stop(self):
+        container, interface = self.create_container(rpc=ZmqRPCServer(transports=('tcp', 'ipc')))
+        path = container.server.endpoints[1].split('://')[1]
+        self.assertTrue(os.path.exists(path))
+        container.stop()
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,184 @@
+import collections
+import unittest
+import uuid
+
+import gevent
+import gevent.event
+import gevent.pool
+import kombu
+
+from lymph.core.components import Componentized
+from lymph.core.events import Event, EventHandler
+from lymph.core.interfaces import Interface
+from lymph.exceptions import PartialBatchFailure
+from lymph.events.kombu import KombuEventSystem, PublisherConfirms
+
+
+class KombuEmitTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = kombu.Connection('memory://')
+        self.container = Componentized(pool=gevent.pool.Group(), error_hook=lambda exc_info: None)
+        # The memory transport keeps its state per process.
+        self.exchange_name = 'test-%s' % uuid.uuid4()
+        self.queue = kombu.Queue(self.exchange_name, exchange=kombu.Exchange(self.exchange_name, 'topic', durable=True), routing_key='foo.*')
+        self.queue(self.connection).declare()
+
+    def tearDown(self):
+        self.queue(self.connection).delete()
+
+    def create_event_system(self, **kwargs):
+        events = KombuEventSystem(self.connection, self.exchange_name, **kwargs)
+        self.container.add_component(events)
+        events.install(self.container)
+        return events
+
+    def get_published(self):
+        bodies = []
+        while True:
+            message = self.queue(self.connection).get(no_ack=True)
+            if message is None:
+                return bodies
+            bodies.append(Event.deserialize(message.payload).body)
+
+    def get_metrics(self, events):
+        return dict((name, value) for metric in events._get_metrics() for name, value, tags in metric if not tags)
+
+    def test_emit(self):
+        events = self.create_event_system()
+        events.emit(Event('foo.bar', {'n': 1}))
+        producer = events.producer
+        events.emit(Event('foo.bar', {'n': 2}))
+        self.assertIs(events.producer, producer)
+        self.assertEqual(self.get_published(), [{'n': 1}, {'n': 2}])
+        self.assertEqual(self.get_metrics(events)['events.emitted'], 2)
+
+    def test_batched_emit(self):
+        events = self.create_event_system(batch_size=10, max_delay=1)
+        for i in range(25):
+            events.emit(Event('foo.bar', {'n': i}))
+        self.assertEqual(self.get_published(), [])
+        gevent.sleep(0.1)
+        self.assertEqual(self.get_published(), [{'n': i} for i in range(20)])
+        events.on_stop()
+        self.assertEqual(self.get_published(), [{'n': i} for i in range(20, 25)])
+        metrics = self.get_metrics(events)
+        self.assertEqual(metrics['events.emitted'], 25)
+        self.assertEqual(metrics['events.emit.batches'], 3)
+        self.assertEqual(metrics['events.emit.max_batch_size'], 10)
+        self.assertEqual(metrics['events.emit.pending'], 0)
+
+    def test_batched_emit_blocks_when_full(self):
+        events = self.create_event_system(batch_size=10, max_pending=5)
+        emitter = gevent.spawn(lambda: [events.emit(Event('foo.bar', {'n': i})) for i in range(20)])
+        gevent.sleep(0)
+        self.assertFalse(emitter.ready())
+        self.assertLessEqual(events.pending.qsize(), 5)
+        emitter.join(timeout=1)
+        events.flush()
+        self.assertEqual(self.get_published(), [{'n': i} for i in range(20)])
+
+    def test_batched_emit_retries_failed_batches(self):
+        events = self.create_event_system(batch_size=10)
+        publish_batch = events.publish_batch
+        failures = [Exception('connection lost'), None]
+
+        def failing_publish_batch(items):
+            if not failures:
+                return publish_batch(items)
+            failure = failures.pop(0)
+            if failure:
+                raise failure
+            # The first event is nacked.
+            publish_batch(items[1:])
+            return items[:1]
+
+        events.publish_batch = failing_publish_batch
+        for i in range(3):
+            events.emit(Event('foo.bar', {'n': i}))
+        events.flush()
+        self.assertEqual(self.get_published(), [{'n': 1}, {'n': 2}, {'n': 0}])
+        metrics = self.get_metrics(events)
+        self.assertEqual(metrics['events.emitted'], 3)
+        self.assertEqual(metrics['events.emit.retries'], 2)
+        self.assertEqual(metrics['events.emit.failed'], 0)
+
+    def test_consume_with_concurrency(self):
+        events = self.create_event_system()
+        interface = Interface(self.container, 'test')
+        running, handled = [], []
+        done = gevent.event.Event()
+
+        def on_foo(interface, event):
+            running.append(event)
+            handled.append(len(running))
+            done.wait()
+            running.remove(event)
+
+        self.assertEqual(EventHandler(interface, on_foo, ['foo.bar'], concurrency=2).prefetch, 2)
+        handler = EventHandler(interface, on_foo, ['foo.bar'], queue_name=self.exchange_name, concurrency=2, prefetch=4)
+        consumer = events.subscribe(handler, consume=False)
+        consumer.queue_length_interval = 0.1
+        consumer.start()
+        for i in range(5):
+            events.emit(Event('foo.bar', {'n': i}))
+        gevent.sleep(0.5)
+        self.assertEqual(len(running), 2)
+        metrics = dict(((name, tags.get('queue')), value) for metric in events._get_metrics() for name, value, tags in metric)
+        queue_name = 'test-%s' % self.exchange_name
+        self.assertEqual(metrics['events.consumer.in_flight', queue_name], 2)
+        self.assertEqual(metrics['events.consumer.waiting', queue_name], 2)
+        self.assertEqual(metrics['events.queue.length', queue_name], 1)
+        done.set()
+        gevent.sleep(0.5)
+        consumer.stop()
+        self.assertEqual(len(handled), 5)
+        self.assertEqual(max(handled), 2)
+        self.assertEqual(consumer.in_flight, 0)
+
+    def test_consume_batches(self):
+        events = self.create_event_system()
+        interface = Interface(self.container, 'test')
+        batches = []
+
+        def on_foo(interface, events):
+            batches.append([event.body['n'] for event in events])
+            raise PartialBatchFailure([event for event in events if event.body['n'] == 1])
+
+        handler = EventHandler(interface, on_foo, ['foo.bar'], queue_name=self.exchange_name, batch_size=2, batch_timeout=0.1)
+        consumer = events.subscribe(handler)
+        for i in range(3):
+            events.emit(Event('foo.bar', {'n': i}))
+        gevent.sleep(1.5)
+        consumer.stop()
+        # The rejected event isn't requeued.
+        self.assertEqual(batches, [[0, 1], [2]])
+        self.assertEqual(consumer.get_queue_length(), 0)
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.events = collections.defaultdict(set)
+        self.confirms = []
+
+    def confirm_select(self):
+        pass
+
+    def wait(self, allowed_methods, timeout=None):
+        method, args = self.confirms.pop(0)
+        for callback in self.events[method]:
+            callback(*args)
+
+
+class PublisherConfirmsTest(unittest.TestCase):
+    def test_wait_for_batch(self):
+        channel = FakeChannel()
+        confirms = PublisherConfirms(channel)
+        tags = [confirms.published() for i in range(4)]
+        self.assertEqual(tags, [1, 2, 3, 4])
+        channel.confirms = [('basic_ack', (2, True)), ('basic_nack', (3, False, False)), ('basic_ack', (4, False))]
+        self.assertEqual(confirms.wait(), {3})
+        self.assertEqual(channel.confirms, [])
+        self.assertEqual(confirms.unconfirmed, set())
+
+    def test_unsupported_transport(self):
+        self.assertIsNone(PublisherConfirms.select(object()))
@@ -1,8 +1,16 @@
+import time
+import unittest
+
+import gevent
+
 import lymph
-from lymph.core.interfaces import Interface
+from lymph.core.admission import AdmissionController, ConcurrencyLimit
+from lymph.core.channels import STREAM_WINDOW, MULTI_CALL_MAX_SIZE
+from lymph.core.hedging import HedgePolicy
+from lymph.core.interfaces import Interface, Proxy
 from lymph.core.messages import Message
-from lymph.testing import RPCServiceTestCase
-from lymph.exceptions import RemoteError, Nack
+from lymph.testing import MockServiceNetwork, RPCServiceTestCase
+from lymph.exceptions import RemoteError, Nack, Timeout
 
 
 class Upper(Interface):
@@ -26,10 +34,33 @@ class Upper(Interface):
     def fail(self):
         raise ValueError('foobar')
 
+    @lymph.rpc(stream=True, raises=(ValueError,))
+    def count(self, n=0, fail_at=None):
+        for i in range(n):
+            if i == fail_at:
+                raise ValueError('failed at %s' % i)
+            self.eventlog.append(('count', i))
+            yield i
+
     @lymph.raw_rpc()
     def just_ack(self, channel):
         channel.ack()
 
+    @lymph.raw_rpc()
+    def time_left(self, channel):
+        channel.reply(channel.request.headers.get('timeout'))
+
+    @lymph.rpc()
+    def nested_time_left(self):
+        return self.proxy('upper', timeout=10).time_left()
+
+    @lymph.rpc()
+    def background_upper(self, text=None, delay=0):
+        def run():
+            gevent.sleep(delay)
+            self.eventlog.append(('background', self.proxy('upper').upper(text=text)))
+        self.spawn(run)
+
     @lymph.rpc()
     def auto_nack(self):
         raise ValueError('auto nack requested')
@@ -38,6 +69,10 @@ class Upper(Interface):
     def on_foo_event(self, event):
         self.eventlog.append((event.evt_type, event.body))
 
+    @lymph.event('bar.*', batch_size=3, batch_timeout=0.05)
+    def on_bar_events(self, events):
+        self.eventlog.append([event.body for event in events])
+
 
 class BasicMockTest(RPCServiceTestCase):
 
@@ -61,6 +96,7 @@ class BasicMockTest(RPCServiceTestCase):
         self.assertEqual(reply.body, {
             'endpoint': 'mock://300.0.0.1:1',
             'identity': '252946e723b6b07c1f5f0aa9442fb348',
+            'circuit_breakers': [],
         })
 
     def test_error(self):
@@ -80,6 +116,97 @@ class BasicMockTest(RPCServiceTestCase):
         with self.assertRaises(Nack):
             self.client.auto_nack()
 
+    def test_stream(self):
+        self.assertEqual(list(self.client.count.stream(n=100)), list(range(100)))
+        self.assertEqual(self.container.server.channels, {})
+
+    def test_stream_flow_control(self):
+        chunks = self.client.count.stream(n=100)
+        self.assertEqual(next(chunks), 0)
+        gevent.sleep(0.01)
+        # The server doesn't produce more chunks than the consumer allows.
+        self.assertEqual(len(self.service.eventlog), STREAM_WINDOW)
+        chunks.close()
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.service.eventlog), STREAM_WINDOW)
+        self.assertEqual(self.container.server.channels, {})
+
+    def test_stream_error(self):
+        chunks = self.client.count.stream(n=10, fail_at=5)
+        with self.assertRaises(RemoteError.ValueError):
+            for i in chunks:
+                self.assertLess(i, 5)
+
+    def test_stream_without_streaming_request(self):
+        self.assertEqual(self.client.count(n=3), [0, 1, 2])
+
+    def test_batch_event_handler(self):
+        for i in range(4):
+            self.emit('bar.baz', {'n': i})
+        self.assertEqual(self.service.eventlog, [[{'n': 0}, {'n': 1}, {'n': 2}]])
+        gevent.sleep(0.1)
+        self.assertEqual(self.service.eventlog, [[{'n': 0}, {'n': 1}, {'n': 2}], [{'n': 3}]])
+
+    def test_batch(self):
+        with self.client.batch() as batch:
+            batch.proxy.upper(text='foo')
+            batch.proxy.fail()
+            batch.proxy.upper(text='bar')
+        results = batch.get(return_exceptions=True)
+        self.assertEqual(results[0], 'FOO')
+        self.assertIsInstance(results[1], RemoteError.ValueError)
+        self.assertEqual(results[2], 'BAR')
+        with self.assertRaises(RemoteError.ValueError):
+            batch.get()
+        self.assertEqual(self.container.server.channels, {})
+
+    def test_map(self):
+        texts = [{'text': 'foo%s' % i} for i in range(10)]
+        self.assertEqual(self.client.upper.map(texts), ['FOO%s' % i for i in range(10)])
+
+    def test_multi_call(self):
+        texts = [{'text': 'foo'}, {'text': None}, {'text': 'bar'}]
+        results = self.client.upper.map(texts, multi=True, return_exceptions=True)
+        self.assertEqual(results[0], 'FOO')
+        self.assertIsInstance(results[1], Nack)
+        self.assertEqual(results[2], 'BAR')
+        with self.client.batch(multi=True) as batch:
+            batch.proxy.upper(text='foo')
+            batch.proxy.fail()
+            batch.proxy.just_ack()
+            batch.proxy.upper(text='bar')
+        results = batch.get(return_exceptions=True)
+        self.assertEqual(results[0], 'FOO')
+        self.assertIsInstance(results[1], RemoteError.ValueError)
+        self.assertEqual(results[2:], [None, 'BAR'])
+        self.assertEqual(self.client.count.map([{'n': 2}], multi=True), [[0, 1]])
+
+    def test_deadline(self):
+        self.assertLessEqual(self.get_proxy(timeout=2).time_left(), 2)
+        self.assertLessEqual(self.get_proxy(timeout=.5).nested_time_left(), .5)
+
+    def test_background_greenlet_outlives_deadline(self):
+        self.get_proxy(timeout=.05).background_upper(text='foo', delay=.1)
+        gevent.sleep(.2)
+        self.assertEqual(self.service.eventlog, [('background', 'FOO')])
+
+    def test_multi_call_deadline(self):
+        self.assertLessEqual(self.get_proxy(timeout=.5).nested_time_left.map([{}], multi=True)[0], .5)
+
+    def test_expired_request(self):
+        channel = self.container.send_request('upper', 'upper.upper', {'text': 'foo'}, headers={'timeout': 0})
+        self.assertRaises(Timeout, channel.get, timeout=.1)
+        self.assertEqual(list(self.container.server.expired_request_counts), [('rpc.expired', 1, {'subject': 'upper.upper'})])
+
+    def test_load_shedding(self):
+        server = self.container.server
+        server.admission = AdmissionController(server, max_queue_size=0, limit=ConcurrencyLimit(initial=1))
+        self.assertEqual(self.client.upper(text='foo'), 'FOO')
+        server.admission.running = 1
+        self.assertRaises(Nack, self.client.upper, text='foo')
+        self.assertEqual(self.request('lymph.ping', {'payload': 42}).body, 42)
+        self.assertEqual(list(server.shed_request_counts), [('rpc.shed', 1, {'reason': 'queue_full'})])
+
     def test_events(self):
         log = self.service.eventlog
         self.assertEqual(log, [])
@@ -93,7 +220,145 @@ class BasicMockTest(RPCServiceTestCase):
         methods = proxy.inspect()['methods']
 
         self.assertEqual(set(m['name'] for m in methods), set([
-            'upper.fail', 'upper.upper', 'upper.auto_nack', 'upper.just_ack',
+            'upper.fail', 'upper.upper', 'upper.auto_nack', 'upper.just_ack', 'upper.count',
+            'upper.time_left', 'upper.nested_time_left', 'upper.background_upper',
             'lymph.status', 'lymph.inspect', 'lymph.ping', 'upper.indirect_upper',
             'lymph.get_metrics',
         ]))
+
+
+class Slow(Interface):
+    delays = {}
+    broken = ()
+
+    def sleep(self):
+        gevent.sleep(self.delays.get(self.container.endpoint, 0))
+        return self.container.endpoint
+
+    @lymph.rpc(idempotent=True)
+    def get(self):
+        return self.sleep()
+
+    @lymph.rpc()
+    def put(self):
+        return self.sleep()
+
+    @lymph.rpc()
+    def check(self):
+        if self.container.endpoint in self.broken:
+            raise ValueError('broken')
+        return self.container.endpoint
+
+
+class SlowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.slow = self.network.add_service(Slow, interface_name='slow')
+        self.fast = self.network.add_service(Slow, interface_name='slow')
+        self.client = self.network.add_service(Upper, interface_name='upper')
+        self.network.start()
+        Slow.delays = {self.slow.endpoint: .5}
+        Slow.broken = ()
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+
+class HedgingTest(SlowTestCase):
+    def get_proxy(self, **kwargs):
+        policy = HedgePolicy(**kwargs)
+        policy.delays.update({'slow.get': .01, 'slow.put': .01})
+        proxy = Proxy(self.client, 'slow', hedge=policy, timeout=1)
+        # The proxy learns which methods are idempotent.
+        delays, Slow.delays = Slow.delays, {}
+        proxy.check()
+        gevent.sleep(.01)
+        Slow.delays = delays
+        return proxy, policy
+
+    def get_hedge_counts(self, policy):
+        return dict((tags['result'], count) for name, count, tags in policy.hedge_counts)
+
+    def test_hedge(self):
+        proxy, policy = self.get_proxy()
+        for i in range(10):
+            start = time.monotonic()
+            self.assertEqual(proxy.get(), self.fast.endpoint)
+            self.assertLess(time.monotonic() - start, .2)
+        counts = self.get_hedge_counts(policy)
+        self.assertGreater(counts['sent'], 0)
+        self.assertEqual(counts['won'], counts['sent'])
+        self.assertEqual(self.client.server.channels, {})
+
+    def test_hedge_rate_limit(self):
+        proxy, policy = self.get_proxy(max_rate=0, burst=1)
+        Slow.delays = {self.slow.endpoint: .05, self.fast.endpoint: .05}
+        for i in range(4):
+            proxy.get()
+        counts = self.get_hedge_counts(policy)
+        self.assertEqual((counts['sent'], counts['throttled']), (1, 3))
+
+    def test_non_idempotent_method(self):
+        proxy, policy = self.get_proxy()
+        self.assertIn('slow.get', policy.subjects)
+        Slow.delays = {self.slow.endpoint: .05, self.fast.endpoint: .05}
+        proxy.put()
+        self.assertEqual(self.get_hedge_counts(policy), {})
+
+    def test_opt_in_non_idempotent_method(self):
+        # The service rejects hedges of methods that aren't idempotent.
+        proxy, policy = self.get_proxy(subjects=['slow.put'])
+        Slow.delays = {self.slow.endpoint: .05, self.fast.endpoint: .05}
+        proxy.put()
+        self.assertIn('slow.put', policy.disabled)
+        self.assertEqual(self.get_hedge_counts(policy), {'sent': 1, 'rejected': 1})
+        proxy.put()
+        self.assertEqual(self.get_hedge_counts(policy), {'sent': 1, 'rejected': 1})
+
+
+class CircuitBreakerTest(SlowTestCase):
+    def test_skip_broken_instance(self):
+        Slow.broken = (self.slow.endpoint,)
+        proxy = Proxy(self.client, 'slow')
+        failures = 0
+        for i in range(30):
+            try:
+                proxy.check()
+            except Nack:
+                failures += 1
+        self.assertEqual(failures, 5)
+        status = self.client.server.breakers.get_status()
+        self.assertEqual([(s['endpoint'], s['state']) for s in status], [(self.slow.endpoint, 'open')])
+
+
+class ProxyBatchTest(SlowTestCase):
+    def test_methods_named_like_batch_attributes(self):
+        Slow.delays = {}
+        with Proxy(self.client, 'slow').batch() as batch:
+            batch.proxy.get()
+            batch.proxy.put()
+        self.assertEqual(len(batch.get()), 2)
+
+    def test_multi_call_concurrency(self):
+        Slow.delays = {self.slow.endpoint: .05}
+        self.slow.server.multi_call_concurrency = 2
+        proxy = Proxy(self.client, self.slow.endpoint, namespace='slow')
+        start = time.monotonic()
+        self.assertEqual(proxy.get.map([{}] * 6, multi=True), [self.slow.endpoint] * 6)
+        self.assertGreaterEqual(time.monotonic() - start, .15)
+
+    def test_multi_call_max_size(self):
+        Slow.delays = {}
+        proxy = Proxy(self.client, self.slow.endpoint, namespace='slow')
+        n = MULTI_CALL_MAX_SIZE + 1
+        self.assertEqual(proxy.get.map([{}] * n, multi=True), [self.slow.endpoint] * n)
+        channel = self.client.send_request(self.slow.endpoint, 'slow.get', {'calls': [{}] * n}, headers={'multi': True})
+        self.assertRaises(Nack, channel.get)
+
+    def test_multi_call_concurrency_with_admission(self):
+        server = self.slow.server
+        server.admission = AdmissionController(server, limit=ConcurrencyLimit(initial=3))
+        self.assertEqual(server.get_multi_call_concurrency(), 4)
+        server.admission.running = 3
+        self.assertEqual(server.get_multi_call_concurrency(), 1)
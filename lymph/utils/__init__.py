@@ -121,6 +121,59 @@ class SampleWindow(Accumulator):
         return 1 - math.erf(abs(value * self.factor - self.mean) / (self.stddev * _sqrt2))
 
 
+class Histogram(object):
+    """
+    Counts values in logarithmic buckets, each `precision` wider than the
+    previous one, so percentiles have a bounded relative error like in an
+    HdrHistogram. With `decay`, all counts are halved every `decay` values
+    and percentiles follow recent values.
+    """
+
+    def __init__(self, min_value=1e-6, precision=0.05, decay=None):
+        self.min_value = min_value
+        self.decay = decay
+        self.counts = collections.defaultdict(float)
+        self.n = 0
+        self.total = 0
+        self._log_base = math.log(1 + precision)
+
+    def __len__(self):
+        return self.total
+
+    def _get_bucket(self, value):
+        if value <= self.min_value:
+            return 0
+        return int(math.log(value / self.min_value) / self._log_base) + 1
+
+    def _get_value(self, bucket):
+        # The upper bound of the bucket.
+        return self.min_value * math.exp(bucket * self._log_base)
+
+    def add(self, value):
+        self.counts[self._get_bucket(value)] += 1
+        self.n += 1
+        self.total += 1
+        if self.decay and not self.total % self.decay:
+            for bucket in self.counts:
+                self.counts[bucket] /= 2
+            self.n /= 2
+
+    def percentile(self, p):
+        """
+        Returns the smallest bucket bound that is greater than `p` percent of
+        the values, or None if there are no values.
+        """
+        if not self.n:
+            return None
+        rank = self.n * p / 100
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self._get_value(bucket)
+        return self._get_value(bucket)
+
+
 def get_greenlets():
     for object in gc.get_objects():
         if isinstance(object, gevent.Greenlet):
@@ -1,53 +1,93 @@
 from __future__ import absolute_import
 from datetime import (date, datetime)
+import itertools
+import json
 import logging
+import operator
 import six
 import uuid
 
+import gevent
+
+from lymph.core.events import EventBatch
+from lymph.utils import make_id
+
 
 logger = logging.getLogger(__name__)
 
+# Bulk items that failed with these statuses are retried.
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
 
 class EventIndex(object):
     def __init__(self, es, index_name='events'):
         self.es = es
         self.index_name = index_name
+        self.preparers = self.compile_preparers()
+
+    def compile_preparers(self):
+        """
+        Returns a dict that maps types to their key prefix and a function
+        that converts their values, or None.
+        """
+        preparers = {}
+        for types, type_prefix, convert in [
+            ((bool,), 'b', None),
+            (six.integer_types, 'i', None),
+            (six.string_types, 's', None),
+            ((float,), 'f', None),
+            ((dict,), 'o', self.prepare_object),
+            ((list,), 'l', None),
+            ((datetime, date), 'd', None),
+            ((uuid.UUID,), 'u', operator.attrgetter('hex')),
+        ]:
+            for cls in types:
+                preparers[cls] = (type_prefix, convert)
+        return preparers
+
+    def get_preparer(self, cls):
+        try:
+            return self.preparers[cls]
+        except KeyError:
+            pass
+        # Subclasses are prepared like their closest base class.
+        for base in getattr(cls, '__mro__', ())[1:]:
+            if base in self.preparers:
+                preparer = self.preparers[cls] = self.preparers[base]
+                return preparer
+        raise TypeError('cannot index values of type %s' % cls)
 
     def prepare_object(self, data):
         return dict(self.prepare_value(key, value)
                     for key, value in six.iteritems(data))
 
     def prepare_value(self, key, value):
-        if isinstance(value, bool):
-            type_prefix = 'b'
-        elif isinstance(value, six.integer_types):
-            type_prefix = 'i'
-        elif isinstance(value, six.string_types):
-            type_prefix = 's'
-        elif isinstance(value, float):
-            type_prefix = 'f'
-        elif isinstance(value, dict):
-            type_prefix = 'o'
-            value = self.prepare_object(value)
-        elif isinstance(value, list):
-            type_prefix = 'l'
-        elif isinstance(value, (datetime, date)):
-            type_prefix = 'd'
-        elif isinstance(value, uuid.UUID):
-            type_prefix = 'u'
-            value = value.hex
-        else:
-            raise TypeError('cannot index values of type %s' % type(value))
+        type_prefix, convert = self.get_preparer(type(value))
+        if convert is not None:
+            value = convert(value)
         return ('%s_%s' % (type_prefix, key)), value
 
-    def index(self, event, index_name=None):
-        event_id = uuid.uuid4().hex
+    def prepare_event(self, event):
         body = self.prepare_object(event.body)
         body.update({
             'type': event.evt_type,
             'source': event.source,
             'logged_at': datetime.utcnow(),
         })
+        return body
+
+    def get_index_name(self, dt):
+        return self.index_name
+
+    def index(self, event, index_name=None):
+        event_id = uuid.uuid4().hex
+        body = self.prepare_event(event)
         self.es.index(
             index=index_name or self.index_name,
             doc_type='event',
@@ -57,6 +97,11 @@ class EventIndex(object):
 
 
 class DatedEventIndex(EventIndex):
+    def __init__(self, *args, **kwargs):
+        super(DatedEventIndex, self).__init__(*args, **kwargs)
+        self._index_date = None
+        self._dated_index_name = None
+
     def create_index_alias(self):
         if self.es.indices.exists_alias(self.index_name):
             logger.info('index alias already exists')
@@ -66,9 +111,85 @@ class DatedEventIndex(EventIndex):
         )
 
     def get_index_name(self, dt):
-        return '%s-%s' % (self.index_name, dt.strftime('%Y.%m.%d'))
+        day = dt.date()
+        if day != self._index_date:
+            self._dated_index_name = '%s-%s' % (self.index_name, dt.strftime('%Y.%m.%d'))
+            self._index_date = day
+        return self._dated_index_name
 
     def index(self, event, index_name=None):
         index_name = self.get_index_name(datetime.now())
         super(DatedEventIndex, self).index(event, index_name)
 
+
+class BulkEventIndexer(object):
+    """
+    Indexes events of `index` (an :class:`EventIndex`) with the bulk API.
+    Prepared documents are buffered and written once there are `max_size`
+    of them, once they take `max_bytes`, or at the latest `max_age` seconds
+    after the first one was buffered. Documents that are rejected with a
+    retryable status are written again up to `max_retries` times, with an
+    exponential backoff starting at `backoff` seconds.
+    """
+
+    def __init__(self, index, max_size=500, max_bytes=5 * 1024 * 1024, max_age=1, max_retries=3, backoff=0.1):
+        self.index = index
+        self.es = index.es
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch = EventBatch(self.write, max_size, max_age)
+        self.buffered_bytes = 0
+        self.failed_count = 0
+        # Documents get ids when they are buffered, so retries don't
+        # duplicate them.
+        self._id_prefix = make_id()
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self.batch)
+
+    def add(self, event):
+        body = self.index.prepare_event(event)
+        action = {'index': {
+            '_index': self.index.get_index_name(datetime.now()),
+            '_type': 'event',
+            '_id': '%s-%s' % (self._id_prefix, next(self._ids)),
+        }}
+        lines = '%s\n%s\n' % (json.dumps(action), json.dumps(body, default=_json_default))
+        self.buffered_bytes += len(lines)
+        self.batch.add(lines)
+        if self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        self.batch.flush()
+
+    def close(self):
+        self.flush()
+
+    def write(self, docs):
+        self.buffered_bytes = 0
+        for retry in range(self.max_retries + 1):
+            if retry:
+                gevent.sleep(self.backoff * 2 ** (retry - 1))
+            try:
+                result = self.es.bulk(body=''.join(docs))
+            except Exception:
+                logger.warning('bulk request with %s documents failed', len(docs), exc_info=True)
+                continue
+            if not result.get('errors'):
+                return
+            retry_docs = []
+            for doc, item in zip(docs, result['items']):
+                status, error = item['index']['status'], item['index'].get('error')
+                if status in RETRY_STATUSES:
+                    retry_docs.append(doc)
+                elif error:
+                    logger.error('cannot index document: %s', error)
+                    self.failed_count += 1
+            docs = retry_docs
+            if not docs:
+                return
+        logger.error('giving up on %s documents after %s retries', len(docs), self.max_retries)
+        self.failed_count += len(docs)
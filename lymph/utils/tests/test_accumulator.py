@@ -3,7 +3,7 @@ from __future__ import division
 from six.moves import range
 from unittest import TestCase
 
-from lymph.utils import Accumulator
+from lymph.utils import Accumulator, Histogram
 
 
 class AccumulatorTests(TestCase):
@@ -15,3 +15,22 @@ class AccumulatorTests(TestCase):
         self.assertEqual(acc.sum, 1)
         self.assertEqual(acc.mean, 0.2)
         self.assertEqual(acc.stddev, 0.09428090415820631)
+
+
+class HistogramTests(TestCase):
+    def test_percentile(self):
+        histogram = Histogram(precision=0.01)
+        self.assertIsNone(histogram.percentile(50))
+        for i in range(1, 1001):
+            histogram.add(i / 1000.)
+        self.assertEqual(len(histogram), 1000)
+        for p in (1, 50, 95, 99.9, 100):
+            self.assertAlmostEqual(histogram.percentile(p), p / 100., delta=p / 100. * 0.01)
+
+    def test_decay(self):
+        histogram = Histogram(decay=100)
+        for i in range(1000):
+            histogram.add(1)
+        for i in range(100):
+            histogram.add(10)
+        self.assertGreater(histogram.percentile(60), 9)
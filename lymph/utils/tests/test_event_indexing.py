@@ -1,6 +1,12 @@
+import collections
 import datetime
+import json
 import unittest
-from lymph.utils.event_indexing import EventIndex
+import uuid
+
+import gevent
+
+from lymph.utils.event_indexing import BulkEventIndexer, DatedEventIndex, EventIndex
 from lymph.core.events import Event
 from mock import patch, Mock
 
@@ -37,3 +43,103 @@ class TestStore(unittest.TestCase):
         self.assertEquals(es_event['_source']['b_bool'], True)
         self.assertEquals(es_event['_source']['l_list'], [1, 2, 3])
         self.assertEquals(es_event['_source']['type'], 'test_event')
+
+
+class FakeElasticsearch(object):
+    def __init__(self, statuses=()):
+        self.requests = []
+        self.documents = {}
+        # Per request, the statuses of its items (default: 201).
+        self.statuses = list(statuses)
+
+    def bulk(self, body):
+        lines = [json.loads(line) for line in body.splitlines()]
+        actions = list(zip(lines[::2], lines[1::2]))
+        self.requests.append(actions)
+        statuses = self.statuses.pop(0) if self.statuses else [201] * len(actions)
+        items = []
+        for (action, doc), status in zip(actions, statuses):
+            meta = action['index']
+            if status == 201:
+                self.documents[meta['_index'], meta['_id']] = doc
+                items.append({'index': {'status': status}})
+            else:
+                items.append({'index': {'status': status, 'error': 'error %s' % status}})
+        return {'errors': any(status != 201 for status in statuses), 'items': items}
+
+
+class BulkEventIndexerTest(unittest.TestCase):
+    def setUp(self):
+        self.es = FakeElasticsearch()
+
+    def create_indexer(self, index_cls=EventIndex, **kwargs):
+        return BulkEventIndexer(index_cls(self.es, 'events'), backoff=0, **kwargs)
+
+    def test_flush_by_size(self):
+        indexer = self.create_indexer(max_size=2)
+        for i in range(3):
+            indexer.add(Event('test_event', {'number': i, 'date': datetime.date(2014, 5, 2)}))
+        self.assertEqual(len(self.es.requests), 1)
+        self.assertEqual(len(indexer), 1)
+        indexer.close()
+        self.assertEqual(len(self.es.requests), 2)
+        docs = sorted(self.es.documents.values(), key=lambda doc: doc['i_number'])
+        self.assertEqual([doc['i_number'] for doc in docs], [0, 1, 2])
+        self.assertEqual(docs[0]['d_date'], '2014-05-02')
+        self.assertEqual(docs[0]['type'], 'test_event')
+
+    def test_flush_by_bytes(self):
+        indexer = self.create_indexer(max_bytes=300)
+        indexer.add(Event('test_event', {'string': 'x' * 100}))
+        self.assertEqual(self.es.requests, [])
+        indexer.add(Event('test_event', {'string': 'x' * 100}))
+        self.assertEqual(len(self.es.requests), 1)
+        self.assertEqual(indexer.buffered_bytes, 0)
+
+    def test_flush_by_age(self):
+        indexer = self.create_indexer(max_age=0.01)
+        indexer.add(Event('test_event', {}))
+        gevent.sleep(0.05)
+        self.assertEqual(len(self.es.documents), 1)
+
+    def test_retry_partial_failures(self):
+        self.es.statuses = [[201, 429, 400], [503], [201]]
+        indexer = self.create_indexer()
+        for i in range(3):
+            indexer.add(Event('test_event', {'number': i}))
+        indexer.flush()
+        self.assertEqual(len(self.es.requests), 3)
+        self.assertEqual(sorted(doc['i_number'] for doc in self.es.documents.values()), [0, 1])
+        self.assertEqual(indexer.failed_count, 1)
+
+    def test_give_up_after_max_retries(self):
+        self.es.statuses = [[429]] * 3
+        indexer = self.create_indexer(max_retries=2)
+        indexer.add(Event('test_event', {}))
+        indexer.flush()
+        self.assertEqual(len(self.es.requests), 3)
+        self.assertEqual(indexer.failed_count, 1)
+
+    def test_dated_index_name(self):
+        indexer = self.create_indexer(DatedEventIndex)
+        indexer.add(Event('test_event', {}))
+        indexer.flush()
+        (index_name, doc_id), = self.es.documents
+        self.assertEqual(index_name, 'events-%s' % datetime.datetime.now().strftime('%Y.%m.%d'))
+        now = datetime.datetime.now()
+        self.assertIs(indexer.index.get_index_name(now), indexer.index.get_index_name(now))
+
+
+class PrepareValueTest(unittest.TestCase):
+    def setUp(self):
+        self.index = EventIndex(Mock())
+
+    def test_subclasses(self):
+        self.assertEqual(self.index.prepare_value('x', collections.OrderedDict(a=1)), ('o_x', {'i_a': 1}))
+        self.assertEqual(self.index.prepare_value('x', datetime.datetime(2014, 5, 2)), ('d_x', datetime.datetime(2014, 5, 2)))
+        self.assertEqual(self.index.prepare_value('x', False), ('b_x', False))
+        self.assertEqual(self.index.prepare_value('x', uuid.UUID(int=1)), ('u_x', uuid.UUID(int=1).hex))
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            self.index.prepare_value('x', object())
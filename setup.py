@@ -54,6 +54,7 @@ setup(
     entry_points={
         'console_scripts': ['lymph = lymph.cli.main:main'],
         'lymph.cli': [
+            'bench = lymph.cli.bench:BenchCommand',
             'discover = lymph.cli.discover:DiscoverCommand',
             'emit = lymph.cli.emit:EmitCommand',
             'help = lymph.cli.help:HelpCommand',
@@ -71,6 +72,7 @@ setup(
         'kombu.serializers': [
             'lymph-json = lymph.serializers.kombu:json_serializer_args',
             'lymph-msgpack = lymph.serializers.kombu:msgpack_serializer_args',
+            'lymph-msgpack-ext = lymph.serializers.kombu:msgpack_ext_serializer_args',
         ],
     },
     classifiers=[